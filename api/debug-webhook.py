@@ -2,13 +2,15 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 from telegram import Bot
-import asyncio
+
+from botlib import event_loop
+from botlib.ptb_request import PTB_BASE_URL
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL)
 
 # Функция для получения информации о боте и вебхуке
 async def get_debug_info():
@@ -48,7 +50,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             # Получаем отладочную информацию
-            result = asyncio.run(get_debug_info())
+            result = event_loop.run(get_debug_info())
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
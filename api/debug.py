@@ -1,37 +1,37 @@
 from http.server import BaseHTTPRequestHandler
 import json
 import os
-from telegram import Bot
-import asyncio
+
+from botlib.telegram_client import get_client
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Клиент Bot API с пулом соединений (общий для всего процесса)
+client = get_client(BOT_TOKEN)
 
 # Функция для получения отладочной информации
-async def get_debug_info():
+def get_debug_info():
     try:
         # Получаем информацию о боте
-        me = await bot.get_me()
+        me = client.call("getMe")
         
         # Получаем информацию о вебхуке
-        webhook_info = await bot.get_webhook_info()
+        webhook_info = client.call("getWebhookInfo")
         
         # Проверяем, есть ли ошибки в вебхуке
-        has_webhook_errors = webhook_info.last_error_message is not None or webhook_info.last_error_date is not None
+        has_webhook_errors = webhook_info.get("last_error_message") is not None or webhook_info.get("last_error_date") is not None
         
         # Проверяем, установлен ли вебхук
-        is_webhook_set = webhook_info.url is not None and len(webhook_info.url) > 0
+        is_webhook_set = bool(webhook_info.get("url"))
         
         # Проверяем, есть ли ожидающие обновления
-        has_pending_updates = webhook_info.pending_update_count > 0
+        has_pending_updates = webhook_info.get("pending_update_count", 0) > 0
         
         return {
             "success": True,
-            "botInfo": me.to_dict(),
-            "webhookInfo": webhook_info.to_dict(),
+            "botInfo": me,
+            "webhookInfo": webhook_info,
             "diagnostics": {
                 "hasWebhookErrors": has_webhook_errors,
                 "isWebhookSet": is_webhook_set,
@@ -48,7 +48,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             # Получаем отладочную информацию
-            result = asyncio.run(get_debug_info())
+            result = get_debug_info()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
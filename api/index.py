@@ -5,6 +5,8 @@ import sys
 import logging
 from api.telegram import process_update  # Исправленный импорт функции обработки обновлений
 
+from botlib import event_loop
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -58,9 +60,8 @@ class handler(BaseHTTPRequestHandler):
             if self.path == '/api/telegram' or self.path == '/telegram':
                 logger.info("Обнаружено обновление от Telegram, обрабатываем...")
                 
-                import asyncio
                 # Вызываем асинхронную функцию обработки сообщения
-                result = asyncio.run(process_update(data))
+                result = event_loop.run(process_update(data))
                 
                 # Отправляем успешный ответ для Telegram
                 self.send_response(200)
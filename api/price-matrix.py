@@ -0,0 +1,94 @@
+from http.server import BaseHTTPRequestHandler
+import json
+import os
+import logging
+import urllib.parse
+
+from botlib.catalog import CatalogError
+from botlib.price_matrix import PRICE_MATRIX_SERVICES, get_price_matrix
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Сколько ячеек матрицы можно вернуть за один запрос
+PRICE_MATRIX_MAX_CELLS = int(os.environ.get("PRICE_MATRIX_MAX_CELLS", 200000))
+
+
+# Ошибка в параметрах запроса
+class BadRequest(ValueError):
+    pass
+
+
+# Номера позиций оси по названиям из запроса (без параметра - вся ось)
+def axis_indexes(query, param, names):
+    values = query.get(param)
+    if not values:
+        return None
+    index = {name: i for i, name in enumerate(names)}
+    unknown = [value for value in values if value not in index]
+    if unknown:
+        raise BadRequest(f"Неизвестные значения {param}: {unknown}")
+    return [index[value] for value in values]
+
+
+# Срез матрицы цен по параметрам запроса:
+#   district=<район>, depth=<метры>, set=<набор оборудования>, bundle=<маска услуг>
+#   (каждый можно повторять; без параметра - вся ось),
+#   service=<услуга> - услуги, из которых составляются пакеты (по умолчанию PRICE_MATRIX_SERVICES)
+def price_matrix_slice(query):
+    services = query.get("service") or PRICE_MATRIX_SERVICES
+    matrix = get_price_matrix(tuple(services))
+
+    districts = axis_indexes(query, "district", matrix.districts)
+    depths = axis_indexes(query, "depth", [str(depth) for depth in matrix.depths])
+    equipment_sets = axis_indexes(query, "set", matrix.equipment_sets)
+    bundles = query.get("bundle")
+    if bundles:
+        try:
+            bundles = [int(bundle) for bundle in bundles]
+        except ValueError:
+            raise BadRequest(f"bundle - номер пакета (битовая маска услуг): {bundles}")
+        if not all(0 <= bundle < matrix.shape[3] for bundle in bundles):
+            raise BadRequest(f"bundle должен быть от 0 до {matrix.shape[3] - 1}")
+
+    axes = [districts, depths, equipment_sets, bundles]
+    cells = 1
+    for axis, size in zip(axes, matrix.shape):
+        cells *= size if axis is None else len(axis)
+    if cells > PRICE_MATRIX_MAX_CELLS:
+        raise BadRequest(f"Слишком большой срез: {cells} ячеек (максимум {PRICE_MATRIX_MAX_CELLS}), "
+                         f"укажите district, depth, set или bundle")
+
+    prices = matrix.prices(*axes)
+    bundle_axis = range(matrix.shape[3]) if bundles is None else bundles
+    return {
+        "version": matrix.version,
+        "axes": {
+            "district": [matrix.districts[i] for i in districts] if districts else list(matrix.districts),
+            "depth": [int(matrix.depths[i]) for i in depths] if depths else matrix.depths.tolist(),
+            "set": [matrix.equipment_sets[i] for i in equipment_sets] if equipment_sets else list(matrix.equipment_sets),
+            "bundle": [{"id": bundle, "services": matrix.bundle_services(bundle)} for bundle in bundle_axis],
+        },
+        "services": list(matrix.services),
+        "shape": list(prices.shape),
+        # prices[район][глубина][набор][пакет]; -1 - глубины нет у района
+        "prices": prices.tolist(),
+    }
+
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        try:
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            status, response_data = 200, price_matrix_slice(query)
+        except (BadRequest, CatalogError) as e:
+            status, response_data = 400, {"status": "error", "error": str(e)}
+        except Exception as e:
+            logger.error(f"Ошибка при расчете матрицы цен: {e}", exc_info=True)
+            status, response_data = 500, {"status": "error", "error": str(e)}
+
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
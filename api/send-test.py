@@ -1,25 +1,25 @@
 from http.server import BaseHTTPRequestHandler
 import json
 import os
-from telegram import Bot
-import asyncio
+
+from botlib.telegram_client import get_client
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Клиент Bot API с пулом соединений (общий для всего процесса)
+client = get_client(BOT_TOKEN)
 
 # Функция для отправки тестового сообщения
-async def send_test_message(chat_id):
+def send_test_message(chat_id):
     try:
-        message = await bot.send_message(
-            chat_id=chat_id,
-            text="Тестовое сообщение от бота. Если вы видите это сообщение, значит бот работает корректно!"
-        )
+        message = client.call("sendMessage", {
+            "chat_id": chat_id,
+            "text": "Тестовое сообщение от бота. Если вы видите это сообщение, значит бот работает корректно!"
+        })
         return {
             "success": True,
-            "message_info": message.to_dict()
+            "message_info": message
         }
     except Exception as e:
         return {
@@ -45,7 +45,7 @@ class handler(BaseHTTPRequestHandler):
                 return
             
             # Отправляем тестовое сообщение
-            result = asyncio.run(send_test_message(chat_id))
+            result = send_test_message(chat_id)
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -2,9 +2,11 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 from telegram import Bot
-import asyncio
 import logging
 
+from botlib import event_loop
+from botlib.ptb_request import PTB_BASE_URL
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,7 +15,7 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL)
 
 # Функция для установки вебхука
 async def set_webhook(url):
@@ -72,7 +74,7 @@ class handler(BaseHTTPRequestHandler):
               return
           
           # Устанавливаем вебхук
-          result = asyncio.run(set_webhook(url))
+          result = event_loop.run(set_webhook(url))
           
           self.send_response(200)
           self.send_header('Content-type', 'application/json')
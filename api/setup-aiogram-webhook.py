@@ -2,10 +2,11 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import logging
-import asyncio
 import sys
 import platform
 
+from botlib import event_loop
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -35,8 +36,9 @@ try:
     
     logger.info(f"URL для вебхука: {VERCEL_URL}")
 
-    # Инициализация бота
-    bot = Bot(token=BOT_TOKEN)
+    # Инициализация бота (адрес Bot API задается TELEGRAM_API_BASE)
+    from botlib.aiogram_bot import API_SERVER
+    bot = Bot(token=BOT_TOKEN, server=API_SERVER)
 
     # Функция для установки вебхука
     async def set_webhook():
@@ -102,7 +104,7 @@ class handler(BaseHTTPRequestHandler):
         try:
             # Настраиваем вебхук и возвращаем информацию
             logger.info("Запуск настройки вебхука")
-            result = asyncio.run(set_webhook())
+            result = event_loop.run(set_webhook())
             logger.info(f"Результат настройки вебхука: {result}")
             
             self.send_response(200)
@@ -2,13 +2,15 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 from telegram import Bot
-import asyncio
+
+from botlib import event_loop
+from botlib.ptb_request import PTB_BASE_URL
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL)
 
 # Функция для установки вебхука
 async def set_webhook(url):
@@ -57,7 +59,7 @@ class handler(BaseHTTPRequestHandler):
                 return
             
             # Устанавливаем вебхук
-            result = asyncio.run(set_webhook(url))
+            result = event_loop.run(set_webhook(url))
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -72,7 +74,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             # Получаем информацию о вебхуке
-            result = asyncio.run(get_webhook_info())
+            result = event_loop.run(get_webhook_info())
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
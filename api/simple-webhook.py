@@ -1,14 +1,24 @@
 from http.server import BaseHTTPRequestHandler
 import json
 import os
+import asyncio
 import logging
 import sys
 import platform
-import urllib.request
-import urllib.parse
-import time
+import hashlib
 from enum import Enum
 
+from botlib import callbacks, event_loop
+from botlib.callbacks import CallbackError
+from botlib.catalog import EQUIPMENT_SETS, Catalog, CatalogError, CatalogSource, load_catalog_data
+from botlib.dedup import get_update_dedup
+from botlib.outbound import request_deadline
+from botlib.polling import UPDATES_MODE, UpdateIngestion, client_call
+from botlib.sessions import (CALLBACK_STATE_LIMITS, CALLBACK_STATE_PREFIX, SESSION_LIMITS, STATELESS_SESSIONS, Session,
+                             decode_callback_state, encode_callback_state, get_sessions, mask_bits)
+from botlib.shards import ShardedQueue, update_user_id, valid_update
+from botlib.telegram_client import get_client
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,239 +52,156 @@ class UserState(Enum):
     SERVICES_SELECTION = 4
     FINAL_CALCULATION = 5
 
-# Данные о районах и ценах
-# В реальном приложении нужно хранить в JSON или загружать из БД
-# Это упрощенная версия данных из lib/drilling-data.ts
-DISTRICTS = [
-    "Александровский район",
-    "Балашихинский район",
-    "Бронницы",
-    "Видное",
-    "Волоколамский район",
-    "Воскресенский район",
-    "Дмитровский район",
-    "Домодедовский район",
-    "Дубна",
-    "Егорьевский район",
-    "Железнодорожный",
-    "Жуковский",
-    "Зарайский район",
-    "Звенигород",
-    "Ивантеевка",
-    "Истринский район",
-    "Каширский район",
-    "Климовск",
-    "Клинский район",
-    "Коломенский район",
-    "Королёв",
-    "Красногорский район",
-    "Ленинский район",
-    "Лотошинский район",
-    "Луховицкий район",
-    "Люберцы",
-    "Можайский район",
-    "Москва",
-    "Наро-Фоминский район",
-    "Ногинский район",
-    "Одинцовский район",
-    "Озёрский район",
-    "Пушкинский район",
-    "Раменский район",
-    "Рублёво",
-    "Рузский район",
-    "Сергиево-Посадский район",
-    "Серебряно-Прудский район",
-    "Серпуховский район",
-    "Ступинский район",
-    "Щёлковский район",
-    "Талдомский район",
-    "Чеховский район",
-    "Шатурский район",
-    "Шаховский район",
-    "Электросталь",
-    "Электроугли"
-]
-
-# Глубины для районов (из предоставленных данных)
-DISTRICT_DEPTHS = {
-    "Александровский район": [[40, 60], [60, 180]],
-    "Балашихинский район": [[15, 40], [30, 160]],
-    "Бронницы": [[45, 65]],
-    "Видное": [[20, 30], [25, 120]],
-    "Волоколамский район": [[30, 60], [35, 180]],
-    "Воскресенский район": [[35, 100]],
-    "Дмитровский район": [[30, 50], [60, 80], [70, 180]],
-    "Домодедовский район": [[25, 90]],
-    "Дубна": [[25, 50], [70, 110]],
-    "Егорьевский район": [[40, 100]],
-    "Железнодорожный": [],
-    "Жуковский": [[50, 85]],
-    "Зарайский район": [[45, 110]],
-    "Звенигород": [[15, 30], [45, 120]],
-    "Ивантеевка": [[15, 40], [45, 110]],
-    "Истринский район": [[15, 40], [55, 80], [60, 180]],
-    "Каширский район": [[40, 150]],
-    "Климовск": [[45, 75]],
-    "Клинский район": [[30, 50], [60, 80], [70, 180]],
-    "Коломенский район": [[45, 90]],
-    "Королёв": [[45, 70]],
-    "Красногорский район": [[60, 120]],
-    "Ленинский район": [[20, 30], [25, 120]],
-    "Лотошинский район": [[25, 50], [45, 120]],
-    "Луховицкий район": [[15, 30], [30, 100]],
-    "Люберцы": [[10, 20], [25, 100]],
-    "Можайский район": [[25, 50], [45, 130]],
-    "Москва": [],
-    "Наро-Фоминский район": [[15, 40], [25, 140]],
-    "Ногинский район": [[15, 30], [20, 100]],
-    "Одинцовский район": [[15, 50], [40, 160]],
-    "Озёрский район": [],
-    "Пушкинский район": [[15, 60], [45, 120]],
-    "Раменский район": [[15, 30], [15, 120]],
-    "Рублёво": [[15, 40], [60, 110]],
-    "Рузский район": [[15, 40], [20, 180]],
-    "Сергиево-Посадский район": [[15, 40], [50, 90], [70, 250]],
-    "Серебряно-Прудский район": [[50, 100]],
-    "Серпуховский район": [[25, 130]],
-    "Ступинский район": [[15, 100]],
-    "Щёлковский район": [[10, 30], [15, 90]],
-    "Талдомский район": [[15, 50], [60, 130]],
-    "Чеховский район": [[30, 60]],
-    "Шатурский район": [],
-    "Шаховский район": [[15, 40], [50, 130]],
-    "Электросталь": [[25, 60]],
-    "Электроугли": [[25, 60]]
-}
-
-# Наборы оборудования и их компоненты
-EQUIPMENT_SETS = {
-    "Адаптер №1": {
-        "насос": 25000,
-        "колонка": 8000
-    },
-    "Адаптер №2": {
-        "насос": 25000,
-        "реле": 800,
-        "обвязка": 300
-    },
-    "Адаптер №3": {
-        "насос": 25000,
-        "гидроаккумулятор": 8000,
-        "доведение внутрь объекта": 5000
-    },
-    "Кессон №1": {
-        "кессон": 75000,
-        "обратный клапан": 3300,
-        "блок автоматики": 5830,
-        "трос": 8800,
-        "кабель": 16500,
-        "зажим троса": 200,
-        "фильтр компресс. переход": 350,
-        "труба PPR Ø32": 130,
-        "труба ПНД Ø32": 10000,
-        "запорная арматура, фитинги": 6000,
-        "оголовок": 3500
-    },
-    "Кессон №2": {
-        "кессон": 75000,
-        "обратный клапан": 3300,
-        "блок автоматики": 5830,
-        "трос": 8800,
-        "кабель": 16500,
-        "зажим троса": 200,
-        "фильтр компресс. переход": 350,
-        "труба PPR Ø32": 130,
-        "труба ПНД Ø32": 500,
-        "запорная арматура, фитинги": 6000,
-        "оголовок": 3500
-    },
-    "Кессон №3": {
-        "кессон": 75000,
-        "обратный клапан": 3300,
-        "блок автоматики": 5830,
-        "трос": 8800,
-        "кабель": 16500,
-        "зажим троса": 200,
-        "фильтр компресс. переход": 350,
-        "труба PPR Ø32": 130,
-        "труба ПНД Ø32": 500,
-        "запорная арматура, фитинги": 6000,
-        "оголовок": 3500
-    },
-    "Станция биологической очистки": {
-        "насос для принудительного выброса очищенной воды": 7500,
-        "колодец в три кольца с крышкой": 45000
-    }
-}
+# Районы, глубины и цены - из артефакта, собранного из lib/drilling-data.ts
+# (python -m botlib.catalog_compiler)
+CATALOG_DATA = load_catalog_data()
+
+DISTRICTS = CATALOG_DATA.districts
 
-# Услуги и цены
-SERVICES = {
-    "Монтаж кессона": 19000,
-    "Монтаж систем автоматики": 2000,
-    "Транспортные расходы": 3000,
-    "Анализ воды": 5000,
-    "Монтаж гидроаккумулятора": 2900
-}
+# Глубины для районов: диапазоны горизонтов ПИ1 и ПИ2
+DISTRICT_DEPTHS = CATALOG_DATA.district_depth_ranges()
 
-# Хранилище состояний пользователей в памяти
-# В реальном приложении нужно использовать Redis или другую БД
-user_states = {}
+# Услуги калькулятора (цены - из артефакта каталога)
+SERVICES = CATALOG_DATA.service_price_map([
+    "Монтаж кессона",
+    "Монтаж систем автоматики",
+    "Транспортные расходы",
+    "Анализ воды",
+    "Монтаж гидроаккумулятора",
+])
 
 # Базовая стоимость бурения за метр
-BASE_DRILLING_COST = 2900
+BASE_DRILLING_COST = CATALOG_DATA.base_drilling_cost
+
+# Каталог с готовыми таблицами цен. Данные выше - каталог по умолчанию; если задан
+# CATALOG_FILE, каталог берется из файла и перечитывается при его изменении без
+# перезапуска. Сессия хранит вместо названий номера позиций и битовые маски,
+# короткие callback_data (d:12, e:7) - тоже номера (catalog.callbacks)
+DEFAULT_CATALOG = Catalog(DISTRICTS, DISTRICT_DEPTHS, EQUIPMENT_SETS, SERVICES, BASE_DRILLING_COST)
+
+# Режим "сессия в кнопках" (STATELESS_SESSIONS из botlib.sessions): любой экземпляр
+# функции обработает нажатие без обращения к хранилищу сессий. Обычные короткие
+# кнопки (d:12) по-прежнему работают через user_states
+
+# В сессию внутри кнопки помещается меньше позиций каталога (CALLBACK_STATE_LIMITS):
+# если каталог в нее не помещается, режим не включаем, а новый файл каталога,
+# который не помещается, не загружаем
+if STATELESS_SESSIONS:
+    try:
+        DEFAULT_CATALOG.check_limits(CALLBACK_STATE_LIMITS)
+    except CatalogError as e:
+        logger.error(f"STATELESS_SESSIONS выключен: {e}")
+        STATELESS_SESSIONS = False
+
+CATALOGS = CatalogSource(DEFAULT_CATALOG, limits=CALLBACK_STATE_LIMITS if STATELESS_SESSIONS else SESSION_LIMITS)
+# Проверка файла каталога в фоновом event loop
+event_loop.submit(CATALOGS.run_reloader())
+
+# Ключ подписи сессии в callback_data (производный от токена бота)
+CALLBACK_KEY = hashlib.sha256(f"callback-state:{BOT_TOKEN}".encode("utf-8")).digest()
+
+# Коды видов кнопок для сессии в callback_data (номер в кортеже)
+CALLBACK_KINDS = (
+    None,
+    callbacks.DISTRICT,
+    callbacks.DEPTH,
+    callbacks.EQUIPMENT_SET,
+    callbacks.EQUIPMENT_CUSTOM,
+    callbacks.EQUIPMENT_DONE,
+    callbacks.EQUIPMENT,
+    callbacks.SERVICES_DONE,
+    callbacks.SERVICE,
+    callbacks.NEW_CALCULATION,
+)
+CALLBACK_CODES = {kind: code for code, kind in enumerate(CALLBACK_KINDS) if kind}
+
+# callback_data кнопки: в режиме STATELESS_SESSIONS к действию добавляется сессия
+def button_data(kind, index=None, session=None):
+    if not STATELESS_SESSIONS or session is None:
+        return CATALOGS.current.callbacks.data(kind, index)
+    return encode_callback_state(CALLBACK_CODES[kind], index or 0, session, CALLBACK_KEY)
+
+# Хранилище состояний пользователей (Session): кэш в памяти процесса,
+# изменения пачками записываются в SQLite (SESSION_DB)
+user_states = get_sessions("simple-webhook", Session)
+# Чистка давно не использованных сессий в фоновом event loop
+event_loop.submit(user_states.run_sweeper())
+
+# Общий клиент Bot API с пулом keep-alive соединений.
+# Создается при импорте, чтобы DNS и TLS-рукопожатие прогрелись до первого обновления
+telegram_client = get_client(BOT_TOKEN)
 
 # Функция для прямого вызова Telegram Bot API
 def telegram_api_request(method, data=None):
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/{method}"
-    
-    if data:
-        data = json.dumps(data).encode('utf-8')
-        headers = {'Content-Type': 'application/json'}
-    else:
-        data = None
-        headers = {}
-    
-    req = urllib.request.Request(url, data=data, headers=headers)
-    
-    try:
-        with urllib.request.urlopen(req) as response:
-            return json.loads(response.read().decode('utf-8'))
-    except Exception as e:
-        logger.error(f"Ошибка при вызове Telegram API: {e}")
-        return {"ok": False, "error": str(e)}
+    return telegram_client.request(method, data)
+
+# Режим ответа через тело вебхука: основной вызов Bot API (sendMessage или
+# editMessageText) возвращается Telegram прямо в HTTP-ответе на вебхук,
+# отдельным исходящим запросом уходят только остальные вызовы
+WEBHOOK_REPLY_MODE = os.environ.get("WEBHOOK_REPLY_MODE", "").lower() in ("1", "true", "yes")
+
+# Режим "сначала подтверждение": обновление ставится в очередь, Telegram сразу
+# получает 200, а обработка идет в фоне; при переполнении очереди отвечаем 503.
+# Имеет смысл на постоянно работающем сервере: serverless-функция после ответа
+# может быть заморожена. Отвечать в теле вебхука в этом режиме некуда
+WEBHOOK_ACK_FIRST = os.environ.get("WEBHOOK_ACK_FIRST", "").lower() in ("1", "true", "yes")
+if WEBHOOK_ACK_FIRST:
+    WEBHOOK_REPLY_MODE = False
+
+# Отправка основного ответа на обновление
+def reply_with(method, data):
+    if WEBHOOK_REPLY_MODE:
+        # Редактирование, которое ничего не меняет, не отправляем вовсе,
+        # а если изменилась только клавиатура - отправляем editMessageReplyMarkup
+        plan = telegram_client.outbound.prepare_inline(method, data)
+        if plan is None:
+            return {"ok": True}
+        method, data = plan
+        return {"method": method, **data}
+    telegram_api_request(method, data)
+    return {"ok": True}
 
 # Функция для создания клавиатуры с районами
-def create_districts_keyboard():
+def create_districts_keyboard(session=None):
+    catalog = CATALOGS.current
     keyboard = []
     row = []
     
-    for i, district in enumerate(DISTRICTS, 1):
-        row.append({"text": district, "callback_data": f"district_{district}"})
+    for i, district in enumerate(catalog.districts, 1):
+        row.append({"text": district, "callback_data": button_data(callbacks.DISTRICT, i - 1, session)})
         
         # По 2 кнопки в ряду
-        if i % 2 == 0 or i == len(DISTRICTS):
+        if i % 2 == 0 or i == len(catalog.districts):
             keyboard.append(row)
             row = []
     
     return {"inline_keyboard": keyboard}
 
-# Функция для создания клавиатуры с глубинами
-def create_depths_keyboard(district):
-    depths = DISTRICT_DEPTHS.get(district, [])
-    keyboard = []
-    
+# Глубины, которые предлагаются району: по нескольку значений из каждого диапазона
+def offered_depths(district):
+    depths = CATALOGS.current.district_depths.get(district, ())
     if not depths:
         # Если для района нет данных по глубинам, предлагаем стандартные значения
-        depths = [[20, 50], [60, 100]]
+        depths = ((20, 50), (60, 100))
+    return [range(start_depth, end_depth + 1, max(5, (end_depth - start_depth) // 4))
+            for start_depth, end_depth in depths]
+
+# Есть ли глубина среди предложенных району сессии (кнопку глубины можно подделать)
+def depth_offered(session, depth):
+    catalog = CATALOGS.current
+    if not 0 <= session.district < len(catalog.districts):
+        return False
+    return any(depth in depths for depths in offered_depths(catalog.districts[session.district]))
+
+# Функция для создания клавиатуры с глубинами
+def create_depths_keyboard(district, session=None):
+    keyboard = []
     
     # Перебираем диапазоны глубин и создаем кнопки
-    for depth_range in depths:
-        start_depth, end_depth = depth_range
+    for depths in offered_depths(district):
         row = []
-        # Добавляем несколько значений из диапазона
-        step = max(5, (end_depth - start_depth) // 4)
-        for depth in range(start_depth, end_depth + 1, step):
-            row.append({"text": f"{depth} м", "callback_data": f"depth_{depth}"})
+        for depth in depths:
+            row.append({"text": f"{depth} м", "callback_data": button_data(callbacks.DEPTH, depth, session)})
             if len(row) == 3:  # Максимум 3 кнопки в ряду
                 keyboard.append(row)
                 row = []
@@ -284,100 +211,79 @@ def create_depths_keyboard(district):
     return {"inline_keyboard": keyboard}
 
 # Функция для создания клавиатуры с наборами оборудования
-def create_equipment_sets_keyboard(selected_set=None):
+def create_equipment_sets_keyboard(selected_set=-1, session=None):
+    catalog = CATALOGS.current
     keyboard = []
     
-    for equipment_set in EQUIPMENT_SETS.keys():
-        prefix = "✅ " if equipment_set == selected_set else ""
-        total_price = sum(EQUIPMENT_SETS[equipment_set].values())
+    for index, equipment_set in enumerate(catalog.equipment_set_names):
+        prefix = "✅ " if index == selected_set else ""
+        total_price = catalog.equipment_set_totals[index]
         keyboard.append([{
             "text": f"{prefix}{equipment_set} - {total_price} руб.",
-            "callback_data": f"equipment_set_{equipment_set}"
+            "callback_data": button_data(callbacks.EQUIPMENT_SET, index, session)
         }])
     
-    keyboard.append([{"text": "Индивидуальный набор", "callback_data": "equipment_custom"}])
-    keyboard.append([{"text": "Продолжить без оборудования", "callback_data": "equipment_done"}])
+    keyboard.append([{"text": "Индивидуальный набор", "callback_data": button_data(callbacks.EQUIPMENT_CUSTOM, session=session)}])
+    keyboard.append([{"text": "Продолжить без оборудования", "callback_data": button_data(callbacks.EQUIPMENT_DONE, session=session)}])
     return {"inline_keyboard": keyboard}
 
 # Функция для создания клавиатуры с отдельными компонентами оборудования
-def create_equipment_keyboard(selected_equipment=None):
-    if selected_equipment is None:
-        selected_equipment = []
-    
-    # Собираем все уникальные компоненты из всех наборов
-    all_components = {}
-    for equipment_set in EQUIPMENT_SETS.values():
-        for component, price in equipment_set.items():
-            all_components[component] = price
-    
+# (selected_equipment - битовая маска выбранных компонентов)
+def create_equipment_keyboard(selected_equipment=0, session=None):
+    catalog = CATALOGS.current
     keyboard = []
-    for component, price in all_components.items():
-        prefix = "✅ " if component in selected_equipment else ""
+    for index, (component, price) in enumerate(zip(catalog.component_names, catalog.component_prices)):
+        prefix = "✅ " if selected_equipment >> index & 1 else ""
         keyboard.append([{
             "text": f"{prefix}{component} - {price} руб.",
-            "callback_data": f"equipment_{component}"
+            "callback_data": button_data(callbacks.EQUIPMENT, index, session)
         }])
     
-    keyboard.append([{"text": "Завершить выбор компонентов", "callback_data": "equipment_done"}])
+    keyboard.append([{"text": "Завершить выбор компонентов", "callback_data": button_data(callbacks.EQUIPMENT_DONE, session=session)}])
     return {"inline_keyboard": keyboard}
 
 # Функция для создания клавиатуры с услугами
-def create_services_keyboard(selected_services=None):
-    if selected_services is None:
-        selected_services = []
-    
+# (selected_services - битовая маска выбранных услуг)
+def create_services_keyboard(selected_services=0, session=None):
+    catalog = CATALOGS.current
     keyboard = []
-    for service, price in SERVICES.items():
-        prefix = "✅ " if service in selected_services else ""
+    for index, (service, price) in enumerate(zip(catalog.service_names, catalog.service_prices)):
+        prefix = "✅ " if selected_services >> index & 1 else ""
         keyboard.append([{
             "text": f"{prefix}{service} - {price} руб.",
-            "callback_data": f"service_{service}"
+            "callback_data": button_data(callbacks.SERVICE, index, session)
         }])
     
-    keyboard.append([{"text": "Завершить выбор услуг", "callback_data": "services_done"}])
+    keyboard.append([{"text": "Завершить выбор услуг", "callback_data": button_data(callbacks.SERVICES_DONE, session=session)}])
     return {"inline_keyboard": keyboard}
 
 # Функция расчета стоимости бурения
 def calculate_drilling_cost(district, depth):
-    return depth * BASE_DRILLING_COST
+    return CATALOGS.current.drilling_cost(depth)
+
+# Стоимость оборудования сессии: готовый набор или выбранные компоненты
+def calculate_equipment_cost(session):
+    return CATALOGS.current.equipment_cost(session.equipment_set, session.equipment)
+
+# Стоимость выбранных услуг сессии
+def calculate_services_cost(session):
+    return CATALOGS.current.services_cost(session.services)
 
 # Функция расчета общей стоимости
-def calculate_total_cost(district, depth, selected_equipment, selected_services):
-    # Стоимость бурения
-    drilling_cost = calculate_drilling_cost(district, depth)
-    
-    # Стоимость оборудования
-    equipment_cost = sum(EQUIPMENT_SETS.get(item, 0) for item in selected_equipment)
-    
-    # Стоимость услуг
-    services_cost = sum(SERVICES.get(item, 0) for item in selected_services)
-    
-    return drilling_cost + equipment_cost + services_cost
+def calculate_total_cost(session):
+    return (calculate_drilling_cost(session.district, session.depth)
+            + calculate_equipment_cost(session)
+            + calculate_services_cost(session))
 
 # Функция создания итогового сообщения с расчетом
-def create_final_message(user_data):
-    district = user_data.get('district', 'Не выбран')
-    depth = user_data.get('depth', 0)
-    equipment_set = user_data.get('equipment_set')
-    selected_equipment = user_data.get('selected_equipment', [])
-    selected_services = user_data.get('selected_services', [])
+def create_final_message(session):
+    catalog = CATALOGS.current
+    district = catalog.districts[session.district] if session.district >= 0 else 'Не выбран'
+    depth = session.depth
     
     drilling_cost = calculate_drilling_cost(district, depth)
-    
-    # Если выбран готовый набор оборудования
-    if equipment_set and equipment_set in EQUIPMENT_SETS:
-        equipment_items = EQUIPMENT_SETS[equipment_set]
-        equipment_cost = sum(equipment_items.values())
-    else:
-        # Собираем все уникальные компоненты из всех наборов для расчета цены
-        all_components = {}
-        for equipment_set in EQUIPMENT_SETS.values():
-            for component, price in equipment_set.items():
-                all_components[component] = price
-        
-        equipment_cost = sum(all_components.get(item, 0) for item in selected_equipment)
-    
-    services_cost = sum(SERVICES.get(item, 0) for item in selected_services)
+    equipment_cost = calculate_equipment_cost(session)
+    services_cost = calculate_services_cost(session)
     total_cost = drilling_cost + equipment_cost + services_cost
     
     message = f"📋 *Итоговый расчет стоимости бурения*\n\n"
@@ -386,29 +292,22 @@ def create_final_message(user_data):
     
     message += f"💰 *Стоимость бурения:* {drilling_cost} руб.\n\n"
     
-    if equipment_set and equipment_set in EQUIPMENT_SETS:
+    if session.equipment_set >= 0:
+        equipment_set = catalog.equipment_set_names[session.equipment_set]
         message += f"🔧 *Выбранный набор:* {equipment_set}\n"
-        for item, price in EQUIPMENT_SETS[equipment_set].items():
+        for item, price in catalog.equipment_set_items[session.equipment_set]:
             message += f"• {item} - {price} руб.\n"
         message += f"*Итого за оборудование:* {equipment_cost} руб.\n\n"
-    elif selected_equipment:
-        # Собираем все уникальные компоненты из всех наборов для вывода
-        all_components = {}
-        for equipment_set in EQUIPMENT_SETS.values():
-            for component, price in equipment_set.items():
-                all_components[component] = price
-        
+    elif session.equipment:
         message += f"🔧 *Выбранное оборудование:*\n"
-        for item in selected_equipment:
-            price = all_components.get(item, 0)
-            message += f"• {item} - {price} руб.\n"
+        for index in mask_bits(session.equipment):
+            message += f"• {catalog.component_names[index]} - {catalog.component_prices[index]} руб.\n"
         message += f"*Итого за оборудование:* {equipment_cost} руб.\n\n"
     
-    if selected_services:
+    if session.services:
         message += f"🛠 *Выбранные услуги:*\n"
-        for item in selected_services:
-            price = SERVICES.get(item, 0)
-            message += f"• {item} - {price} руб.\n"
+        for index in mask_bits(session.services):
+            message += f"• {catalog.service_names[index]} - {catalog.service_prices[index]} руб.\n"
         message += f"*Итого за услуги:* {services_cost} руб.\n\n"
     
     message += f"*ОБЩАЯ СТОИМОСТЬ: {total_cost} руб.*"
@@ -451,6 +350,21 @@ def set_webhook():
 def process_update(update_data):
     logger.info(f"Получено обновление от Telegram")
     
+    # Сессия приходит в callback_data кнопки - хранилище не нужно
+    if STATELESS_SESSIONS:
+        return handle_update(update_data)
+    
+    # При общем хранилище сессий (Redis) читаем свежую сессию пользователя;
+    # после обработки сессия кодируется одним снимком и записывается
+    user_id = str(update_user_id(update_data))
+    user_states.refresh(user_id)
+    try:
+        return handle_update(update_data)
+    finally:
+        user_states.commit(user_id)
+
+# Обработка обновления по типу
+def handle_update(update_data):
     # Обработка callback-запросов (нажатий на кнопки)
     if 'callback_query' in update_data:
         return process_callback_query(update_data['callback_query'])
@@ -461,6 +375,15 @@ def process_update(update_data):
     
     return {"ok": True}
 
+# Фильтр повторных доставок: Telegram повторяет обновление, если вебхук
+# ответил ошибкой или не успел ответить, а повторное нажатие кнопки
+# снова переключило бы выбор оборудования или услуги
+update_dedup = get_update_dedup()
+
+# Очереди фоновой обработки (WEBHOOK_ACK_FIRST и getUpdates): обновления одного
+# пользователя обрабатываются по порядку, разных - параллельно в пуле потоков
+update_queue = ShardedQueue(lambda update_data: asyncio.to_thread(process_update, update_data))
+
 # Обработка текстовых сообщений
 def process_message(message):
     chat_id = message['chat']['id']
@@ -468,38 +391,27 @@ def process_message(message):
     user_id = str(message['from']['id'])
     
     # Инициализация состояния пользователя если его нет
-    if user_id not in user_states:
-        user_states[user_id] = {
-            'state': UserState.START.value,
-            'district': None,
-            'depth': None,
-            'equipment_set': None,
-            'selected_equipment': [],
-            'selected_services': [],
-            'timestamp': time.time()
-        }
+    if not STATELESS_SESSIONS and user_id not in user_states:
+        user_states[user_id] = Session(UserState.START.value)
+    
+    # Ответ на обновление (в режиме WEBHOOK_REPLY_MODE уходит в теле HTTP-ответа)
+    response = {"ok": True}
     
     # Обработка команд
     if text == '/start':
         # Сбрасываем состояние пользователя
-        user_states[user_id] = {
-            'state': UserState.DISTRICT_SELECTION.value,
-            'district': None,
-            'depth': None,
-            'equipment_set': None,
-            'selected_equipment': [],
-            'selected_services': [],
-            'timestamp': time.time()
-        }
+        session = Session(UserState.DISTRICT_SELECTION.value)
+        if not STATELESS_SESSIONS:
+            user_states[user_id] = session
         
-        telegram_api_request("sendMessage", {
+        response = reply_with("sendMessage", {
             "chat_id": chat_id,
             "text": "👋 Добро пожаловать в калькулятор стоимости бурения скважин!\n\nВыберите район, в котором планируется бурение:",
-            "reply_markup": create_districts_keyboard()
+            "reply_markup": create_districts_keyboard(session)
         })
     
     elif text == '/help':
-        telegram_api_request("sendMessage", {
+        response = reply_with("sendMessage", {
             "chat_id": chat_id,
             "text": "🔹 *Команды бота*:\n\n"
                    "/start - начать расчет стоимости бурения\n"
@@ -517,50 +429,58 @@ def process_message(message):
     
     elif text == '/reset':
         # Сбрасываем состояние пользователя
-        user_states[user_id] = {
-            'state': UserState.START.value,
-            'district': None,
-            'depth': None,
-            'equipment_set': None,
-            'selected_equipment': [],
-            'selected_services': [],
-            'timestamp': time.time()
-        }
+        if not STATELESS_SESSIONS:
+            user_states[user_id] = Session(UserState.START.value)
         
-        telegram_api_request("sendMessage", {
+        response = reply_with("sendMessage", {
             "chat_id": chat_id,
             "text": "🔄 Все данные сброшены. Отправьте /start чтобы начать новый расчет."
         })
     
     else:
         # Если это не команда, отправляем инструкцию
-        telegram_api_request("sendMessage", {
+        response = reply_with("sendMessage", {
             "chat_id": chat_id,
             "text": "Отправьте /start чтобы начать расчет стоимости бурения или /help для справки."
         })
     
-    return {"ok": True}
+    return response
 
 # Обработка нажатий на кнопки
 def process_callback_query(callback_query):
+    catalog = CATALOGS.current
     user_id = str(callback_query['from']['id'])
     chat_id = callback_query['message']['chat']['id']
     message_id = callback_query['message']['message_id']
     callback_data = callback_query['data']
     
-    # Инициализация состояния пользователя если его нет
-    if user_id not in user_states:
-        user_states[user_id] = {
-            'state': UserState.START.value,
-            'district': None,
-            'depth': None,
-            'equipment_set': None,
-            'selected_equipment': [],
-            'selected_services': [],
-            'timestamp': time.time()
-        }
+    # Вид кнопки и номер позиции каталога. Кнопка режима STATELESS_SESSIONS
+    # несет в себе и сессию, остальные берут сессию из user_states
+    stateless = callback_data.startswith(CALLBACK_STATE_PREFIX)
+    try:
+        if stateless:
+            state = decode_callback_state(callback_data, CALLBACK_KEY)
+            if state is None or not 0 < state[0] < len(CALLBACK_KINDS):
+                raise CallbackError(f"Неверная сессия в кнопке: {callback_data!r}")
+            code, index, session = state
+            kind = CALLBACK_KINDS[code]
+        else:
+            kind, index = catalog.callbacks.parse(callback_data)
+            # Инициализация состояния пользователя если его нет
+            if user_id not in user_states:
+                user_states[user_id] = Session(UserState.START.value)
+            session = user_states[user_id]
+        if kind == callbacks.DEPTH and not depth_offered(session, index):
+            raise CallbackError(f"Глубины {index} нет у района сессии: {callback_data!r}")
+    except CallbackError as e:
+        logger.warning(f"{e}")
+        telegram_api_request("answerCallbackQuery", {
+            "callback_query_id": callback_query['id'],
+            "text": "Кнопка устарела. Отправьте /start, чтобы начать новый расчет."
+        })
+        return {"ok": True}
     
-    user_data = user_states[user_id]
+    response = {"ok": True}
     
     # Отправляем ответ на callback query чтобы убрать "часики" на кнопке
     telegram_api_request("answerCallbackQuery", {
@@ -568,206 +488,162 @@ def process_callback_query(callback_query):
     })
     
     # Обработка выбора района
-    if callback_data.startswith('district_'):
-        district = callback_data.replace('district_', '')
-        user_data['district'] = district
-        user_data['state'] = UserState.DEPTH_SELECTION.value
+    if kind == callbacks.DISTRICT:
+        district = catalog.districts[index]
+        session.district = index
+        session.state = UserState.DEPTH_SELECTION.value
         
-        telegram_api_request("editMessageText", {
+        response = reply_with("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": f"🏡 Выбран район: *{district}*\n\nТеперь выберите глубину бурения:",
             "parse_mode": "Markdown",
-            "reply_markup": create_depths_keyboard(district)
+            "reply_markup": create_depths_keyboard(district, session)
         })
     
     # Обработка выбора глубины
-    elif callback_data.startswith('depth_'):
-        depth = int(callback_data.replace('depth_', ''))
-        user_data['depth'] = depth
-        user_data['state'] = UserState.EQUIPMENT_SELECTION.value
+    elif kind == callbacks.DEPTH:
+        depth = index
+        session.depth = depth
+        session.state = UserState.EQUIPMENT_SELECTION.value
         
         # Рассчитываем стоимость бурения
-        drilling_cost = calculate_drilling_cost(user_data['district'], depth)
+        drilling_cost = calculate_drilling_cost(session.district, depth)
         
-        telegram_api_request("editMessageText", {
+        response = reply_with("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": f"📏 Выбрана глубина: *{depth} м*\n\n"
                    f"💰 Стоимость бурения: *{drilling_cost} руб.*\n\n"
                    f"Выберите набор оборудования:",
             "parse_mode": "Markdown",
-            "reply_markup": create_equipment_sets_keyboard(user_data.get('equipment_set'))
+            "reply_markup": create_equipment_sets_keyboard(session.equipment_set, session)
         })
     
     # Обработка выбора набора оборудования
-    elif callback_data.startswith('equipment_set_'):
-        equipment_set = callback_data.replace('equipment_set_', '')
-        user_data['equipment_set'] = equipment_set
-        user_data['selected_equipment'] = list(EQUIPMENT_SETS[equipment_set].keys())
-        user_data['state'] = UserState.SERVICES_SELECTION.value
+    elif kind == callbacks.EQUIPMENT_SET:
+        equipment_set = catalog.equipment_set_names[index]
+        session.equipment_set = index
+        session.equipment = catalog.equipment_set_masks[index]
+        session.state = UserState.SERVICES_SELECTION.value
         
         # Рассчитываем стоимость оборудования
-        equipment_cost = sum(EQUIPMENT_SETS[equipment_set].values())
+        equipment_cost = calculate_equipment_cost(session)
         
-        telegram_api_request("editMessageText", {
+        response = reply_with("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": f"🔧 Выбран набор: *{equipment_set}*\n\n"
                    f"💰 Стоимость оборудования: *{equipment_cost} руб.*\n\n"
                    f"Теперь выберите дополнительные услуги:",
             "parse_mode": "Markdown",
-            "reply_markup": create_services_keyboard(user_data.get('selected_services', []))
+            "reply_markup": create_services_keyboard(session.services, session)
         })
     
     # Обработка запроса на индивидуальный набор оборудования
-    elif callback_data == 'equipment_custom':
-        user_data['equipment_set'] = None
-        user_data['selected_equipment'] = []
+    elif kind == callbacks.EQUIPMENT_CUSTOM:
+        session.equipment_set = -1
+        session.equipment = 0
         
-        telegram_api_request("editMessageText", {
+        response = reply_with("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": f"🔧 Выберите компоненты оборудования по отдельности:",
             "parse_mode": "Markdown",
-            "reply_markup": create_equipment_keyboard(user_data.get('selected_equipment', []))
+            "reply_markup": create_equipment_keyboard(session.equipment, session)
+        })
+    
+    # Обработка завершения выбора оборудования
+    elif kind == callbacks.EQUIPMENT_DONE:
+        session.state = UserState.SERVICES_SELECTION.value
+        
+        # Рассчитываем стоимость выбранного оборудования
+        equipment_cost = calculate_equipment_cost(session)
+        
+        response = reply_with("editMessageText", {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": "🔧 Выбор оборудования завершен.\n\n"
+                   f"💰 Стоимость оборудования: *{equipment_cost} руб.*\n\n"
+                   f"Теперь выберите дополнительные услуги:",
+            "parse_mode": "Markdown",
+            "reply_markup": create_services_keyboard(session.services, session)
         })
     
     # Обработка выбора компонентов оборудования
-    elif callback_data.startswith('equipment_'):
-        if callback_data == 'equipment_done':
-            user_data['state'] = UserState.SERVICES_SELECTION.value
-            
-            # Собираем все уникальные компоненты из всех наборов для расчета цены
-            all_components = {}
-            for equipment_set in EQUIPMENT_SETS.values():
-                for component, price in equipment_set.items():
-                    all_components[component] = price
-            
-            # Рассчитываем стоимость выбранного оборудования
-            equipment_cost = sum(all_components.get(item, 0) for item in user_data.get('selected_equipment', []))
-            
-            telegram_api_request("editMessageText", {
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": "🔧 Выбор оборудования завершен.\n\n"
-                       f"💰 Стоимость оборудования: *{equipment_cost} руб.*\n\n"
-                       f"Теперь выберите дополнительные услуги:",
-                "parse_mode": "Markdown",
-                "reply_markup": create_services_keyboard(user_data.get('selected_services', []))
-            })
-        else:
-            component = callback_data.replace('equipment_', '')
-            
-            # Переключаем выбор компонента (добавляем или удаляем)
-            if 'selected_equipment' not in user_data:
-                user_data['selected_equipment'] = []
-                
-            if component in user_data['selected_equipment']:
-                user_data['selected_equipment'].remove(component)
-            else:
-                user_data['selected_equipment'].append(component)
-            
-            # Собираем все уникальные компоненты из всех наборов для расчета цены
-            all_components = {}
-            for equipment_set in EQUIPMENT_SETS.values():
-                for comp, price in equipment_set.items():
-                    all_components[comp] = price
-            
-            equipment_cost = sum(all_components.get(item, 0) for item in user_data['selected_equipment'])
-            
-            telegram_api_request("editMessageText", {
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": f"🔧 Выберите компоненты оборудования:\n"
-                       f"💰 Текущая стоимость оборудования: *{equipment_cost} руб.*\n\n",
-                "parse_mode": "Markdown",
-                "reply_markup": create_equipment_keyboard(user_data['selected_equipment'])
-            })
+    elif kind == callbacks.EQUIPMENT:
+        # Переключаем выбор компонента (добавляем или удаляем)
+        session.toggle_equipment(index)
+        
+        equipment_cost = calculate_equipment_cost(session)
+        
+        response = reply_with("editMessageText", {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": f"🔧 Выберите компоненты оборудования:\n"
+                   f"💰 Текущая стоимость оборудования: *{equipment_cost} руб.*\n\n",
+            "parse_mode": "Markdown",
+            "reply_markup": create_equipment_keyboard(session.equipment, session)
+        })
+    
+    # Обработка завершения выбора услуг
+    elif kind == callbacks.SERVICES_DONE:
+        session.state = UserState.FINAL_CALCULATION.value
+        
+        # Создаем итоговое сообщение
+        final_message = create_final_message(session)
+        
+        # Предлагаем клавиатуру для новых расчетов
+        keyboard = {
+            "inline_keyboard": [
+                [{"text": "🔄 Сделать новый расчет", "callback_data": button_data(callbacks.NEW_CALCULATION, session=session)}]
+            ]
+        }
+        
+        response = reply_with("editMessageText", {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": final_message,
+            "parse_mode": "Markdown",
+            "reply_markup": keyboard
+        })
     
     # Обработка выбора услуг
-    elif callback_data.startswith('service_'):
-        if callback_data == 'services_done':
-            user_data['state'] = UserState.FINAL_CALCULATION.value
-            
-            # Создаем итоговое сообщение
-            final_message = create_final_message(user_data)
-            
-            # Предлагаем клавиатуру для новых расчетов
-            keyboard = {
-                "inline_keyboard": [
-                    [{"text": "🔄 Сделать новый расчет", "callback_data": "new_calculation"}]
-                ]
-            }
-            
-            telegram_api_request("editMessageText", {
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": final_message,
-                "parse_mode": "Markdown",
-                "reply_markup": keyboard
-            })
-        else:
-            service_item = callback_data.replace('service_', '')
-            
-            # Переключаем выбор услуги (добавляем или удаляем)
-            if 'selected_services' not in user_data:
-                user_data['selected_services'] = []
-                
-            if service_item in user_data['selected_services']:
-                user_data['selected_services'].remove(service_item)
-            else:
-                user_data['selected_services'].append(service_item)
-            
-            drilling_cost = calculate_drilling_cost(user_data['district'], user_data['depth'])
-            
-            # Расчет стоимости оборудования
-            if user_data.get('equipment_set') and user_data['equipment_set'] in EQUIPMENT_SETS:
-                equipment_cost = sum(EQUIPMENT_SETS[user_data['equipment_set']].values())
-            else:
-                # Собираем все уникальные компоненты
-                all_components = {}
-                for equipment_set in EQUIPMENT_SETS.values():
-                    for component, price in equipment_set.items():
-                        all_components[component] = price
-                
-                equipment_cost = sum(all_components.get(item, 0) for item in user_data.get('selected_equipment', []))
-            
-            services_cost = sum(SERVICES.get(item, 0) for item in user_data['selected_services'])
-            
-            telegram_api_request("editMessageText", {
-                "chat_id": chat_id,
-                "message_id": message_id,
-                "text": f"📏 Глубина: *{user_data['depth']} м*\n"
-                       f"💰 Стоимость бурения: *{drilling_cost} руб.*\n"
-                       f"🔧 Стоимость оборудования: *{equipment_cost} руб.*\n"
-                       f"🛠 Стоимость услуг: *{services_cost} руб.*\n\n"
-                       f"Выберите дополнительные услуги:",
-                "parse_mode": "Markdown",
-                "reply_markup": create_services_keyboard(user_data['selected_services'])
-            })
+    elif kind == callbacks.SERVICE:
+        # Переключаем выбор услуги (добавляем или удаляем)
+        session.toggle_service(index)
+        
+        drilling_cost = calculate_drilling_cost(session.district, session.depth)
+        equipment_cost = calculate_equipment_cost(session)
+        services_cost = calculate_services_cost(session)
+        
+        response = reply_with("editMessageText", {
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "text": f"📏 Глубина: *{session.depth} м*\n"
+                   f"💰 Стоимость бурения: *{drilling_cost} руб.*\n"
+                   f"🔧 Стоимость оборудования: *{equipment_cost} руб.*\n"
+                   f"🛠 Стоимость услуг: *{services_cost} руб.*\n\n"
+                   f"Выберите дополнительные услуги:",
+            "parse_mode": "Markdown",
+            "reply_markup": create_services_keyboard(session.services, session)
+        })
     
     # Обработка запроса на новый расчет
-    elif callback_data == 'new_calculation':
+    elif kind == callbacks.NEW_CALCULATION:
         # Сбрасываем состояние пользователя
-        user_states[user_id] = {
-            'state': UserState.DISTRICT_SELECTION.value,
-            'district': None,
-            'depth': None,
-            'equipment_set': None,
-            'selected_equipment': [],
-            'selected_services': [],
-            'timestamp': time.time()
-        }
+        session = Session(UserState.DISTRICT_SELECTION.value)
+        if not stateless:
+            user_states[user_id] = session
         
-        telegram_api_request("editMessageText", {
+        response = reply_with("editMessageText", {
             "chat_id": chat_id,
             "message_id": message_id,
             "text": "👋 Начинаем новый расчет стоимости бурения скважины!\n\nВыберите район, в котором планируется бурение:",
-            "reply_markup": create_districts_keyboard()
+            "reply_markup": create_districts_keyboard(session)
         })
     
-    return {"ok": True}
+    return response
 
 class handler(BaseHTTPRequestHandler):
     def do_GET(self):
@@ -800,7 +676,13 @@ class handler(BaseHTTPRequestHandler):
                     "status": "ok",
                     "message": "Simple webhook endpoint is running",
                     "python_version": python_version,
-                    "path": self.path
+                    "path": self.path,
+                    "client": telegram_client.stats,
+                    "outbound": telegram_client.outbound.stats(),
+                    "updates": update_queue.stats(),
+                    "dedup": update_dedup.stats(),
+                    "sessions": user_states.stats(),
+                    "catalog": CATALOGS.stats()
                 }).encode('utf-8'))
         except Exception as e:
             logger.error(f"Ошибка при обработке GET запроса: {e}", exc_info=True)
@@ -821,9 +703,29 @@ class handler(BaseHTTPRequestHandler):
             
             logger.info(f"Получен POST запрос: {self.path}")
             
-            # Обрабатываем обновление от Telegram
-            result = process_update(update_json)
-            
+            # Повторную доставку уже полученного обновления подтверждаем без обработки
+            if update_dedup.seen(update_json):
+                logger.info(f"Повторная доставка обновления {update_json.get('update_id')}, пропускаем")
+                self.send_response(200)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({"ok": True}).encode('utf-8'))
+                return
+
+            try:
+                if WEBHOOK_ACK_FIRST:
+                    self.enqueue_update(update_json)
+                    return
+
+                # Обрабатываем обновление от Telegram: ожидания лимитов и повторов
+                # исходящих вызовов должны уложиться во время работы функции
+                with request_deadline():
+                    result = process_update(update_json)
+            except Exception:
+                # Ответим ошибкой, Telegram доставит обновление повторно - его нужно будет обработать
+                update_dedup.forget(update_json)
+                raise
+
             # Отправляем успешный ответ
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -838,4 +740,52 @@ class handler(BaseHTTPRequestHandler):
                 "status": "error",
                 "error": str(e),
                 "python_version": python_version
-            }).encode('utf-8')) 
\ No newline at end of file
+            }).encode('utf-8')) 
+
+    # Режим WEBHOOK_ACK_FIRST: ставим обновление в фоновую очередь и сразу отвечаем
+    def enqueue_update(self, update_json):
+        if not valid_update(update_json):
+            status, result = 400, {"ok": False, "error": "Некорректное обновление"}
+        elif event_loop.run(update_queue.offer(update_user_id(update_json), update_json)):
+            status, result = 200, {"ok": True}
+        else:
+            logger.warning(f"Очередь обработки переполнена, обновление {update_json['update_id']} отклонено")
+            # Telegram доставит обновление повторно - его нужно будет обработать
+            update_dedup.forget(update_json)
+            status, result = 503, {"ok": False, "error": "Очередь переполнена"}
+
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        if status == 503:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(json.dumps(result).encode('utf-8'))
+
+# Обработка обновления, полученного через getUpdates
+async def dispatch_update(update_data):
+    if update_dedup.seen(update_data):
+        return
+    try:
+        await update_queue.process(update_user_id(update_data), update_data)
+    except Exception:
+        # Обновление не обработано - повторное получение не должно считаться дублем
+        update_dedup.forget(update_data)
+        raise
+
+# Получение обновлений через getUpdates на своем сервере (без вебхука):
+# PYTHONPATH=. python api/simple-webhook.py
+# С UPDATES_MODE=auto основным остается вебхук, а опрос включается,
+# когда getWebhookInfo сообщает об ошибках доставки
+async def run_polling():
+    ingestion = UpdateIngestion(
+        client_call(telegram_client),
+        dispatch_update,
+        webhook_url=f"{VERCEL_URL}/api/simple-webhook",
+        mode="auto" if UPDATES_MODE == "auto" else "polling",
+    )
+    await ingestion.run()
+
+if __name__ == "__main__":
+    # При опросе отвечать в теле вебхука некуда - все вызовы отправляем сами
+    WEBHOOK_REPLY_MODE = False
+    asyncio.run(run_polling())
@@ -2,9 +2,10 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import logging
-import asyncio
 import sys
 
+from botlib import event_loop
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,9 +19,11 @@ if not BOT_TOKEN:
 try:
     from aiogram import Bot, Dispatcher, types
     from aiogram.types import ParseMode
+
+    from botlib.aiogram_bot import API_SERVER
     
-    # Инициализация бота и диспетчера
-    bot = Bot(token=BOT_TOKEN)
+    # Инициализация бота и диспетчера (адрес Bot API задается TELEGRAM_API_BASE)
+    bot = Bot(token=BOT_TOKEN, server=API_SERVER)
     dp = Dispatcher(bot)
     
     # Простой обработчик команды /start для тестирования
@@ -85,8 +88,9 @@ class handler(BaseHTTPRequestHandler):
             
             logger.info(f"Получен POST запрос: {self.path}")
             
-            # Обрабатываем обновление от Telegram
-            result = asyncio.run(process_update(update_json))
+            # Обрабатываем обновление от Telegram в общем фоновом event loop,
+            # где живет бот и его сессия
+            result = event_loop.run(process_update(update_json))
             
             # Отправляем успешный ответ для Telegram
             self.send_response(200)
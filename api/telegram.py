@@ -1,10 +1,19 @@
 from http.server import BaseHTTPRequestHandler
+import asyncio
 import json
 import os
 import logging
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-import asyncio
+
+from botlib import callbacks, event_loop
+from botlib.callbacks import CallbackCatalog, CallbackError
+from botlib.catalog import load_catalog_data
+from botlib.dedup import get_update_dedup
+from botlib.outbound import get_outbound, request_deadline
+from botlib.sessions import get_sessions
+from botlib.shards import update_user_id
+from botlib.ptb_request import PTB_BASE_FILE_URL, PTB_BASE_URL, PacedRequest
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -15,51 +24,79 @@ BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
     logger.error("TELEGRAM_BOT_TOKEN не задан")
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Инициализация бота: все вызовы идут через общий конвейер с лимитами Telegram
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL, base_file_url=PTB_BASE_FILE_URL, request=PacedRequest())
+
+# Районы, глубины и цены - из артефакта, собранного из lib/drilling-data.ts
+# (python -m botlib.catalog_compiler)
+catalog_data = load_catalog_data()
 
-# Данные о районах и глубинах
-districts = [
-    "Александровский район",
-    "Балашихинский район",
-    "Бронницы",
-    "Видное",
-    "Волоколамский район",
-]
+districts = list(catalog_data.districts)
 
-# Глубины по районам (упрощенно)
-district_depths = {
-    "Александровский район": [40, 50, 60, 70, 80, 90, 100],
-    "Балашихинский район": [15, 20, 25, 30, 35, 40],
-    "Бронницы": [45, 50, 55, 60, 65],
-    "Видное": [20, 25, 30],
-    "Волоколамский район": [30, 35, 40, 45, 50, 55, 60],
-}
+# Глубины по районам: горизонты ПИ1 и ПИ2 с шагом 5 м, как на сайте
+district_depths = catalog_data.district_depths()
+
+# Глубины, которые предлагаются району (если данных нет - стандартные значения)
+def offered_depths(district):
+    return district_depths.get(district) or [30, 40, 50, 60, 70]
 
 # Оборудование и цены
-equipment = {
-    "Скважинный насос Belamos tf 80-110": 25000,
-    "Насос Grundfos SQ 3-65": 45000,
-    "Кессон пластиковый": 35000,
-    "Гидроаккумулятор 50 л": 6000,
-}
+equipment = catalog_data.equipment_price_map([
+    "Скважинный насос Belamos tf 80-110",
+    "Насос Grundfos SQ 3-65",
+    "Кессон пластиковый",
+    "Гидроаккумулятор 50 л",
+])
 
 # Услуги и цены
-services = {
-    "Монтаж кессона": 19000,
-    "Монтаж систем автоматики": 2000,
-    "Транспортные расходы": 3000,
-    "Анализ воды": 5000,
-}
+services = catalog_data.service_price_map([
+    "Монтаж кессона",
+    "Монтаж систем автоматики",
+    "Транспортные расходы",
+    "Анализ воды",
+])
+
+# Короткие callback_data кнопок: номер позиции в списках выше
+CALLBACKS = CallbackCatalog({
+    callbacks.DISTRICT: districts,
+    callbacks.EQUIPMENT: list(equipment),
+    callbacks.SERVICE: list(services),
+})
 
-# Хранилище состояний пользователей
-user_states = {}
+# Хранилище состояний пользователей: кэш в памяти, сохраняются в SQLite (SESSION_DB)
+user_states = get_sessions("telegram")
+# Чистка давно не использованных сессий в фоновом event loop
+event_loop.submit(user_states.run_sweeper())
+
+# Фильтр повторных доставок одного и того же обновления
+update_dedup = get_update_dedup()
 
 # Функция для обработки обновлений от Telegram
 async def process_update(update_data):
-    # Создаем объект Update из данных
-    update = Update.de_json(update_data, bot)
-    
+    # Повторную доставку отсеиваем до разбора обновления и вызовов Telegram
+    if update_dedup.seen(update_data):
+        logger.info(f"Повторная доставка обновления {update_data.get('update_id')}, пропускаем")
+        return
+
+    try:
+        # При общем хранилище сессий (Redis) читаем свежую сессию пользователя;
+        # после обработки сессия кодируется одним снимком и записывается
+        user_id = update_user_id(update_data)
+        await user_states.refresh_async(user_id)
+        try:
+            # Создаем объект Update из данных; ожидания лимитов и повторов
+            # исходящих вызовов должны уложиться во время работы функции
+            with request_deadline():
+                await handle_update(Update.de_json(update_data, bot))
+        finally:
+            await user_states.commit_async(user_id)
+    except Exception:
+        # Ответим ошибкой, Telegram доставит обновление повторно - его нужно будет обработать
+        update_dedup.forget(update_data)
+        raise
+
+# Обработка обновления Telegram
+async def handle_update(update):
     # Обрабатываем команды
     if update.message and update.message.text:
         if update.message.text == '/start':
@@ -75,21 +112,27 @@ async def process_update(update_data):
     
     # Обрабатываем нажатия на кнопки
     if update.callback_query:
-        callback_data = update.callback_query.data
+        try:
+            kind, index = CALLBACKS.parse(update.callback_query.data or "")
+        except CallbackError:
+            # Кнопка старого формата (до коротких номеров) или неизвестная
+            logger.info(f"Пользователь {update.effective_user.id} нажал устаревшую кнопку {update.callback_query.data!r}")
+            await update.callback_query.answer("Кнопка устарела. Отправьте /start, чтобы начать новый расчет.")
+            return
         
-        if callback_data.startswith('district_'):
-            await process_district_selection(update)
-        elif callback_data.startswith('depth_'):
-            await process_depth_selection(update)
-        elif callback_data.startswith('equipment_') and callback_data != 'equipment_done':
-            await process_equipment_selection(update)
-        elif callback_data == 'equipment_done':
+        if kind == callbacks.DISTRICT:
+            await process_district_selection(update, index)
+        elif kind == callbacks.DEPTH:
+            await process_depth_selection(update, index)
+        elif kind == callbacks.EQUIPMENT:
+            await process_equipment_selection(update, index)
+        elif kind == callbacks.EQUIPMENT_DONE:
             await process_equipment_done(update)
-        elif callback_data.startswith('service_'):
-            await process_service_selection(update)
-        elif callback_data == 'services_done':
+        elif kind == callbacks.SERVICE:
+            await process_service_selection(update, index)
+        elif kind == callbacks.SERVICES_DONE:
             await process_services_done(update)
-        elif callback_data == 'start_over':
+        elif kind == callbacks.NEW_CALCULATION:
             await process_start_over(update)
 
 # Обработчик команды /start
@@ -112,7 +155,7 @@ async def start_command(update):
             if i + j < len(districts):
                 row.append({
                     "text": districts[i + j],
-                    "callback_data": f"district_{districts[i + j]}"
+                    "callback_data": CALLBACKS.data(callbacks.DISTRICT, i + j)
                 })
         keyboard.append(row)
     
@@ -143,7 +186,7 @@ async def reset_command(update):
             if i + j < len(districts):
                 row.append({
                     "text": districts[i + j],
-                    "callback_data": f"district_{districts[i + j]}"
+                    "callback_data": CALLBACKS.data(callbacks.DISTRICT, i + j)
                 })
         keyboard.append(row)
     
@@ -155,11 +198,11 @@ async def reset_command(update):
     )
 
 # Обработчик выбора района
-async def process_district_selection(update):
+async def process_district_selection(update, index):
     query = update.callback_query
     await query.answer()
     
-    district = query.data.replace('district_', '')
+    district = CALLBACKS.name(callbacks.DISTRICT, index)
     user_id = update.effective_user.id
     
     logger.info(f"Пользователь {user_id} выбрал район: {district}")
@@ -172,7 +215,7 @@ async def process_district_selection(update):
     user_states[user_id]["stage"] = "district_selected"
     
     # Получаем глубины для выбранного района
-    depths = district_depths.get(district, [30, 40, 50, 60, 70])
+    depths = offered_depths(district)
     
     # Создаем клавиатуру с глубинами
     keyboard = []
@@ -182,7 +225,7 @@ async def process_district_selection(update):
             if i + j < len(depths):
                 row.append({
                     "text": f"{depths[i + j]} м",
-                    "callback_data": f"depth_{depths[i + j]}"
+                    "callback_data": CALLBACKS.data(callbacks.DEPTH, depths[i + j])
                 })
         keyboard.append(row)
     
@@ -194,11 +237,10 @@ async def process_district_selection(update):
     )
 
 # Обработчик выбора глубины
-async def process_depth_selection(update):
+async def process_depth_selection(update, depth):
     query = update.callback_query
     await query.answer()
     
-    depth = int(query.data.replace('depth_', ''))
     user_id = update.effective_user.id
     
     logger.info(f"Пользователь {user_id} выбрал глубину: {depth}")
@@ -207,24 +249,29 @@ async def process_depth_selection(update):
     if user_id not in user_states or "district" not in user_states[user_id]:
         await query.edit_message_text("Произошла ошибка. Пожалуйста, начните заново с команды /start")
         return
+    # Глубина из кнопки должна быть среди предложенных району (кнопку можно подделать)
+    if depth not in offered_depths(user_states[user_id]["district"]):
+        logger.warning(f"Пользователь {user_id} выбрал глубину {depth}, которой нет у района")
+        await query.edit_message_text("Кнопка устарела. Отправьте /start, чтобы начать новый расчет.")
+        return
     
     user_states[user_id]["depth"] = depth
     user_states[user_id]["stage"] = "depth_selected"
     
     # Рассчитываем стоимость бурения (упрощенно)
-    drilling_cost = depth * 2900  # Базовая стоимость 2900 руб/м
+    drilling_cost = depth * catalog_data.base_drilling_cost
     
     # Создаем клавиатуру с оборудованием
     keyboard = []
     for item in equipment:
         keyboard.append([{
             "text": item,
-            "callback_data": f"equipment_{item}"
+            "callback_data": CALLBACKS.data_for(callbacks.EQUIPMENT, item)
         }])
     
     keyboard.append([{
         "text": "Завершить выбор оборудования",
-        "callback_data": "equipment_done"
+        "callback_data": CALLBACKS.data(callbacks.EQUIPMENT_DONE)
     }])
     
     reply_markup = {"inline_keyboard": keyboard}
@@ -235,11 +282,11 @@ async def process_depth_selection(update):
     )
 
 # Обработчик выбора оборудования
-async def process_equipment_selection(update):
+async def process_equipment_selection(update, index):
     query = update.callback_query
     await query.answer()
     
-    equipment_item = query.data.replace('equipment_', '')
+    equipment_item = CALLBACKS.name(callbacks.EQUIPMENT, index)
     user_id = update.effective_user.id
     
     logger.info(f"Пользователь {user_id} выбрал оборудование: {equipment_item}")
@@ -265,12 +312,12 @@ async def process_equipment_selection(update):
         text = f"✅ {item}" if item in user_states[user_id].get("selected_equipment", []) else item
         keyboard.append([{
             "text": text,
-            "callback_data": f"equipment_{item}"
+            "callback_data": CALLBACKS.data_for(callbacks.EQUIPMENT, item)
         }])
     
     keyboard.append([{
         "text": "Завершить выбор оборудования",
-        "callback_data": "equipment_done"
+        "callback_data": CALLBACKS.data(callbacks.EQUIPMENT_DONE)
     }])
     
     reply_markup = {"inline_keyboard": keyboard}
@@ -306,12 +353,12 @@ async def process_equipment_done(update):
     for item in services:
         keyboard.append([{
             "text": item,
-            "callback_data": f"service_{item}"
+            "callback_data": CALLBACKS.data_for(callbacks.SERVICE, item)
         }])
     
     keyboard.append([{
         "text": "Завершить выбор услуг",
-        "callback_data": "services_done"
+        "callback_data": CALLBACKS.data(callbacks.SERVICES_DONE)
     }])
     
     reply_markup = {"inline_keyboard": keyboard}
@@ -333,11 +380,11 @@ async def process_equipment_done(update):
     user_states[user_id]["stage"] = "services_selection"
 
 # Обработчик выбора услуг
-async def process_service_selection(update):
+async def process_service_selection(update, index):
     query = update.callback_query
     await query.answer()
     
-    service_item = query.data.replace('service_', '')
+    service_item = CALLBACKS.name(callbacks.SERVICE, index)
     user_id = update.effective_user.id
     
     logger.info(f"Пользователь {user_id} выбрал услугу: {service_item}")
@@ -361,12 +408,12 @@ async def process_service_selection(update):
         text = f"✅ {item}" if item in user_states[user_id].get("selected_services", []) else item
         keyboard.append([{
             "text": text,
-            "callback_data": f"service_{item}"
+            "callback_data": CALLBACKS.data_for(callbacks.SERVICE, item)
         }])
     
     keyboard.append([{
         "text": "Завершить выбор услуг",
-        "callback_data": "services_done"
+        "callback_data": CALLBACKS.data(callbacks.SERVICES_DONE)
     }])
     
     reply_markup = {"inline_keyboard": keyboard}
@@ -410,7 +457,7 @@ async def process_services_done(update):
     selected_services = user_states[user_id].get("selected_services", [])
     
     # Базовая стоимость бурения
-    drilling_cost = depth * 2900  # Базовая стоимость 2900 руб/м
+    drilling_cost = depth * catalog_data.base_drilling_cost
     
     # Стоимость оборудования
     equipment_cost = sum(equipment.get(item, 0) for item in selected_equipment)
@@ -448,7 +495,7 @@ async def process_services_done(update):
     # Клавиатура для начала заново
     keyboard = [[{
         "text": "Начать заново",
-        "callback_data": "start_over"
+        "callback_data": CALLBACKS.data(callbacks.NEW_CALCULATION)
     }]]
     
     reply_markup = {"inline_keyboard": keyboard}
@@ -485,7 +532,7 @@ async def process_start_over(update):
             if i + j < len(districts):
                 row.append({
                     "text": districts[i + j],
-                    "callback_data": f"district_{districts[i + j]}"
+                    "callback_data": CALLBACKS.data(callbacks.DISTRICT, i + j)
                 })
         keyboard.append(row)
     
@@ -546,8 +593,9 @@ class handler(BaseHTTPRequestHandler):
             update_data = json.loads(post_data.decode('utf-8'))
             logger.info(f"Получен вебхук: {json.dumps(update_data)}")
             
-            # Обрабатываем обновление
-            asyncio.run(process_update(update_data))
+            # Обрабатываем обновление в общем фоновом event loop,
+            # где живет бот и его пул соединений
+            event_loop.run(process_update(update_data))
             
             # Отправляем успешный ответ
             self.send_response(200)
@@ -566,5 +614,10 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
         self.end_headers()
-        self.wfile.write(json.dumps({"status": "Telegram webhook is running"}).encode('utf-8'))
+        self.wfile.write(json.dumps({
+            "status": "Telegram webhook is running",
+            "outbound": get_outbound().stats(),
+            "dedup": update_dedup.stats(),
+            "sessions": user_states.stats()
+        }).encode('utf-8'))
 
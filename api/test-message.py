@@ -2,13 +2,15 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 from telegram import Bot
-import asyncio
+
+from botlib import event_loop
+from botlib.ptb_request import PTB_BASE_URL
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL)
 
 # Функция для отправки тестового сообщения
 async def send_test_message(chat_id):
@@ -39,7 +41,7 @@ class handler(BaseHTTPRequestHandler):
                 return
             
             # Отправляем тестовое сообщение
-            result = asyncio.run(send_test_message(chat_id))
+            result = event_loop.run(send_test_message(chat_id))
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -2,9 +2,11 @@ from http.server import BaseHTTPRequestHandler
 import json
 import os
 import logging
-import asyncio
 from telegram import Bot
 
+from botlib import event_loop
+from botlib.ptb_request import PTB_BASE_URL
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,7 +23,7 @@ if not VERCEL_URL.startswith(("http://", "https://")):
     VERCEL_URL = f"https://{VERCEL_URL}"
 
 # Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+bot = Bot(token=BOT_TOKEN, base_url=PTB_BASE_URL)
 
 # Функция для установки вебхука
 async def set_webhook():
@@ -57,7 +59,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             # Настраиваем вебхук и возвращаем информацию
-            result = asyncio.run(set_webhook())
+            result = event_loop.run(set_webhook())
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -1,24 +1,24 @@
 from http.server import BaseHTTPRequestHandler
 import json
 import os
-from telegram import Bot
-import asyncio
+
+from botlib.telegram_client import get_client
 
 # Получение токена из переменных окружения
 BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+# Клиент Bot API с пулом соединений (общий для всего процесса)
+client = get_client(BOT_TOKEN)
 
 # Функция для получения информации о вебхуке
-async def get_webhook_info():
+def get_webhook_info():
     try:
-        webhook_info = await bot.get_webhook_info()
-        me = await bot.get_me()
+        webhook_info = client.call("getWebhookInfo")
+        me = client.call("getMe")
         return {
             "status": "ok",
-            "bot_info": me.to_dict(),
-            "webhook_info": webhook_info.to_dict()
+            "bot_info": me,
+            "webhook_info": webhook_info
         }
     except Exception as e:
         return {
@@ -30,7 +30,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         try:
             # Получаем информацию о вебхуке
-            result = asyncio.run(get_webhook_info())
+            result = get_webhook_info()
             
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -1,14 +1,31 @@
 import os
+import sys
 import json
+import asyncio
 import logging
+
+# Общие модули botlib лежат в корне репозитория (в Docker-образе - рядом с main.py)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from aiogram import Bot, Dispatcher, types
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.utils.executor import start_webhook
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.dispatcher.webhook import BaseResponse, EditMessageText, SendMessage
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import JSONResponse
 import uvicorn
 
+from botlib import callbacks
+from botlib.aiogram_bot import PacedBot
+from botlib.callbacks import CallbackCatalog, CallbackError
+from botlib.catalog_map import get_catalog_map
+from botlib.dedup import get_update_dedup
+from botlib.polling import UpdateIngestion
+from botlib.sessions import get_sessions
+from botlib.shards import ShardedQueue, update_user_id, valid_update
+from botlib.spool import SpoolConsumer, UpdateSpool
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,24 +40,136 @@ WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "https://example.com")  # Будет з
 WEBHOOK_PATH = "/api/telegram-webhook"
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+# Режим ответа через тело вебхука: основной вызов Bot API возвращается
+# Telegram прямо в HTTP-ответе, отдельными запросами уходят только остальные
+WEBHOOK_REPLY_MODE = os.getenv("WEBHOOK_REPLY_MODE", "").lower() in ("1", "true", "yes")
+
+# Режим "сначала подтверждение": вебхук ставит обновление в очередь и сразу
+# отвечает 200, обработка и вызовы Bot API идут в фоне. При переполнении
+# очереди отвечаем 503, и Telegram доставит обновление позже
+WEBHOOK_ACK_FIRST = os.getenv("WEBHOOK_ACK_FIRST", "").lower() in ("1", "true", "yes")
+
+# Очередь обновлений на диске (файл SQLite): приемник только надежно записывает
+# обновление и отвечает Telegram, обработчики забирают его из файла, поэтому
+# перезапуск контейнера не теряет обновления. Роль процесса: receiver, worker или both
+UPDATES_SPOOL = os.getenv("UPDATES_SPOOL", "")
+SPOOL_ROLE = os.getenv("SPOOL_ROLE", "both").lower()
+
+# Инициализация бота и диспетчера (вызовы Bot API идут через общий конвейер с лимитами Telegram)
+bot = PacedBot(token=BOT_TOKEN)
 dp = Dispatcher(bot)
 dp.middleware.setup(LoggingMiddleware())
 
 # Инициализация FastAPI
 app = FastAPI()
 
-# Данные о районах и глубинах
-districts = [
-    "Александровский район",
-    "Балашихинский район",
-    "Бронницы",
-    # ... остальные районы
-]
+# Районы, глубины и цены - из двоичного артефакта, собранного из lib/drilling-data.ts
+# (python -m botlib.catalog_compiler). Файл отображается в память только на чтение,
+# поэтому воркеры uvicorn делят одну копию каталога; новая версия файла
+# подхватывается без перезапуска. districts и цены ниже - представления текущей версии
+catalog_map = get_catalog_map()
+
+districts = catalog_map.districts
+
+# Оборудование и услуги калькулятора - позиции текущей версии каталога,
+# как и районы: новые позиции появляются без перезапуска
+equipment_list = catalog_map.equipment
+services_list = catalog_map.services
+
+equipment_prices = catalog_map.equipment_prices
+service_prices = catalog_map.service_prices
+
+# Короткие callback_data кнопок: номер позиции в списках выше
+CALLBACKS = CallbackCatalog({
+    callbacks.DISTRICT: districts,
+    callbacks.EQUIPMENT: equipment_list,
+    callbacks.SERVICE: services_list,
+})
+
+
+# Фильтр aiogram по виду кнопки: номер позиции попадает в аргумент index обработчика
+def callback_filter(kind):
+    def _filter(callback_query):
+        try:
+            parsed_kind, index = CALLBACKS.parse(callback_query.data or "")
+        except CallbackError:
+            return False
+        if parsed_kind != kind:
+            return False
+        return {"index": index}
+    return _filter
+
+# Состояния пользователей: кэш в памяти, сохраняются в SQLite (SESSION_DB)
+user_states = get_sessions("bot")
 
-# Словарь для хранения состояния пользователей
-user_states = {}
+# Отправка нового сообщения: в режиме WEBHOOK_REPLY_MODE возвращаем вызов
+# для тела ответа на вебхук, иначе отправляем сразу
+async def reply_send(chat_id, text, reply_markup=None, parse_mode=None):
+    if WEBHOOK_REPLY_MODE:
+        return SendMessage(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+    await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+# Редактирование сообщения с кнопками (аналогично reply_send)
+async def reply_edit(callback_query, text, reply_markup=None, parse_mode=None):
+    if WEBHOOK_REPLY_MODE:
+        return EditMessageText(
+            text=text,
+            chat_id=callback_query.message.chat.id,
+            message_id=callback_query.message.message_id,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode
+        )
+    await bot.edit_message_text(
+        chat_id=callback_query.message.chat.id,
+        message_id=callback_query.message.message_id,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=parse_mode
+    )
+
+# Обработка одного обновления (сырой JSON Telegram) через aiogram, вызывается из очереди пользователя.
+# Возвращает (метод, параметры) вызова, который обработчик отдал для тела ответа
+# (режим WEBHOOK_REPLY_MODE), или None. Если ответить в теле некуда (send_reply),
+# такой вызов отправляем обычным запросом
+async def process_update(item):
+    data, send_reply = item
+    # Обработчики берут бота и диспетчер из контекста
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    # При общем хранилище сессий (Redis) читаем свежую сессию пользователя;
+    # после обработки сессия кодируется одним снимком и записывается
+    user_id = update_user_id(data)
+    await user_states.refresh_async(user_id)
+    try:
+        results = await dp.process_update(types.Update(**data))
+    finally:
+        await user_states.commit_async(user_id)
+
+    response = get_webhook_response(results)
+    if response is None:
+        return None
+    payload = response.get_response()
+    reply = payload.pop("method"), payload
+    if send_reply:
+        await bot.request(*reply)
+        return None
+    return reply
+
+# Фильтр повторных доставок одного и того же обновления (по update_id и callback_query.id)
+update_dedup = get_update_dedup()
+
+# Очереди обработки обновлений: разные пользователи обрабатываются параллельно,
+# обновления одного пользователя - строго по порядку (user_states без блокировок)
+update_queue = ShardedQueue(process_update)
+
+# Поиск вызова для тела ответа среди результатов обработчиков
+def get_webhook_response(results):
+    for result in results or []:
+        if isinstance(result, list):
+            result = get_webhook_response(result)
+        if isinstance(result, BaseResponse):
+            return result
+    return None
 
 # Обработчик команды /start
 @dp.message_handler(commands=['start'])
@@ -57,9 +186,9 @@ async def cmd_start(message: types.Message):
     # Создаем клавиатуру с районами
     keyboard = InlineKeyboardMarkup(row_width=2)
     for district in districts:
-        keyboard.add(InlineKeyboardButton(district, callback_data=f"district_{district}"))
+        keyboard.add(InlineKeyboardButton(district, callback_data=CALLBACKS.data_for(callbacks.DISTRICT, district)))
     
-    await message.answer("Добро пожаловать в калькулятор стоимости бурения! Выберите район:", reply_markup=keyboard)
+    return await reply_send(message.chat.id, "Добро пожаловать в калькулятор стоимости бурения! Выберите район:", reply_markup=keyboard)
 
 # Обработчик команды /reset
 @dp.message_handler(commands=['reset'])
@@ -76,14 +205,27 @@ async def cmd_reset(message: types.Message):
     # Создаем клавиатуру с районами
     keyboard = InlineKeyboardMarkup(row_width=2)
     for district in districts:
-        keyboard.add(InlineKeyboardButton(district, callback_data=f"district_{district}"))
+        keyboard.add(InlineKeyboardButton(district, callback_data=CALLBACKS.data_for(callbacks.DISTRICT, district)))
     
-    await message.answer("Начинаем заново. Выберите район:", reply_markup=keyboard)
+    return await reply_send(message.chat.id, "Начинаем заново. Выберите район:", reply_markup=keyboard)
+
+# Сколько глубин предлагать району: горизонты с шагом 5 м дают до сотни
+# значений, а клавиатура из десятков рядов неудобна и раздувает editMessageText
+MAX_OFFERED_DEPTHS = int(os.getenv("MAX_OFFERED_DEPTHS", "12"))
+
+# Глубины, которые предлагаются району (если данных нет - стандартные значения).
+# Длинный список прореживаем равномерно, сохраняя самую малую и самую большую
+def offered_depths(district):
+    depths = sorted(set(catalog_map.current.district_depths(district))) or [30, 40, 50, 60, 70, 80]
+    if len(depths) <= MAX_OFFERED_DEPTHS:
+        return depths
+    last = len(depths) - 1
+    return sorted({depths[round(i * last / (MAX_OFFERED_DEPTHS - 1))] for i in range(MAX_OFFERED_DEPTHS)})
 
 # Обработчик выбора района
-@dp.callback_query_handler(lambda c: c.data.startswith('district_'))
-async def process_district_selection(callback_query: types.CallbackQuery):
-    district = callback_query.data.replace('district_', '')
+@dp.callback_query_handler(callback_filter(callbacks.DISTRICT))
+async def process_district_selection(callback_query: types.CallbackQuery, index: int):
+    district = CALLBACKS.name(callbacks.DISTRICT, index)
     user_id = callback_query.from_user.id
     
     logger.info(f"Пользователь {user_id} выбрал район: {district}")
@@ -95,29 +237,24 @@ async def process_district_selection(callback_query: types.CallbackQuery):
     user_states[user_id]["district"] = district
     user_states[user_id]["stage"] = "district_selected"
     
-    # Здесь должна быть логика получения глубин для выбранного района
-    # Для примера используем фиксированные значения
-    depths = [30, 40, 50, 60, 70, 80]
+    # Глубины района (если данных нет - стандартные значения)
+    depths = offered_depths(district)
     
-    # Создаем клавиатуру с глубинами
+    # Создаем клавиатуру с глубинами: add с несколькими кнопками раскладывает
+    # их по рядам из row_width штук
     keyboard = InlineKeyboardMarkup(row_width=3)
-    for depth in depths:
-        keyboard.add(InlineKeyboardButton(f"{depth} м", callback_data=f"depth_{depth}"))
-    
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=f"Вы выбрали район: {district}. Теперь выберите глубину бурения:",
-        reply_markup=keyboard
-    )
+    keyboard.add(*[InlineKeyboardButton(f"{depth} м", callback_data=CALLBACKS.data(callbacks.DEPTH, depth))
+                   for depth in depths])
     
     # Отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
+    
+    return await reply_edit(callback_query, f"Вы выбрали район: {district}. Теперь выберите глубину бурения:", reply_markup=keyboard)
 
 # Обработчик выбора глубины
-@dp.callback_query_handler(lambda c: c.data.startswith('depth_'))
-async def process_depth_selection(callback_query: types.CallbackQuery):
-    depth = int(callback_query.data.replace('depth_', ''))
+@dp.callback_query_handler(callback_filter(callbacks.DEPTH))
+async def process_depth_selection(callback_query: types.CallbackQuery, index: int):
+    depth = index
     user_id = callback_query.from_user.id
     
     logger.info(f"Пользователь {user_id} выбрал глубину: {depth}")
@@ -126,42 +263,34 @@ async def process_depth_selection(callback_query: types.CallbackQuery):
     if user_id not in user_states or "district" not in user_states[user_id]:
         await callback_query.answer("Произошла ошибка. Пожалуйста, начните заново с команды /start")
         return
+    # Глубина из кнопки должна быть среди предложенных району (кнопку можно подделать)
+    if depth not in offered_depths(user_states[user_id]["district"]):
+        logger.warning(f"Пользователь {user_id} выбрал глубину {depth}, которой нет у района")
+        await callback_query.answer("Кнопка устарела. Отправьте /start, чтобы начать новый расчет.")
+        return
     
     user_states[user_id]["depth"] = depth
     user_states[user_id]["stage"] = "depth_selected"
     
     # Рассчитываем стоимость бурения (упрощенно)
-    drilling_cost = depth * 2900  # Базовая стоимость 2900 руб/м
-    
-    # Здесь должна быть логика получения списка оборудования
-    # Для примера используем фиксированные значения
-    equipment_list = [
-        "Скважинный насос Belamos tf 80-110",
-        "Насос Grundfos SQ 3-65",
-        "Кессон пластиковый",
-        "Гидроаккумулятор 50 л"
-    ]
+    drilling_cost = depth * catalog_map.current.base_drilling_cost
     
     # Создаем клавиатуру с оборудованием
     keyboard = InlineKeyboardMarkup(row_width=1)
     for item in equipment_list:
-        keyboard.add(InlineKeyboardButton(item, callback_data=f"equipment_{item}"))
+        keyboard.add(InlineKeyboardButton(item, callback_data=CALLBACKS.data_for(callbacks.EQUIPMENT, item)))
     
-    keyboard.add(InlineKeyboardButton("Завершить выбор оборудования", callback_data="equipment_done"))
-    
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=f"Вы выбрали глубину: {depth} м\n\nСтоимость бурения: {drilling_cost} руб.\n\nВыберите необходимое оборудование:",
-        reply_markup=keyboard
-    )
+    keyboard.add(InlineKeyboardButton("Завершить выбор оборудования", callback_data=CALLBACKS.data(callbacks.EQUIPMENT_DONE)))
     
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
+    
+    return await reply_edit(callback_query, f"Вы выбрали глубину: {depth} м\n\nСтоимость бурения: {drilling_cost} руб.\n\nВыберите необходимое оборудование:", reply_markup=keyboard)
 
 # Обработчик выбора оборудования
-@dp.callback_query_handler(lambda c: c.data.startswith('equipment_') and not c.data == 'equipment_done')
-async def process_equipment_selection(callback_query: types.CallbackQuery):
-    equipment = callback_query.data.replace('equipment_', '')
+@dp.callback_query_handler(callback_filter(callbacks.EQUIPMENT))
+async def process_equipment_selection(callback_query: types.CallbackQuery, index: int):
+    equipment = CALLBACKS.name(callbacks.EQUIPMENT, index)
     user_id = callback_query.from_user.id
     
     logger.info(f"Пользователь {user_id} выбрал оборудование: {equipment}")
@@ -181,21 +310,13 @@ async def process_equipment_selection(callback_query: types.CallbackQuery):
     
     user_states[user_id]["stage"] = "equipment_selection"
     
-    # Получаем список всего оборудования
-    equipment_list = [
-        "Скважинный насос Belamos tf 80-110",
-        "Насос Grundfos SQ 3-65",
-        "Кессон пластиковый",
-        "Гидроаккумулятор 50 л"
-    ]
-    
     # Создаем клавиатуру с отметками выбранного оборудования
     keyboard = InlineKeyboardMarkup(row_width=1)
     for item in equipment_list:
         text = f"✅ {item}" if item in user_states[user_id].get("selected_equipment", []) else item
-        keyboard.add(InlineKeyboardButton(text, callback_data=f"equipment_{item}"))
+        keyboard.add(InlineKeyboardButton(text, callback_data=CALLBACKS.data_for(callbacks.EQUIPMENT, item)))
     
-    keyboard.add(InlineKeyboardButton("Завершить выбор оборудования", callback_data="equipment_done"))
+    keyboard.add(InlineKeyboardButton("Завершить выбор оборудования", callback_data=CALLBACKS.data(callbacks.EQUIPMENT_DONE)))
     
     # Формируем текст сообщения
     message_text = "Выбранное оборудование:\n"
@@ -204,17 +325,13 @@ async def process_equipment_selection(callback_query: types.CallbackQuery):
     else:
         message_text += "Ничего не выбрано"
     
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=message_text,
-        reply_markup=keyboard
-    )
-    
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
+    
+    return await reply_edit(callback_query, message_text, reply_markup=keyboard)
 
 # Обработчик завершения выбора оборудования
-@dp.callback_query_handler(lambda c: c.data == 'equipment_done')
+@dp.callback_query_handler(callback_filter(callbacks.EQUIPMENT_DONE))
 async def process_equipment_done(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
@@ -225,21 +342,12 @@ async def process_equipment_done(callback_query: types.CallbackQuery):
         await callback_query.answer("Произошла ошибка. Пожалуйста, начните заново с команды /start")
         return
     
-    # Здесь должна быть логика получения списка услуг
-    # Для примера используем фиксированные значения
-    services_list = [
-        "Монтаж кессона",
-        "Монтаж систем автоматики",
-        "Транспортные расходы",
-        "Анализ воды"
-    ]
-    
     # Создаем клавиатуру с услугами
     keyboard = InlineKeyboardMarkup(row_width=1)
     for item in services_list:
-        keyboard.add(InlineKeyboardButton(item, callback_data=f"service_{item}"))
+        keyboard.add(InlineKeyboardButton(item, callback_data=CALLBACKS.data_for(callbacks.SERVICE, item)))
     
-    keyboard.add(InlineKeyboardButton("Завершить выбор услуг", callback_data="services_done"))
+    keyboard.add(InlineKeyboardButton("Завершить выбор услуг", callback_data=CALLBACKS.data(callbacks.SERVICES_DONE)))
     
     # Формируем текст сообщения
     message_text = "Выбранное оборудование:\n"
@@ -250,20 +358,17 @@ async def process_equipment_done(callback_query: types.CallbackQuery):
     
     message_text += "\n\nВыберите дополнительные услуги:"
     
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=message_text,
-        reply_markup=keyboard
-    )
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
+    await callback_query.answer()
     
     user_states[user_id]["stage"] = "services_selection"
-    await callback_query.answer()
+    
+    return await reply_edit(callback_query, message_text, reply_markup=keyboard)
 
 # Обработчик выбора услуг
-@dp.callback_query_handler(lambda c: c.data.startswith('service_'))
-async def process_service_selection(callback_query: types.CallbackQuery):
-    service = callback_query.data.replace('service_', '')
+@dp.callback_query_handler(callback_filter(callbacks.SERVICE))
+async def process_service_selection(callback_query: types.CallbackQuery, index: int):
+    service = CALLBACKS.name(callbacks.SERVICE, index)
     user_id = callback_query.from_user.id
     
     logger.info(f"Пользователь {user_id} выбрал услугу: {service}")
@@ -281,21 +386,13 @@ async def process_service_selection(callback_query: types.CallbackQuery):
             user_states[user_id]["selected_services"] = []
         user_states[user_id]["selected_services"].append(service)
     
-    # Получаем список всех услуг
-    services_list = [
-        "Монтаж кессона",
-        "Монтаж систем автоматики",
-        "Транспортные расходы",
-        "Анализ воды"
-    ]
-    
     # Создаем клавиатуру с отметками выбранных услуг
     keyboard = InlineKeyboardMarkup(row_width=1)
     for item in services_list:
         text = f"✅ {item}" if item in user_states[user_id].get("selected_services", []) else item
-        keyboard.add(InlineKeyboardButton(text, callback_data=f"service_{item}"))
+        keyboard.add(InlineKeyboardButton(text, callback_data=CALLBACKS.data_for(callbacks.SERVICE, item)))
     
-    keyboard.add(InlineKeyboardButton("Завершить выбор услуг", callback_data="services_done"))
+    keyboard.add(InlineKeyboardButton("Завершить выбор услуг", callback_data=CALLBACKS.data(callbacks.SERVICES_DONE)))
     
     # Формируем текст сообщения
     message_text = "Выбранное оборудование:\n"
@@ -310,17 +407,13 @@ async def process_service_selection(callback_query: types.CallbackQuery):
     else:
         message_text += "Ничего не выбрано"
     
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=message_text,
-        reply_markup=keyboard
-    )
-    
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
+    
+    return await reply_edit(callback_query, message_text, reply_markup=keyboard)
 
 # Обработчик завершения выбора услуг
-@dp.callback_query_handler(lambda c: c.data == 'services_done')
+@dp.callback_query_handler(callback_filter(callbacks.SERVICES_DONE))
 async def process_services_done(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
@@ -338,26 +431,12 @@ async def process_services_done(callback_query: types.CallbackQuery):
     selected_services = user_states[user_id].get("selected_services", [])
     
     # Базовая стоимость бурения
-    drilling_cost = depth * 2900  # Базовая стоимость 2900 руб/м
-    
-    # Стоимость оборудования (упрощенно)
-    equipment_prices = {
-        "Скважинный насос Belamos tf 80-110": 25000,
-        "Насос Grundfos SQ 3-65": 45000,
-        "Кессон пластиковый": 35000,
-        "Гидроаккумулятор 50 л": 6000
-    }
+    drilling_cost = depth * catalog_map.current.base_drilling_cost
     
+    # Стоимость оборудования
     equipment_cost = sum(equipment_prices.get(item, 0) for item in selected_equipment)
     
-    # Стоимость услуг (упрощенно)
-    service_prices = {
-        "Монтаж кессона": 19000,
-        "Монтаж систем автоматики": 2000,
-        "Транспортные расходы": 3000,
-        "Анализ воды": 5000
-    }
-    
+    # Стоимость услуг
     services_cost = sum(service_prices.get(item, 0) for item in selected_services)
     
     # Общая стоимость
@@ -389,21 +468,17 @@ async def process_services_done(callback_query: types.CallbackQuery):
     
     # Клавиатура для начала заново
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("Начать заново", callback_data="start_over"))
+    keyboard.add(InlineKeyboardButton("Начать заново", callback_data=CALLBACKS.data(callbacks.NEW_CALCULATION)))
     
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text=message,
-        reply_markup=keyboard,
-        parse_mode="Markdown"
-    )
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
+    await callback_query.answer()
     
     user_states[user_id]["stage"] = "final"
-    await callback_query.answer()
+    
+    return await reply_edit(callback_query, message, reply_markup=keyboard, parse_mode="Markdown")
 
 # Обработчик кнопки "Начать заново"
-@dp.callback_query_handler(lambda c: c.data == 'start_over')
+@dp.callback_query_handler(callback_filter(callbacks.NEW_CALCULATION))
 async def process_start_over(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     
@@ -419,22 +494,61 @@ async def process_start_over(callback_query: types.CallbackQuery):
     # Создаем клавиатуру с районами
     keyboard = InlineKeyboardMarkup(row_width=2)
     for district in districts:
-        keyboard.add(InlineKeyboardButton(district, callback_data=f"district_{district}"))
-    
-    await bot.edit_message_text(
-        chat_id=callback_query.message.chat.id,
-        message_id=callback_query.message.message_id,
-        text="Начинаем заново. Выберите район:",
-        reply_markup=keyboard
-    )
+        keyboard.add(InlineKeyboardButton(district, callback_data=CALLBACKS.data_for(callbacks.DISTRICT, district)))
     
+    # Отвечаем на callback_query, чтобы убрать часы загрузки
     await callback_query.answer()
+    
+    return await reply_edit(callback_query, "Начинаем заново. Выберите район:", reply_markup=keyboard)
+
+# Кнопки старого формата (до коротких номеров) и неизвестные кнопки
+@dp.callback_query_handler()
+async def process_stale_callback(callback_query: types.CallbackQuery):
+    logger.info(f"Пользователь {callback_query.from_user.id} нажал устаревшую кнопку {callback_query.data!r}")
+    await callback_query.answer("Кнопка устарела. Отправьте /start, чтобы начать новый расчет.")
 
 # Обработчик для всех остальных сообщений
 @dp.message_handler()
 async def echo(message: types.Message):
     logger.info(f"Получено сообщение от пользователя {message.from_user.id}: {message.text}")
-    await message.answer("Пожалуйста, используйте команду /start для начала работы с ботом или /reset для сброса.")
+    return await reply_send(message.chat.id, "Пожалуйста, используйте команду /start для начала работы с ботом или /reset для сброса.")
+
+# Обработка обновления, полученного через getUpdates
+async def dispatch_update(data):
+    if update_dedup.seen(data):
+        return
+    try:
+        # С очередью на диске offset подтверждается после надежной записи
+        if update_spool is not None:
+            await update_spool.append_async(data)
+            return
+        await update_queue.process(update_user_id(data), (data, True))
+    except Exception:
+        # Обновление не обработано - повторное получение не должно считаться дублем
+        update_dedup.forget(data)
+        raise
+
+# Обработка обновления, взятого из очереди на диске
+async def process_spooled_update(data):
+    await update_queue.process(update_user_id(data), (data, True))
+
+update_spool = UpdateSpool(UPDATES_SPOOL) if UPDATES_SPOOL else None
+spool_consumer = SpoolConsumer(update_spool, process_spooled_update) if update_spool else None
+
+# Получение обновлений через getUpdates (UPDATES_MODE=polling)
+# или вебхук с переключением на getUpdates при ошибках доставки (UPDATES_MODE=auto)
+ingestion = UpdateIngestion(bot.request, dispatch_update, webhook_url=WEBHOOK_URL)
+
+@app.on_event("startup")
+async def start_ingestion():
+    if ingestion.mode != "webhook":
+        asyncio.create_task(ingestion.run())
+    if spool_consumer is not None and SPOOL_ROLE != "receiver":
+        asyncio.create_task(spool_consumer.run())
+    # Чистка сессий пользователей, давно не нажимавших кнопки
+    asyncio.create_task(user_states.run_sweeper())
+    # Переотображение каталога при выходе новой версии файла
+    asyncio.create_task(catalog_map.run_reloader())
 
 # FastAPI эндпоинт для вебхука
 @app.post(WEBHOOK_PATH)
@@ -443,10 +557,46 @@ async def bot_webhook(request: Request):
         data = await request.json()
         logger.info(f"Получен вебхук: {json.dumps(data)}")
         
-        # Обработка обновления через aiogram
-        update = types.Update(**data)
-        await dp.process_update(update)
-        
+        if not valid_update(data):
+            return JSONResponse(content={"ok": False, "error": "Некорректное обновление"}, status_code=400)
+
+        # Повторную доставку уже полученного обновления подтверждаем без обработки
+        if update_dedup.seen(data):
+            logger.info(f"Повторная доставка обновления {data['update_id']}, пропускаем")
+            return JSONResponse(content={"ok": True})
+
+        try:
+            # Записываем обновление в очередь на диске и подтверждаем получение
+            if update_spool is not None:
+                await update_spool.append_async(data)
+                return JSONResponse(content={"ok": True})
+            # Ставим обновление в очередь пользователя и сразу подтверждаем получение
+            if WEBHOOK_ACK_FIRST:
+                if update_queue.submit_nowait(update_user_id(data), (data, True)) is None:
+                    logger.warning(f"Очередь обработки переполнена, обновление {data['update_id']} отклонено")
+                    # Telegram доставит обновление повторно - его нужно будет обработать
+                    update_dedup.forget(data)
+                    return JSONResponse(content={"ok": False, "error": "Очередь переполнена"}, status_code=503,
+                                        headers={"Retry-After": "1"})
+                return JSONResponse(content={"ok": True})
+
+            # Обработка обновления через aiogram в очереди пользователя
+            reply = await update_queue.process(update_user_id(data), (data, False))
+
+            # В режиме WEBHOOK_REPLY_MODE основной вызов Bot API отдаем в теле ответа
+            if reply is not None:
+                # Редактирование, которое ничего не меняет, не отправляем вовсе,
+                # а если изменилась только клавиатура - отправляем editMessageReplyMarkup
+                plan = bot.outbound.prepare_inline(*reply)
+                if plan is not None:
+                    method, payload = plan
+                    return JSONResponse(content={"method": method, **payload})
+
+        except Exception:
+            # Ответим ошибкой, Telegram доставит обновление повторно - его нужно будет обработать
+            update_dedup.forget(data)
+            raise
+
         return JSONResponse(content={"ok": True})
     except Exception as e:
         logger.error(f"Ошибка при обработке вебхука: {e}")
@@ -462,6 +612,14 @@ async def status():
         logger.error(f"Ошибка при проверке статуса: {e}")
         return JSONResponse(content={"status": "error", "error": str(e)}, status_code=500)
 
+# FastAPI эндпоинт с метриками исходящей очереди
+@app.get("/api/metrics")
+async def metrics():
+    return {"outbound": bot.outbound.stats(), "updates": update_queue.stats(),
+            "dedup": update_dedup.stats(), "ingestion": ingestion.stats(), "sessions": user_states.stats(),
+            "catalog": catalog_map.stats(),
+            "spool": {**update_spool.stats(), **spool_consumer.stats()} if update_spool else None}
+
 # FastAPI эндпоинт для установки вебхука
 @app.post("/api/set-webhook")
 async def set_webhook(request: Request):
@@ -0,0 +1 @@
+# Общие модули для Python-реализаций бота (api/*.py и bot/main.py)
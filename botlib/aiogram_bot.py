@@ -0,0 +1,39 @@
+from aiogram import Bot
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.utils import exceptions
+
+from botlib.outbound import get_outbound
+from botlib.telegram_client import API_BASE
+
+# Адрес Bot API в формате aiogram (Bot(server=...))
+API_SERVER = TelegramAPIServer.from_base(API_BASE)
+
+
+# Бот aiogram, пропускающий все вызовы Bot API через общий
+# конвейер исходящих запросов (лимиты Telegram, повторы и т.д.)
+class PacedBot(Bot):
+    def __init__(self, *args, outbound=None, **kwargs):
+        kwargs.setdefault("server", API_SERVER)
+        super().__init__(*args, **kwargs)
+        self.outbound = outbound or get_outbound()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        # aiogram сообщает об ошибках исключениями - переводим их в ответ
+        # Telegram, чтобы конвейер мог решить, повторять ли вызов.
+        # Метод и данные берем из аргументов: конвейер мог их заменить
+        async def transport(_method, _data):
+            try:
+                return {"ok": True, "result": await Bot.request(self, _method, _data, files, **kwargs)}
+            except exceptions.RetryAfter as e:
+                return {"ok": False, "error_code": 429, "parameters": {"retry_after": e.timeout}, "exception": e}
+            except exceptions.NetworkError:
+                raise
+            except exceptions.TelegramAPIError as e:
+                # Без уточненного типа aiogram выбрасывает TelegramAPIError для ответов 5xx
+                server_error = type(e) in (exceptions.TelegramAPIError, exceptions.RestartingTelegram)
+                return {"ok": False, "error_code": 500 if server_error else 400, "exception": e}
+
+        response = await self.outbound.send_async(method, data or {}, transport)
+        if not response.get("ok"):
+            raise response["exception"]
+        return response.get("result")
@@ -0,0 +1,77 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Короткие callback_data кнопок калькулятора: "вид:номер" (d:12, e:7) или
+# просто "вид" для кнопок без аргумента. Номер - позиция в списке каталога,
+# поэтому новые позиции добавляются в конец списка: номера на уже отправленных
+# кнопках не меняются. Для глубины номер - сама глубина в метрах
+DISTRICT = "d"
+DEPTH = "h"
+EQUIPMENT_SET = "s"
+EQUIPMENT = "e"
+SERVICE = "v"
+EQUIPMENT_CUSTOM = "ec"
+EQUIPMENT_DONE = "ed"
+SERVICES_DONE = "vd"
+NEW_CALCULATION = "n"
+
+# Виды кнопок без аргумента
+ACTIONS = frozenset({EQUIPMENT_CUSTOM, EQUIPMENT_DONE, SERVICES_DONE, NEW_CALCULATION})
+
+# Виды кнопок с числом вместо номера в каталоге и наибольшее допустимое число
+# (глубина хранится в сессии двумя байтами). Есть ли такая глубина у района,
+# проверяет обработчик: район известен только из сессии
+NUMERIC = {DEPTH: 0xFFFF}
+
+
+# Ошибка разбора callback_data (кнопка старого формата или подделка)
+class CallbackError(ValueError):
+    pass
+
+
+# Таблицы каталога обработчика: вид кнопки -> список названий.
+# Кодирование по названию - словарь, разбор - индекс в списке, оба за O(1).
+# Другие последовательности (например, MappedNames из botlib.catalog_map) не
+# копируются: названия берутся из них при каждом обращении, номер - через index()
+class CallbackCatalog:
+    def __init__(self, tables):
+        self.tables = {kind: tuple(names) if isinstance(names, (list, tuple)) else names
+                       for kind, names in tables.items()}
+        self._ids = {kind: {name: i for i, name in enumerate(names)}
+                     for kind, names in self.tables.items() if isinstance(names, tuple)}
+
+    # callback_data по номеру позиции (или глубине)
+    def data(self, kind, index=None):
+        return kind if index is None else f"{kind}:{index}"
+
+    # callback_data по названию позиции каталога
+    def data_for(self, kind, name):
+        return f"{kind}:{self.id(kind, name)}"
+
+    # Номер позиции по названию
+    def id(self, kind, name):
+        ids = self._ids.get(kind)
+        return ids[name] if ids is not None else self.tables[kind].index(name)
+
+    def name(self, kind, index):
+        return self.tables[kind][index]
+
+    # callback_data -> (вид, номер или None)
+    def parse(self, data):
+        kind, separator, arg = data.partition(":")
+        if not separator:
+            if kind in ACTIONS:
+                return kind, None
+            raise CallbackError(f"Неизвестная кнопка: {data!r}")
+        if not arg.isdigit():
+            raise CallbackError(f"Неверный номер в кнопке: {data!r}")
+        index = int(arg)
+        if kind in NUMERIC:
+            if index > NUMERIC[kind]:
+                raise CallbackError(f"Слишком большое число в кнопке: {data!r}")
+            return kind, index
+        names = self.tables.get(kind)
+        if names is None or index >= len(names):
+            raise CallbackError(f"Неизвестная кнопка: {data!r}")
+        return kind, index
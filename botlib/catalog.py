@@ -0,0 +1,378 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from types import MappingProxyType
+
+from botlib import callbacks
+from botlib.callbacks import CallbackCatalog
+from botlib.sessions import SESSION_LIMITS, mask_bits
+
+logger = logging.getLogger(__name__)
+
+# Файл каталога (JSON, см. Catalog.to_dict); пусто - каталог из кода обработчика
+CATALOG_FILE = os.environ.get("CATALOG_FILE", "")
+
+# Как часто проверяется, не изменился ли файл каталога (секунды)
+CATALOG_RELOAD_INTERVAL = float(os.environ.get("CATALOG_RELOAD_INTERVAL", 30))
+
+
+# Ошибка загрузки каталога (битый файл или несовместимая версия)
+class CatalogError(ValueError):
+    pass
+
+
+# Наборы оборудования калькулятора и их компоненты (в drilling-data.ts наборов нет;
+# ими пользуются simple-webhook и матрица цен botlib.price_matrix)
+EQUIPMENT_SETS = {
+    "Адаптер №1": {
+        "насос": 25000,
+        "колонка": 8000
+    },
+    "Адаптер №2": {
+        "насос": 25000,
+        "реле": 800,
+        "обвязка": 300
+    },
+    "Адаптер №3": {
+        "насос": 25000,
+        "гидроаккумулятор": 8000,
+        "доведение внутрь объекта": 5000
+    },
+    "Кессон №1": {
+        "кессон": 75000,
+        "обратный клапан": 3300,
+        "блок автоматики": 5830,
+        "трос": 8800,
+        "кабель": 16500,
+        "зажим троса": 200,
+        "фильтр компресс. переход": 350,
+        "труба PPR Ø32": 130,
+        "труба ПНД Ø32": 10000,
+        "запорная арматура, фитинги": 6000,
+        "оголовок": 3500
+    },
+    "Кессон №2": {
+        "кессон": 75000,
+        "обратный клапан": 3300,
+        "блок автоматики": 5830,
+        "трос": 8800,
+        "кабель": 16500,
+        "зажим троса": 200,
+        "фильтр компресс. переход": 350,
+        "труба PPR Ø32": 130,
+        "труба ПНД Ø32": 500,
+        "запорная арматура, фитинги": 6000,
+        "оголовок": 3500
+    },
+    "Кессон №3": {
+        "кессон": 75000,
+        "обратный клапан": 3300,
+        "блок автоматики": 5830,
+        "трос": 8800,
+        "кабель": 16500,
+        "зажим троса": 200,
+        "фильтр компресс. переход": 350,
+        "труба PPR Ø32": 130,
+        "труба ПНД Ø32": 500,
+        "запорная арматура, фитинги": 6000,
+        "оголовок": 3500
+    },
+    "Станция биологической очистки": {
+        "насос для принудительного выброса очищенной воды": 7500,
+        "колодец в три кольца с крышкой": 45000
+    }
+}
+
+# Артефакт с данными сайта (lib/drilling-data.ts), собранный botlib.catalog_compiler
+CATALOG_ARTIFACT = os.environ.get("CATALOG_ARTIFACT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog_data.json"))
+
+# Версия формата артефакта
+CATALOG_ARTIFACT_FORMAT = 1
+
+
+# Данные сайта из артефакта: районы, глубины и цены по номерам позиций
+# (порядок - как в drilling-data.ts) плюс словари название -> номер
+class CatalogData:
+    __slots__ = (
+        "version", "districts", "district_index", "depth_ranges", "depths",
+        "base_drilling_cost", "filter_min_depth", "filter_cost",
+        "equipment_names", "equipment_prices", "equipment_index",
+        "service_names", "service_prices", "service_index",
+    )
+
+    def __init__(self, artifact):
+        if artifact.get("format") != CATALOG_ARTIFACT_FORMAT:
+            raise CatalogError(f"Неподдерживаемый формат артефакта каталога: {artifact.get('format')!r}")
+        self.version = artifact["version"]
+        self.districts = tuple(artifact["districts"])
+        self.district_index = {name: i for i, name in enumerate(self.districts)}
+        self.depth_ranges = tuple(tuple(tuple(r) for r in ranges) for ranges in artifact["depth_ranges"])
+        self.depths = tuple(tuple(depths) for depths in artifact["depths"])
+        self.base_drilling_cost = artifact["base_drilling_cost"]
+        self.filter_min_depth = artifact["filter_surcharge"]["min_depth"]
+        self.filter_cost = artifact["filter_surcharge"]["cost"]
+        self.equipment_names = tuple(artifact["equipment"]["names"])
+        self.equipment_prices = tuple(artifact["equipment"]["prices"])
+        self.equipment_index = {name: i for i, name in enumerate(self.equipment_names)}
+        self.service_names = tuple(artifact["services"]["names"])
+        self.service_prices = tuple(artifact["services"]["prices"])
+        self.service_index = {name: i for i, name in enumerate(self.service_names)}
+
+    # Диапазоны глубин района в формате Catalog: {район: ((от, до), ...)}
+    def district_depth_ranges(self):
+        return dict(zip(self.districts, self.depth_ranges))
+
+    # Все глубины района с шагом depth_step: {район: [глубины]}
+    def district_depths(self):
+        return {name: list(depths) for name, depths in zip(self.districts, self.depths)}
+
+    # Цены выбранных позиций по названиям (порядок - как в names)
+    def equipment_price_map(self, names):
+        return {name: self.equipment_prices[self.equipment_index[name]] for name in names}
+
+    def service_price_map(self, names):
+        return {name: self.service_prices[self.service_index[name]] for name in names}
+
+
+_catalog_data = {}
+
+
+# Артефакт читается один раз на процесс
+def load_catalog_data(path=CATALOG_ARTIFACT):
+    data = _catalog_data.get(path)
+    if data is None:
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = _catalog_data[path] = CatalogData(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            raise CatalogError(f"Не удалось загрузить артефакт каталога {path}: {e!r}. "
+                               f"Соберите его: python -m botlib.catalog_compiler")
+        logger.info(f"Загружен артефакт каталога {path}, версия {data.version}")
+    return data
+
+
+# Новый список названий начинается со старого: у старых позиций те же номера
+def names_extend(old, new):
+    return len(new) >= len(old) and all(old_name == new_name for old_name, new_name in zip(old, new))
+
+
+# Неизменяемый каталог калькулятора: районы, глубины, наборы оборудования и услуги.
+# Все производные таблицы (цены по номерам, суммы наборов, маски компонентов)
+# строятся один раз при создании, поэтому расчет на каждом нажатии - только
+# обращения по индексу. Номера позиций совпадают с номерами в Session и callback_data
+class Catalog:
+    __slots__ = (
+        "districts", "district_index", "district_depths",
+        "equipment_set_names", "equipment_set_items", "equipment_set_totals", "equipment_set_masks",
+        "component_names", "component_prices", "component_index",
+        "service_names", "service_prices",
+        "base_drilling_cost", "version", "callbacks",
+    )
+
+    def __init__(self, districts, district_depths, equipment_sets, services, base_drilling_cost, version=0):
+        setattr_ = super().__setattr__
+
+        setattr_("districts", tuple(districts))
+        setattr_("district_index", MappingProxyType({name: i for i, name in enumerate(self.districts)}))
+        setattr_("district_depths", MappingProxyType({
+            name: tuple(tuple(depth_range) for depth_range in ranges)
+            for name, ranges in district_depths.items()
+        }))
+
+        setattr_("equipment_set_names", tuple(equipment_sets))
+        setattr_("equipment_set_items", tuple(tuple(equipment_sets[name].items()) for name in self.equipment_set_names))
+        setattr_("equipment_set_totals", tuple(sum(price for _, price in items) for items in self.equipment_set_items))
+
+        # Все уникальные компоненты из всех наборов (цена - из последнего набора с компонентом)
+        components = {}
+        for items in self.equipment_set_items:
+            components.update(items)
+        setattr_("component_names", tuple(components))
+        setattr_("component_prices", tuple(components.values()))
+        setattr_("component_index", MappingProxyType({name: i for i, name in enumerate(self.component_names)}))
+        setattr_("equipment_set_masks", tuple(
+            sum(1 << self.component_index[name] for name, _ in items) for items in self.equipment_set_items
+        ))
+
+        setattr_("service_names", tuple(services))
+        setattr_("service_prices", tuple(services.values()))
+
+        setattr_("base_drilling_cost", base_drilling_cost)
+        setattr_("version", version)
+
+        # Таблицы коротких callback_data (d:12, e:7) этой версии каталога
+        setattr_("callbacks", CallbackCatalog({
+            callbacks.DISTRICT: self.districts,
+            callbacks.EQUIPMENT_SET: self.equipment_set_names,
+            callbacks.EQUIPMENT: self.component_names,
+            callbacks.SERVICE: self.service_names,
+        }))
+
+    # Каталог из словаря формата to_dict (содержимого файла каталога)
+    @classmethod
+    def from_dict(cls, data):
+        try:
+            catalog = cls(
+                data["districts"],
+                data.get("district_depths", {}),
+                data["equipment_sets"],
+                data["services"],
+                data["base_drilling_cost"],
+                data.get("version", 0),
+            )
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            raise CatalogError(f"Неверный формат каталога: {e!r}")
+        for ranges in catalog.district_depths.values():
+            if any(len(depth_range) != 2 or depth_range[0] > depth_range[1] for depth_range in ranges):
+                raise CatalogError(f"Неверный диапазон глубин: {ranges}")
+        return catalog
+
+    def to_dict(self):
+        return {
+            "version": self.version,
+            "districts": list(self.districts),
+            "district_depths": {name: [list(depth_range) for depth_range in ranges]
+                                for name, ranges in self.district_depths.items()},
+            "equipment_sets": {name: dict(items) for name, items in zip(self.equipment_set_names, self.equipment_set_items)},
+            "services": dict(zip(self.service_names, self.service_prices)),
+            "base_drilling_cost": self.base_drilling_cost,
+        }
+
+    # Можно ли заменить этот каталог новым: номера позиций уже лежат в сессиях
+    # и на отправленных кнопках, поэтому позиции можно только добавлять в конец
+    def compatible_with(self, other):
+        return (names_extend(self.districts, other.districts)
+                and names_extend(self.equipment_set_names, other.equipment_set_names)
+                and names_extend(self.component_names, other.component_names)
+                and names_extend(self.service_names, other.service_names))
+
+    # Помещается ли каталог в поля сессии (SESSION_LIMITS или CALLBACK_STATE_LIMITS):
+    # номера позиций и маски выбора хранятся в полях фиксированной ширины
+    def check_limits(self, limits):
+        sizes = {
+            "districts": len(self.districts),
+            "equipment_sets": len(self.equipment_set_names),
+            "components": len(self.component_names),
+            "services": len(self.service_names),
+            "depth": max((depth for ranges in self.district_depths.values()
+                          for depth_range in ranges for depth in depth_range), default=0),
+        }
+        over = [f"{name} {size} > {limits[name]}" for name, size in sizes.items() if size > limits[name]]
+        if over:
+            raise CatalogError(f"каталог не помещается в сессию: {', '.join(over)}")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Каталог неизменяем")
+
+    def __delattr__(self, name):
+        raise AttributeError("Каталог неизменяем")
+
+    def drilling_cost(self, depth):
+        return depth * self.base_drilling_cost
+
+    # Стоимость оборудования: готовый набор (номер >= 0) или компоненты по маске
+    def equipment_cost(self, equipment_set, equipment):
+        if equipment_set >= 0:
+            return self.equipment_set_totals[equipment_set]
+        prices = self.component_prices
+        return sum(prices[i] for i in mask_bits(equipment))
+
+    def services_cost(self, services):
+        prices = self.service_prices
+        return sum(prices[i] for i in mask_bits(services))
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "districts": len(self.districts),
+            "equipment_sets": len(self.equipment_set_names),
+            "components": len(self.component_names),
+            "services": len(self.service_names),
+        }
+
+
+# Каталог, который можно обновлять без перезапуска. Файл проверяется по таймеру
+# (mtime и размер), новый Catalog собирается в фоновом потоке и подменяется одним
+# присваиванием ссылки current. Читатели без блокировок берут current один раз на
+# обновление и работают с неизменяемым снимком до конца обработки.
+# limits - сколько позиций помещается в сессию обработчика: каталог, который
+# в нее не помещается, не загружается
+class CatalogSource:
+    def __init__(self, default, path=CATALOG_FILE, limits=SESSION_LIMITS):
+        default.check_limits(limits)
+        self.current = default
+        self.path = path
+        self.limits = limits
+
+        self._lock = threading.Lock()
+        self._signature = None
+
+        # Метрики
+        self.reloads = 0
+        self.errors = 0
+        self.last_error = None
+
+        if path:
+            self.check()
+
+    # Подпись файла для проверки изменений без чтения содержимого
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    # Перечитываем файл, если он изменился; True - каталог заменен
+    def check(self):
+        if not self.path:
+            return False
+        with self._lock:
+            try:
+                signature = self._file_signature()
+                if signature == self._signature:
+                    return False
+                # Запоминаем подпись и для отвергнутого файла, чтобы не разбирать его каждый раз
+                self._signature = signature
+                with open(self.path, encoding="utf-8") as f:
+                    catalog = Catalog.from_dict(json.load(f))
+                if not self.current.compatible_with(catalog):
+                    raise CatalogError("в новом каталоге позиции текущего удалены, переставлены или "
+                                       "переименованы (позиции можно только добавлять в конец)")
+                catalog.check_limits(self.limits)
+            except (OSError, ValueError) as e:
+                self.errors += 1
+                self.last_error = str(e)
+                logger.error(f"Каталог {self.path} не загружен, остается версия {self.current.version}: {e}")
+                return False
+
+            self.current = catalog
+            self.reloads += 1
+            logger.info(f"Загружен каталог {self.path}, версия {catalog.version}")
+            return True
+
+    async def run_reloader(self, interval=CATALOG_RELOAD_INTERVAL):
+        if not self.path:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.check)
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки каталога: {e}")
+
+    def stats(self):
+        return {
+            "file": self.path or None,
+            "reloads": self.reloads,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            **self.current.stats(),
+        }
+
+
+# Атомарная запись каталога в файл: читатель видит либо старый файл, либо новый целиком
+def save_catalog(catalog, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(catalog.to_dict(), f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+from botlib.catalog import CATALOG_ARTIFACT, CATALOG_ARTIFACT_FORMAT
+from botlib.catalog_map import write_binary_catalog
+
+logger = logging.getLogger(__name__)
+
+# Сборка каталога из lib/drilling-data.ts (единственного источника данных о районах,
+# глубинах и ценах) в компактный JSON-артефакт, который Python-обработчики читают
+# при импорте вместо своих копий данных, и его двоичную версию для mmap
+# (botlib.catalog_map, рядом с JSON с расширением .bin).
+# Запуск после правки drilling-data.ts:
+#   python -m botlib.catalog_compiler [lib/drilling-data.ts] [botlib/catalog_data.json]
+
+# Модуль данных сайта
+CATALOG_SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lib", "drilling-data.ts")
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<name>[^\W\d][\w]*)
+  | (?P<punct>[\[\]{}:,])
+''', re.VERBOSE | re.DOTALL)
+
+
+# Ошибка разбора модуля данных
+class CatalogCompileError(ValueError):
+    pass
+
+
+# Литерал TypeScript (массив, объект, число) -> значение Python.
+# Поддерживается то, что встречается в drilling-data.ts: комментарии,
+# ключи без кавычек, строки в одинарных кавычках, запятые в конце списков
+def parse_ts_literal(text):
+    parts = []
+    pos = 0
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise CatalogCompileError(f"Неожиданный символ в литерале: {text[pos:pos + 20]!r}")
+        pos = match.end()
+        kind = match.lastgroup
+        token = match.group()
+        if kind in ("space", "comment"):
+            continue
+        if kind == "string" and token.startswith("'"):
+            token = json.dumps(token[1:-1].replace("\\'", "'"), ensure_ascii=False)
+        elif kind == "name" and token not in ("null", "true", "false"):
+            # Ключ объекта без кавычек
+            token = json.dumps(token, ensure_ascii=False)
+        elif token in "]}" and parts and parts[-1] == ",":
+            parts.pop()
+        parts.append(token)
+    try:
+        return json.loads("".join(parts))
+    except ValueError as e:
+        raise CatalogCompileError(f"Не удалось разобрать литерал: {e}")
+
+
+# Значение константы модуля: const name[: тип] = литерал
+def extract_const(source, name):
+    match = re.search(rf"^const\s+{name}\b[^=]*=\s*", source, re.M)
+    if match is None:
+        raise CatalogCompileError(f"В модуле нет константы {name}")
+    start = match.end()
+    if source[start] not in "[{":
+        end = re.compile(r"[\n;/]").search(source, start).start()
+        return parse_ts_literal(source[start:end])
+
+    # Ищем парную скобку, пропуская строки и комментарии
+    depth = 0
+    pos = start
+    while pos < len(source):
+        token = _TOKEN.match(source, pos)
+        if token is None:
+            raise CatalogCompileError(f"Неожиданный символ в {name}: {source[pos:pos + 20]!r}")
+        if token.group() in ("[", "{"):
+            depth += 1
+        elif token.group() in ("]", "}"):
+            depth -= 1
+            if depth == 0:
+                return parse_ts_literal(source[start:token.end()])
+        pos = token.end()
+    raise CatalogCompileError(f"Незакрытый литерал {name}")
+
+
+# Глубины из диапазона с шагом, как generateDepthsFromRange в drilling-data.ts
+def depths_from_range(depth_range, step):
+    if not depth_range:
+        return []
+    return list(range(depth_range[0], depth_range[1] + 1, step))
+
+
+# Модуль данных -> словарь артефакта (формат CATALOG_ARTIFACT_FORMAT)
+def compile_catalog(source):
+    districts = extract_const(source, "districts")
+    horizons = extract_const(source, "districtDepthRanges")
+    base_drilling_cost = extract_const(source, "baseDrillingCostPerMeter")
+    equipment = extract_const(source, "equipment")
+    services = extract_const(source, "services")
+
+    step = re.search(r"const\s+step\s*=\s*(\d+)", source)
+    step = int(step.group(1)) if step else 5
+
+    # Доплата за фильтр на песок в calculateDrillingCost: depth > N ? цена : 0
+    surcharge = re.search(r"depth\s*>\s*(\d+)\s*\?\s*(\d+)\s*:\s*0", source)
+    if surcharge is None:
+        raise CatalogCompileError("Не найдена доплата за фильтр в calculateDrillingCost")
+
+    depth_ranges = []
+    depths = []
+    for district in districts:
+        # Горизонты ПИ1 и ПИ2 района (отсутствующие пропускаем)
+        ranges = [list(r) for r in (horizons.get(district, {}).get(key) for key in ("pi1", "pi2")) if r]
+        depth_ranges.append(ranges)
+        depths.append(sorted({depth for r in ranges for depth in depths_from_range(r, step)}))
+
+    data = {
+        "districts": districts,
+        "depth_ranges": depth_ranges,
+        "depths": depths,
+        "depth_step": step,
+        "base_drilling_cost": base_drilling_cost,
+        "filter_surcharge": {"min_depth": int(surcharge.group(1)), "cost": int(surcharge.group(2))},
+        "equipment": {"names": list(equipment), "prices": list(equipment.values())},
+        "services": {"names": list(services), "prices": list(services.values())},
+    }
+    # Версия - хэш содержимого: меняется только при изменении данных
+    digest = hashlib.sha256(json.dumps(data, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+    return {"format": CATALOG_ARTIFACT_FORMAT, "version": digest[:12], **data}
+
+
+# Атомарная запись артефакта: читатель видит либо старый файл, либо новый целиком
+def write_artifact(artifact, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(artifact, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def main(argv):
+    source_path = argv[1] if len(argv) > 1 else CATALOG_SOURCE
+    output_path = argv[2] if len(argv) > 2 else CATALOG_ARTIFACT
+    with open(source_path, encoding="utf-8") as f:
+        artifact = compile_catalog(f.read())
+    write_artifact(artifact, output_path)
+    write_binary_catalog(artifact, os.path.splitext(output_path)[0] + ".bin")
+    logger.info(f"Каталог {source_path} -> {output_path}, версия {artifact['version']}: "
+                f"{len(artifact['districts'])} районов, {len(artifact['equipment']['names'])} позиций оборудования, "
+                f"{len(artifact['services']['names'])} услуг")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv)
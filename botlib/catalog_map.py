@@ -0,0 +1,381 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import threading
+from collections.abc import Mapping, Sequence
+
+from botlib.catalog import CATALOG_ARTIFACT, CATALOG_RELOAD_INTERVAL, CatalogError, names_extend
+
+logger = logging.getLogger(__name__)
+
+# Двоичная версия артефакта каталога для процессов с несколькими воркерами.
+# Каждый воркер отображает файл в память только на чтение (mmap), поэтому страницы
+# файла общие в page cache и память не растет с числом воркеров. Данные читаются
+# прямо из отображения через struct без разбора файла в объекты Python
+CATALOG_BINARY = os.environ.get("CATALOG_BINARY", os.path.splitext(CATALOG_ARTIFACT)[0] + ".bin")
+
+CATALOG_BINARY_MAGIC = b"KCAT"
+CATALOG_BINARY_FORMAT = 1
+
+# Заголовок: магия, формат, шаг глубин, версия артефакта, базовая цена бурения,
+# доплата за фильтр и глубина, с которой она берется, число районов, позиций
+# оборудования и услуг, затем смещения разделов от начала файла: записи районов,
+# отсортированный по названию индекс районов, то же для оборудования и услуг
+CATALOG_BINARY_HEADER = struct.Struct("<4sHH16sIIHHHHIIIIII")
+
+# Район: смещение и длина названия (UTF-8), смещение и число пар диапазонов
+# глубин (u16, u16), смещение и число глубин (u16)
+DISTRICT_RECORD = struct.Struct("<IHIHIH")
+
+# Позиция оборудования или услуги: смещение и длина названия, цена
+ITEM_RECORD = struct.Struct("<IHI")
+
+_U16 = struct.Struct("<H")
+
+
+# Артефакт (словарь формата botlib.catalog_compiler) -> содержимое двоичного файла.
+# Раздел чисел и строк идет после записей; все смещения абсолютные
+def build_binary_catalog(artifact):
+    districts = artifact["districts"]
+    equipment = artifact["equipment"]
+    services = artifact["services"]
+
+    names_count = len(districts) + len(equipment["names"]) + len(services["names"])
+    records_size = (DISTRICT_RECORD.size * len(districts)
+                    + ITEM_RECORD.size * (len(equipment["names"]) + len(services["names"]))
+                    + _U16.size * names_count)
+    data_start = CATALOG_BINARY_HEADER.size + records_size
+
+    data = bytearray()
+
+    def put_string(name):
+        encoded = name.encode("utf-8")
+        offset = data_start + len(data)
+        data.extend(encoded)
+        return offset, len(encoded)
+
+    def put_numbers(numbers):
+        offset = data_start + len(data)
+        data.extend(struct.pack(f"<{len(numbers)}H", *numbers))
+        return offset
+
+    # Номера записей в порядке возрастания названий (для двоичного поиска по названию)
+    def sorted_index(names):
+        order = sorted(range(len(names)), key=lambda i: names[i].encode("utf-8"))
+        return struct.pack(f"<{len(order)}H", *order)
+
+    district_records = bytearray()
+    for name, ranges, depths in zip(districts, artifact["depth_ranges"], artifact["depths"]):
+        name_offset, name_length = put_string(name)
+        ranges_offset = put_numbers([depth for depth_range in ranges for depth in depth_range])
+        depths_offset = put_numbers(depths)
+        district_records += DISTRICT_RECORD.pack(name_offset, name_length, ranges_offset, len(ranges),
+                                                 depths_offset, len(depths))
+
+    def item_records(items):
+        records = bytearray()
+        for name, price in zip(items["names"], items["prices"]):
+            records += ITEM_RECORD.pack(*put_string(name), price)
+        return records
+
+    equipment_records = item_records(equipment)
+    service_records = item_records(services)
+
+    sections = [
+        district_records, sorted_index(districts),
+        equipment_records, sorted_index(equipment["names"]),
+        service_records, sorted_index(services["names"]),
+    ]
+    offsets = []
+    offset = CATALOG_BINARY_HEADER.size
+    for section in sections:
+        offsets.append(offset)
+        offset += len(section)
+
+    header = CATALOG_BINARY_HEADER.pack(
+        CATALOG_BINARY_MAGIC, CATALOG_BINARY_FORMAT, artifact["depth_step"],
+        artifact["version"].encode("ascii"), artifact["base_drilling_cost"],
+        artifact["filter_surcharge"]["cost"], artifact["filter_surcharge"]["min_depth"],
+        len(districts), len(equipment["names"]), len(services["names"]),
+        *offsets,
+    )
+    return header + b"".join(sections) + bytes(data)
+
+
+# Атомарная запись: уже отображенный воркерами файл не меняется, они продолжают
+# читать старую версию, пока не переотобразят новый файл
+def write_binary_catalog(artifact, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(build_binary_catalog(artifact))
+    os.replace(tmp_path, path)
+
+
+# Одна версия каталога, отображенная в память. Доступ по номеру - struct.unpack_from
+# из отображения, по названию - двоичный поиск по отсортированному индексу
+class MappedCatalog:
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < CATALOG_BINARY_HEADER.size:
+            raise CatalogError(f"Файл каталога {path} слишком короткий")
+        (magic, file_format, self.depth_step, version, self.base_drilling_cost,
+         self.filter_cost, self.filter_min_depth,
+         self.district_count, self.equipment_count, self.service_count,
+         self._districts_offset, self._districts_sorted_offset,
+         self._equipment_offset, self._equipment_sorted_offset,
+         self._services_offset, self._services_sorted_offset) = CATALOG_BINARY_HEADER.unpack_from(self._mm)
+        if magic != CATALOG_BINARY_MAGIC or file_format != CATALOG_BINARY_FORMAT:
+            raise CatalogError(f"Файл {path} - не двоичный каталог формата {CATALOG_BINARY_FORMAT}")
+        self.version = version.rstrip(b"\0").decode("ascii")
+
+    def _string(self, offset, length):
+        return self._mm[offset:offset + length].decode("utf-8")
+
+    def _district(self, index):
+        if not 0 <= index < self.district_count:
+            raise IndexError(index)
+        return DISTRICT_RECORD.unpack_from(self._mm, self._districts_offset + index * DISTRICT_RECORD.size)
+
+    def district_name(self, index):
+        name_offset, name_length = self._district(index)[:2]
+        return self._string(name_offset, name_length)
+
+    # Диапазоны глубин горизонтов района: ((от, до), ...)
+    def depth_ranges(self, index):
+        _, _, offset, count, _, _ = self._district(index)
+        numbers = struct.unpack_from(f"<{count * 2}H", self._mm, offset)
+        return tuple(zip(numbers[::2], numbers[1::2]))
+
+    # Все глубины района с шагом depth_step
+    def depths(self, index):
+        _, _, _, _, offset, count = self._district(index)
+        return list(struct.unpack_from(f"<{count}H", self._mm, offset))
+
+    def _item(self, offset, count, index):
+        if not 0 <= index < count:
+            raise IndexError(index)
+        return ITEM_RECORD.unpack_from(self._mm, offset + index * ITEM_RECORD.size)
+
+    def equipment_name(self, index):
+        name_offset, name_length, _ = self._item(self._equipment_offset, self.equipment_count, index)
+        return self._string(name_offset, name_length)
+
+    def equipment_price(self, index):
+        return self._item(self._equipment_offset, self.equipment_count, index)[2]
+
+    def service_name(self, index):
+        name_offset, name_length, _ = self._item(self._services_offset, self.service_count, index)
+        return self._string(name_offset, name_length)
+
+    def service_price(self, index):
+        return self._item(self._services_offset, self.service_count, index)[2]
+
+    # Номер записи по названию: двоичный поиск по индексу, отсортированному по байтам названия
+    def _find(self, name, sorted_offset, count, record_key):
+        key = name.encode("utf-8")
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            index = _U16.unpack_from(self._mm, sorted_offset + middle * _U16.size)[0]
+            current = record_key(index)
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return index
+        return None
+
+    def _district_key(self, index):
+        name_offset, name_length = self._district(index)[:2]
+        return self._mm[name_offset:name_offset + name_length]
+
+    def _equipment_key(self, index):
+        name_offset, name_length, _ = self._item(self._equipment_offset, self.equipment_count, index)
+        return self._mm[name_offset:name_offset + name_length]
+
+    def _service_key(self, index):
+        name_offset, name_length, _ = self._item(self._services_offset, self.service_count, index)
+        return self._mm[name_offset:name_offset + name_length]
+
+    def district_id(self, name):
+        return self._find(name, self._districts_sorted_offset, self.district_count, self._district_key)
+
+    def equipment_id(self, name):
+        return self._find(name, self._equipment_sorted_offset, self.equipment_count, self._equipment_key)
+
+    def service_id(self, name):
+        return self._find(name, self._services_sorted_offset, self.service_count, self._service_key)
+
+    # Глубины района по названию (пустой список, если района нет)
+    def district_depths(self, name):
+        index = self.district_id(name)
+        return [] if index is None else self.depths(index)
+
+    def size(self):
+        return len(self._mm)
+
+    def district_names(self):
+        return [self.district_name(i) for i in range(self.district_count)]
+
+    def equipment_names(self):
+        return [self.equipment_name(i) for i in range(self.equipment_count)]
+
+    def service_names(self):
+        return [self.service_name(i) for i in range(self.service_count)]
+
+    # Можно ли заменить эту версию новой (как Catalog.compatible_with):
+    # старые позиции остаются на своих номерах, новые - только в конце
+    def compatible_with(self, other):
+        return (names_extend(self.district_names(), other.district_names())
+                and names_extend(self.equipment_names(), other.equipment_names())
+                and names_extend(self.service_names(), other.service_names()))
+
+
+# Названия позиций текущей версии каталога как последовательность: по номеру -
+# запись из отображения, index() - двоичный поиск. Подходит для CallbackCatalog
+class MappedNames(Sequence):
+    def __init__(self, source, count, name, find):
+        self._source = source
+        self._count = count
+        self._name = name
+        self._find = find
+
+    def __len__(self):
+        return getattr(self._source.current, self._count)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return getattr(self._source.current, self._name)(index)
+
+    def index(self, name, *args):
+        index = getattr(self._source.current, self._find)(name)
+        if index is None:
+            raise ValueError(f"{name!r} нет в каталоге")
+        return index
+
+    def __contains__(self, name):
+        return getattr(self._source.current, self._find)(name) is not None
+
+
+# Цены текущей версии каталога по названию (оборудование или услуги)
+class MappedPrices(Mapping):
+    def __init__(self, source, count, name, price, find):
+        self._source = source
+        self._count = count
+        self._name = name
+        self._price = price
+        self._find = find
+
+    def __getitem__(self, name):
+        catalog = self._source.current
+        index = getattr(catalog, self._find)(name)
+        if index is None:
+            raise KeyError(name)
+        return getattr(catalog, self._price)(index)
+
+    def __iter__(self):
+        catalog = self._source.current
+        name = getattr(catalog, self._name)
+        return (name(i) for i in range(getattr(catalog, self._count)))
+
+    def __len__(self):
+        return getattr(self._source.current, self._count)
+
+
+# Двоичный каталог, который переотображается при выходе новой версии.
+# current - текущая MappedCatalog; замена - одно присваивание ссылки, старое
+# отображение закрывается сборщиком мусора, когда его перестают использовать.
+# districts, equipment, services и цены всегда смотрят в current
+class CatalogMap:
+    def __init__(self, path=CATALOG_BINARY):
+        self.path = path
+        self._lock = threading.Lock()
+        self._signature = self._file_signature()
+        self.current = MappedCatalog(path)
+
+        # Метрики
+        self.remaps = 0
+        self.errors = 0
+
+        self.districts = MappedNames(self, "district_count", "district_name", "district_id")
+        self.equipment = MappedNames(self, "equipment_count", "equipment_name", "equipment_id")
+        self.services = MappedNames(self, "service_count", "service_name", "service_id")
+        self.equipment_prices = MappedPrices(self, "equipment_count", "equipment_name", "equipment_price", "equipment_id")
+        self.service_prices = MappedPrices(self, "service_count", "service_name", "service_price", "service_id")
+
+    # Файл заменяется через rename, поэтому новая версия - новый inode
+    def _file_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    # Переотображаем файл, если вышла новая версия; True - каталог заменен
+    def check(self):
+        with self._lock:
+            try:
+                signature = self._file_signature()
+                if signature == self._signature:
+                    return False
+                self._signature = signature
+                catalog = MappedCatalog(self.path)
+            except (OSError, ValueError, struct.error) as e:
+                self.errors += 1
+                logger.error(f"Каталог {self.path} не переотображен, остается версия {self.current.version}: {e}")
+                return False
+            if catalog.version == self.current.version:
+                return False
+            if not self.current.compatible_with(catalog):
+                self.errors += 1
+                logger.error(f"Каталог {self.path} не переотображен, остается версия {self.current.version}: "
+                             f"в версии {catalog.version} позиции удалены, переставлены или переименованы "
+                             f"(позиции можно только добавлять в конец)")
+                return False
+            self.current = catalog
+            self.remaps += 1
+            logger.info(f"Каталог {self.path} переотображен, версия {catalog.version}")
+            return True
+
+    async def run_reloader(self, interval=CATALOG_RELOAD_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.check)
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки каталога: {e}")
+
+    def stats(self):
+        catalog = self.current
+        return {
+            "file": self.path,
+            "version": catalog.version,
+            "mapped_bytes": catalog.size(),
+            "districts": catalog.district_count,
+            "equipment": catalog.equipment_count,
+            "services": catalog.service_count,
+            "remaps": self.remaps,
+            "errors": self.errors,
+        }
+
+
+_catalog_maps = {}
+_catalog_maps_lock = threading.Lock()
+
+
+# Одно отображение файла на процесс
+def get_catalog_map(path=CATALOG_BINARY):
+    with _catalog_maps_lock:
+        catalog_map = _catalog_maps.get(path)
+        if catalog_map is None:
+            try:
+                catalog_map = _catalog_maps[path] = CatalogMap(path)
+            except (OSError, ValueError, struct.error) as e:
+                raise CatalogError(f"Не удалось отобразить каталог {path}: {e!r}. "
+                                   f"Соберите его: python -m botlib.catalog_compiler")
+            logger.info(f"Отображен каталог {path}, версия {catalog_map.current.version}")
+        return catalog_map
@@ -0,0 +1,189 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from botlib.resp import RespClient
+from botlib.sessions import SESSION_REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд помним обработанные обновления (Telegram повторяет
+# доставку, пока вебхук отвечает ошибкой или не отвечает вовсе)
+DEDUP_TTL = float(os.environ.get("UPDATE_DEDUP_TTL", 3600))
+
+# Сколько ключей держим в памяти процесса (самые старые вытесняются)
+DEDUP_CAPACITY = int(os.environ.get("UPDATE_DEDUP_CAPACITY", 100000))
+
+# Файл SQLite, общий для нескольких процессов на одной машине (пусто - только память процесса)
+DEDUP_DB = os.environ.get("UPDATE_DEDUP_DB", "")
+
+# Redis, общий для всех экземпляров (по умолчанию - тот же, что у сессий);
+# если задан, используется вместо UPDATE_DEDUP_DB
+DEDUP_REDIS_URL = os.environ.get("UPDATE_DEDUP_REDIS_URL", SESSION_REDIS_URL)
+
+# Раз в сколько вставок чистим просроченные ключи в общем хранилище
+SHARED_PURGE_EVERY = 1000
+
+
+# Ключи повторной доставки для сырого JSON обновления:
+# update_id и id нажатия кнопки (callback_query.id)
+def update_keys(update):
+    keys = []
+    if isinstance(update.get("update_id"), int):
+        keys.append(f"u:{update['update_id']}")
+    callback_query = update.get("callback_query")
+    if isinstance(callback_query, dict) and callback_query.get("id"):
+        keys.append(f"cb:{callback_query['id']}")
+    return keys
+
+
+# Общее для процессов хранилище ключей в SQLite (режим WAL)
+class SqliteDedupStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._inserts = 0
+
+    # Соединение на поток (sqlite3 не разрешает делить его между потоками)
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    # Добавляем ключ; False - ключ уже есть и еще не просрочен
+    def add(self, key, ttl):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("DELETE FROM dedup WHERE key = ? AND expires < ?", (key, now))
+        added = conn.execute("INSERT OR IGNORE INTO dedup (key, expires) VALUES (?, ?)",
+                             (key, now + ttl)).rowcount == 1
+        self._inserts += 1
+        if self._inserts % SHARED_PURGE_EVERY == 0:
+            conn.execute("DELETE FROM dedup WHERE expires < ?", (now,))
+        return added
+
+    def discard(self, key):
+        self._conn().execute("DELETE FROM dedup WHERE key = ?", (key,))
+
+
+# Общее для процессов и машин хранилище ключей в Redis: SET NX EX добавляет
+# ключ атомарно, а просроченные ключи удаляет сам Redis
+class RespDedupStore:
+    def __init__(self, client):
+        self.client = client
+
+    def _key(self, key):
+        return f"dedup:{key}"
+
+    # Добавляем ключ; False - ключ уже есть и еще не просрочен
+    def add(self, key, ttl):
+        reply = self.client.execute("SET", self._key(key), "1", "NX", "EX", max(1, round(ttl)))
+        return reply is not None
+
+    def discard(self, key):
+        self.client.execute("DEL", self._key(key))
+
+
+# Отсев повторных доставок одного и того же обновления.
+# В памяти - окно по времени: ключи лежат в порядке поступления, поэтому
+# просроченные и лишние снимаются с начала за O(1). Если задано общее
+# хранилище, ключ проверяется и в нем (для нескольких процессов).
+# Проверка идет по сырому JSON, до создания объектов Update и вызовов Telegram
+class UpdateDedup:
+    def __init__(self, ttl=DEDUP_TTL, capacity=DEDUP_CAPACITY, shared=None):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.shared = shared
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Метрики
+        self.checked = 0
+        self.duplicates = 0
+        self.shared_errors = 0
+
+    def _prune(self, now):
+        while self._seen:
+            key, expires = next(iter(self._seen.items()))
+            if expires > now and len(self._seen) <= self.capacity:
+                break
+            self._seen.popitem(last=False)
+
+    # Обновление уже приходило? Если нет - запоминаем его
+    def seen(self, update):
+        keys = update_keys(update)
+        if not keys:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self.checked += 1
+            self._prune(now)
+            if any(key in self._seen for key in keys):
+                self.duplicates += 1
+                return True
+            for key in keys:
+                self._seen[key] = now + self.ttl
+            self._prune(now)
+
+        if self.shared is not None:
+            try:
+                if not all([self.shared.add(key, self.ttl) for key in keys]):
+                    self.duplicates += 1
+                    return True
+            except Exception as e:
+                # Общее хранилище недоступно - полагаемся на память процесса
+                self.shared_errors += 1
+                logger.warning(f"Ошибка общего хранилища дедупликации: {e}")
+        return False
+
+    # Забываем обновление, если оно не было принято (например, очередь переполнена),
+    # чтобы повторная доставка от Telegram была обработана
+    def forget(self, update):
+        keys = update_keys(update)
+        with self._lock:
+            for key in keys:
+                self._seen.pop(key, None)
+        if self.shared is not None:
+            try:
+                for key in keys:
+                    self.shared.discard(key)
+            except Exception as e:
+                self.shared_errors += 1
+                logger.warning(f"Ошибка общего хранилища дедупликации: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "size": len(self._seen),
+                "shared": self.shared is not None,
+                "shared_errors": self.shared_errors,
+            }
+
+
+# Общий для процесса фильтр повторных доставок
+_default_dedup = None
+_default_lock = threading.Lock()
+
+
+def get_update_dedup():
+    global _default_dedup
+    with _default_lock:
+        if _default_dedup is None:
+            if DEDUP_REDIS_URL:
+                shared = RespDedupStore(RespClient(DEDUP_REDIS_URL))
+            elif DEDUP_DB:
+                shared = SqliteDedupStore(DEDUP_DB)
+            else:
+                shared = None
+            _default_dedup = UpdateDedup(shared=shared)
+        return _default_dedup
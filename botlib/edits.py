@@ -0,0 +1,221 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from botlib.sessions import SERVERLESS, SESSION_REDIS_URL, STATELESS_SESSIONS
+
+# Методы редактирования, которые можно склеивать по сообщению
+EDIT_METHODS = frozenset({"editMessageText", "editMessageReplyMarkup"})
+
+
+# Ключ сообщения в кешах редактирований
+def message_key(chat_id, message_id):
+    return (str(chat_id), int(message_id))
+
+
+# Ключ сообщения для вызова редактирования или None, если вызов не редактирует сообщение
+def edit_key(method, params):
+    if method not in EDIT_METHODS or not params:
+        return None
+    if params.get("inline_message_id"):
+        return ("inline", params["inline_message_id"])
+    if params.get("chat_id") is not None and params.get("message_id") is not None:
+        return message_key(params["chat_id"], params["message_id"])
+    return None
+
+
+# Сообщения бота могут редактировать несколько процессов: экземпляры
+# serverless-функции или инстансы с общими сессиями (Redis, сессия в кнопках)
+MULTI_INSTANCE = bool(SERVERLESS or SESSION_REDIS_URL or STATELESS_SESSIONS)
+
+# Сколько последних отрисовок сообщений помним (0 - кеш выключен). Кеш живет
+# в памяти процесса и не знает о редактированиях из других процессов, поэтому
+# при MULTI_INSTANCE по умолчанию выключен
+RENDER_CACHE_SIZE = int(os.environ.get("TELEGRAM_RENDER_CACHE_SIZE", 0 if MULTI_INSTANCE else 10000))
+
+# Ответ Telegram на редактирование без изменений
+NOT_MODIFIED_ERROR = "message is not modified"
+
+
+# Короткий хеш значения (строки или JSON-совместимого объекта)
+def _digest(value):
+    if value is None:
+        return b""
+    if not isinstance(value, str):
+        value = json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest()
+
+
+# Параметры editMessageText, относящиеся к тексту (остальные есть и у editMessageReplyMarkup)
+TEXT_PARAMS = frozenset({"text", "parse_mode", "entities", "disable_web_page_preview"})
+
+# Результат сравнения новой отрисовки с последней отправленной
+RENDER_UNCHANGED = "unchanged"
+RENDER_MARKUP_ONLY = "markup_only"
+RENDER_CHANGED = "changed"
+
+
+# Параметры editMessageReplyMarkup из параметров editMessageText
+def markup_only_params(params):
+    return {k: v for k, v in params.items() if k not in TEXT_PARAMS}
+
+
+# Хеши отрисовки: (текст с параметрами форматирования, клавиатура)
+def render_hashes(method, params):
+    if method == "editMessageReplyMarkup":
+        text_hash = None
+    else:
+        text_hash = _digest([params.get("text"), params.get("parse_mode"), params.get("entities"),
+                             params.get("disable_web_page_preview")])
+    return text_hash, _digest(params.get("reply_markup"))
+
+
+# LRU-кеш последней отрисовки каждого сообщения (хеш текста и клавиатуры).
+# Позволяет не отправлять editMessageText, который ничего не меняет -
+# Telegram на такой вызов все равно ответит "message is not modified", -
+# а если изменилась только клавиатура, отправить editMessageReplyMarkup
+class RenderCache:
+    def __init__(self, capacity=RENDER_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Сколько редактирований пропущено без обращения к Telegram
+        self.hits = 0
+        # Сколько editMessageText заменено на более легкий editMessageReplyMarkup
+        self.markup_only = 0
+
+    # Сравнение новой отрисовки с последней отправленной: не изменилось ничего,
+    # изменилась только клавиатура или изменился текст
+    def compare(self, key, method, params):
+        text_hash, markup_hash = render_hashes(method, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return RENDER_CHANGED
+            if text_hash is not None and text_hash != entry[0]:
+                return RENDER_CHANGED
+            self._entries.move_to_end(key)
+            return RENDER_UNCHANGED if markup_hash == entry[1] else RENDER_MARKUP_ONLY
+
+    # Запоминаем отрисовку, которую Telegram принял
+    def remember(self, key, method, params):
+        if self.capacity <= 0:
+            return
+        text_hash, markup_hash = render_hashes(method, params)
+        with self._lock:
+            if text_hash is None:
+                entry = self._entries.get(key)
+                if entry is None:
+                    return
+                text_hash = entry[0]
+            self._entries[key] = (text_hash, markup_hash)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "markup_only": self.markup_only, "size": len(self._entries)}
+
+
+# Склейка частых редактирований одного сообщения.
+# Каждое редактирование получает порядковый номер; пока вызов ждет слота
+# в лимитере, более новое редактирование того же сообщения заменяет его.
+# Кто первым получил слот, становится владельцем сообщения и отправляет самую
+# свежую версию, остальные ожидающие вызовы отбрасываются. Пока владелец
+# отправляет, никто другой по этому сообщению в Telegram не ходит: версию,
+# пришедшую за это время, владелец отправляет следующей, поэтому старая
+# отрисовка не может прийти в Telegram позже новой
+class EditCoalescer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seq = 0
+        # Ожидающая отправки версия: ключ -> (номер, метод, параметры)
+        self._pending = {}
+        # Номер версии, которая сейчас отправляется: ключ -> номер
+        self._claimed = {}
+
+        # Метрики
+        self.submitted = 0
+        self.replaced = 0
+        self.dropped = 0
+        self.handed_off = 0
+
+    # Регистрируем новое редактирование, возвращаем его номер
+    def submit(self, key, method, params):
+        with self._lock:
+            self._seq += 1
+            self.submitted += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.replaced += 1
+                # Новая версия только с клавиатурой не должна терять текст из ожидающей
+                if pending[1] == "editMessageText" and method != "editMessageText":
+                    method, params = pending[1], {**pending[2], **params}
+            self._pending[key] = (self._seq, method, params)
+            return self._seq
+
+    # Вызывается перед каждой попыткой отправки.
+    # Возвращает (номер, метод, параметры) версии, которую нужно отправить,
+    # или None, если вызов устарел или сообщение сейчас отправляет другой
+    # вызов (тогда ожидающую версию отправит он, после done).
+    # owned - вызов уже владеет сообщением (повтор или переданная версия)
+    def claim(self, key, seq, owned=False):
+        with self._lock:
+            if owned and self._claimed.get(key) == seq:
+                pending = self._pending.pop(key, None)
+                if pending is None:
+                    return seq, None, None
+                self._claimed[key] = pending[0]
+                return pending
+            if key in self._claimed:
+                self.handed_off += 1
+                return None
+            pending = self._pending.pop(key, None)
+            if pending is None:
+                self.dropped += 1
+                return None
+            self._claimed[key] = pending[0]
+            return pending
+
+    # Есть ли по сообщению ожидающие или отправляемые версии
+    def busy(self, key):
+        with self._lock:
+            return key in self._pending or key in self._claimed
+
+    # Отправка версии seq завершена. Возвращает версию, пришедшую за это время,
+    # - владелец отправляет ее следующей, - или None, и сообщение освобождается
+    def done(self, key, seq):
+        with self._lock:
+            if self._claimed.get(key) != seq:
+                return None
+            pending = self._pending.pop(key, None)
+            if pending is None:
+                del self._claimed[key]
+                return None
+            self._claimed[key] = pending[0]
+            return pending
+
+    # Владелец прервал отправку (ошибка, срок запроса): ожидающая версия
+    # остается и уйдет со следующим редактированием сообщения
+    def release(self, key, seq):
+        with self._lock:
+            if self._claimed.get(key) == seq:
+                del self._claimed[key]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "replaced": self.replaced,
+                "dropped": self.dropped,
+                "handed_off": self.handed_off,
+                "pending": len(self._pending),
+            }
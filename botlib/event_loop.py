@@ -0,0 +1,46 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Фоновый event loop процесса. Живет в отдельном потоке между вызовами
+# serverless-функции, поэтому Bot и его HTTP-сессия (httpx у python-telegram-bot,
+# aiohttp у aiogram) создаются один раз, а "теплые" вызовы переиспользуют соединения.
+# asyncio.run() на каждый запрос, наоборот, закрывал loop вместе с сессией
+_loop = None
+_lock = threading.Lock()
+
+
+def _start_loop():
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def _run():
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+
+    threading.Thread(target=_run, name="botlib-event-loop", daemon=True).start()
+    ready.wait()
+    logger.info("Запущен фоновый event loop")
+    return loop
+
+
+# Общий event loop процесса (запускается при первом обращении)
+def get_loop():
+    global _loop
+    with _lock:
+        if _loop is None or _loop.is_closed():
+            _loop = _start_loop()
+        return _loop
+
+
+# Запускаем корутину в фоновом loop, не дожидаясь результата
+def submit(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+# Выполняем корутину в фоновом loop и ждем результат (замена asyncio.run)
+def run(coro, timeout=None):
+    return submit(coro).result(timeout)
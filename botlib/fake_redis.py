@@ -0,0 +1,240 @@
+import asyncio
+import fnmatch
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Локальная замена Redis для тестов и прогонов без redis-server: поддерживает
+# подмножество команд, которым пользуются сессии (строки с TTL).
+# Запуск: python -m botlib.fake_redis, затем у бота
+# SESSION_REDIS_URL=redis://127.0.0.1:6380
+
+# Адрес, на котором слушает сервер
+HOST = os.environ.get("FAKE_REDIS_HOST", "127.0.0.1")
+PORT = int(os.environ.get("FAKE_REDIS_PORT", 6380))
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+class FakeRedis:
+    def __init__(self, host=HOST, port=PORT):
+        self.host = host
+        self.port = port
+
+        self.loop = None
+        self._server = None
+        # Ключ -> (значение, момент истечения по time.monotonic() или None)
+        self.data = {}
+
+        # Метрики
+        self.commands = {}
+        self.connections = 0
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Порт 0 - берем тот, что выдала система
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Redis слушает {self.url}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    # Запуск в фоновом потоке со своим event loop; возвращает адрес для SESSION_REDIS_URL
+    def start_in_thread(self):
+        started = threading.Event()
+
+        def _run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=_run, daemon=True).start()
+        started.wait()
+        return self.url
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline-команда (например, из telnet)
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            header = await reader.readline()
+            length = int(header[1:-2])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                try:
+                    reply = self.execute(args)
+                except FakeRedisError as e:
+                    writer.write(b"-%s\r\n" % str(e).encode("utf-8"))
+                else:
+                    writer.write(encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _expire(self, key, seconds):
+        if self._get(key) is None:
+            return 0
+        self.data[key] = (self.data[key][0], time.monotonic() + seconds)
+        return 1
+
+    def execute(self, args):
+        command = args[0].decode("utf-8").upper()
+        args = args[1:]
+        self.commands[command] = self.commands.get(command, 0) + 1
+        handler = getattr(self, f"cmd_{command.lower()}", None)
+        if handler is None:
+            raise FakeRedisError(f"ERR unknown command '{command}'")
+        try:
+            return handler(*args)
+        except (TypeError, ValueError):
+            raise FakeRedisError(f"ERR wrong arguments for '{command}' command")
+
+    def cmd_ping(self, message=None):
+        return SimpleString("PONG") if message is None else message
+
+    def cmd_auth(self, *args):
+        return SimpleString("OK")
+
+    def cmd_select(self, db):
+        return SimpleString("OK")
+
+    def cmd_get(self, key):
+        return self._get(key)
+
+    def cmd_mget(self, *keys):
+        return [self._get(key) for key in keys]
+
+    def cmd_set(self, key, value, *options):
+        options = [option.upper() if isinstance(option, bytes) else option for option in options]
+        expires = None
+        exists = self._get(key) is not None
+        i = 0
+        while i < len(options):
+            option = options[i]
+            if option in (b"EX", b"PX"):
+                amount = int(options[i + 1])
+                expires = time.monotonic() + (amount if option == b"EX" else amount / 1000)
+                i += 1
+            elif option == b"NX" and exists or option == b"XX" and not exists:
+                return None
+            elif option not in (b"NX", b"XX"):
+                raise FakeRedisError("ERR syntax error")
+            i += 1
+        self.data[key] = (value, expires)
+        return SimpleString("OK")
+
+    def cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._get(key) is not None:
+                del self.data[key]
+                deleted += 1
+        return deleted
+
+    def cmd_exists(self, *keys):
+        return sum(1 for key in keys if self._get(key) is not None)
+
+    def cmd_expire(self, key, seconds):
+        return self._expire(key, int(seconds))
+
+    def cmd_pexpire(self, key, milliseconds):
+        return self._expire(key, int(milliseconds) / 1000)
+
+    def cmd_ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        expires = self.data[key][1]
+        return -1 if expires is None else max(round(expires - time.monotonic()), 0)
+
+    def cmd_keys(self, pattern):
+        pattern = pattern.decode("utf-8")
+        return [key for key in list(self.data) if self._get(key) is not None
+                and fnmatch.fnmatchcase(key.decode("utf-8"), pattern)]
+
+    def cmd_dbsize(self):
+        return sum(1 for key in list(self.data) if self._get(key) is not None)
+
+    def cmd_flushdb(self, *args):
+        self.data.clear()
+        return SimpleString("OK")
+
+    cmd_flushall = cmd_flushdb
+
+    def stats(self):
+        return {
+            "keys": self.cmd_dbsize(),
+            "connections": self.connections,
+            "commands": self.commands,
+        }
+
+
+# Ответ +OK (в отличие от bulk-строки)
+class SimpleString(str):
+    pass
+
+
+def encode_reply(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, SimpleString):
+        return b"+%s\r\n" % reply.encode("utf-8")
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        reply = reply.encode("utf-8")
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode_reply(item) for item in reply)
+    raise TypeError(f"Нельзя закодировать ответ {reply!r}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(FakeRedis().serve_forever())
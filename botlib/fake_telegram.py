@@ -0,0 +1,518 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+logger = logging.getLogger(__name__)
+
+# Локальная замена Telegram Bot API для тестов и нагрузочных прогонов.
+# Запуск: python -m botlib.fake_telegram, затем у бота
+# TELEGRAM_API_BASE=http://127.0.0.1:8081 (токен может быть любым)
+
+# Адрес, на котором слушает сервер
+HOST = os.environ.get("FAKE_TELEGRAM_HOST", "127.0.0.1")
+PORT = int(os.environ.get("FAKE_TELEGRAM_PORT", 8081))
+
+# Задержка ответа (секунды): фиксированная часть и случайный разброс сверху
+LATENCY = float(os.environ.get("FAKE_TELEGRAM_LATENCY", 0.05))
+JITTER = float(os.environ.get("FAKE_TELEGRAM_JITTER", 0.02))
+
+# Доля вызовов, на которые сервер отвечает 429, и какой retry_after сообщает
+ERROR_429_RATE = float(os.environ.get("FAKE_TELEGRAM_429_RATE", 0))
+RETRY_AFTER = int(os.environ.get("FAKE_TELEGRAM_RETRY_AFTER", 1))
+
+# Эмуляция лимитов Telegram: сообщений в секунду на бота и в один чат (0 - не проверять)
+GLOBAL_LIMIT = int(os.environ.get("FAKE_TELEGRAM_GLOBAL_LIMIT", 0))
+CHAT_LIMIT = int(os.environ.get("FAKE_TELEGRAM_CHAT_LIMIT", 0))
+
+# Методы, на которые распространяются лимиты и случайные 429
+LIMITED_METHODS = frozenset({"sendMessage", "editMessageText", "editMessageReplyMarkup"})
+
+# Дольше этого getUpdates не ждет новых обновлений (секунды)
+MAX_POLL_TIMEOUT = 50
+
+# Сколько обновлений храним для getUpdates
+MAX_PENDING_UPDATES = 10000
+
+# Сколько одновременных запросов на вебхук (как max_connections у Telegram)
+WEBHOOK_CONNECTIONS = 40
+
+# Пользователь бота, которого возвращает getMe
+FAKE_BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Fake Bot",
+    "username": "fake_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+NOT_MODIFIED_DESCRIPTION = ("Bad Request: message is not modified: specified new message content and reply "
+                            "markup are exactly the same as a current content and reply markup of the message")
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 409: "Conflict", 429: "Too Many Requests"}
+
+
+class FakeTelegramError(Exception):
+    def __init__(self, error_code, description, retry_after=None):
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.retry_after = retry_after
+
+
+# Значение параметра из формы: сложные объекты (reply_markup и т.д.) приходят строкой JSON
+def _form_value(value):
+    if value[:1] in ("{", "["):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+# Разбор параметров вызова из строки запроса и тела (JSON или форма)
+def parse_params(query, content_type, body):
+    params = {k: _form_value(v) for k, v in urllib.parse.parse_qsl(query)}
+    if not body:
+        return params
+    if content_type.startswith("application/json"):
+        params.update(json.loads(body.decode("utf-8")))
+    elif content_type.startswith("application/x-www-form-urlencoded"):
+        params.update({k: _form_value(v) for k, v in urllib.parse.parse_qsl(body.decode("utf-8"))})
+    else:
+        raise FakeTelegramError(400, f"Bad Request: unsupported content type {content_type}")
+    return params
+
+
+# Обновление с текстовым сообщением пользователя (для нагрузочных прогонов)
+def message_update(chat_id, text, user_id=None, message_id=1):
+    user = {"id": user_id or chat_id, "is_bot": False, "first_name": "User"}
+    return {"message": {
+        "message_id": message_id,
+        "from": user,
+        "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+        "date": int(time.time()),
+        "text": text,
+        **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+           if text.startswith("/") else {}),
+    }}
+
+
+# Обновление с нажатием кнопки под сообщением бота
+def callback_update(chat_id, message_id, data, user_id=None):
+    user = {"id": user_id or chat_id, "is_bot": False, "first_name": "User"}
+    return {"callback_query": {
+        "id": str(random.getrandbits(63)),
+        "from": user,
+        "chat_instance": str(chat_id),
+        "data": data,
+        "message": {
+            "message_id": message_id,
+            "from": FAKE_BOT_USER,
+            "chat": {"id": chat_id, "type": "private", "first_name": "User"},
+            "date": int(time.time()),
+            "text": "...",
+        },
+    }}
+
+
+# Поддельный Bot API: asyncio HTTP-сервер, который хранит состояние сообщений,
+# отвечает с настраиваемой задержкой и умеет возвращать 429
+class FakeTelegram:
+    def __init__(self, host=HOST, port=PORT, latency=LATENCY, jitter=JITTER, error_429_rate=ERROR_429_RATE,
+                 retry_after=RETRY_AFTER, global_limit=GLOBAL_LIMIT, chat_limit=CHAT_LIMIT):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429_rate = error_429_rate
+        self.retry_after = retry_after
+        self.global_limit = global_limit
+        self.chat_limit = chat_limit
+
+        self.loop = None
+        self._server = None
+        self.reset()
+
+    # Сброс состояния: сообщения, обновления, вебхук и метрики
+    def reset(self):
+        # Сообщения по чатам: chat_id -> {message_id: сообщение}
+        self.chats = {}
+        # Сообщения, отправленные через inline-режим: inline_message_id -> сообщение
+        self.inline_messages = {}
+        self._next_message_id = {}
+
+        self.updates = []
+        self._next_update_id = 1
+        self._new_updates = None
+
+        self.webhook = {"url": "", "secret_token": None, "max_connections": WEBHOOK_CONNECTIONS}
+        self._webhook_slots = None
+        # Последняя ошибка доставки на вебхук: (время, описание)
+        self.webhook_error = None
+
+        # Окна лимитов: ключ -> (начало секунды, количество вызовов)
+        self._windows = {}
+
+        # Метрики
+        self.calls = {}
+        self.errors_429 = 0
+        self.not_modified = 0
+        self.webhook_deliveries = 0
+        self.webhook_failures = 0
+        self.webhook_reply_errors = 0
+
+    # Адрес для TELEGRAM_API_BASE
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._new_updates = asyncio.Condition()
+        self._webhook_slots = asyncio.Semaphore(self.webhook["max_connections"])
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Порт 0 - берем тот, что выдала система
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake Telegram Bot API слушает {self.base_url}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    # Запуск в фоновом потоке со своим event loop (для синхронных тестов и бенчмарков)
+    def start_in_thread(self):
+        started = threading.Event()
+
+        def _run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=_run, daemon=True).start()
+        started.wait()
+        return self.base_url
+
+    # Добавляем обновление: оно попадет в getUpdates или уйдет на вебхук.
+    # Можно вызывать из любого потока
+    def push_update(self, update):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if self.loop is not None and running is not self.loop:
+            self.loop.call_soon_threadsafe(self._push_update, update)
+        else:
+            self._push_update(update)
+
+    def _push_update(self, update):
+        update = {**update, "update_id": self._next_update_id}
+        self._next_update_id += 1
+        if self.webhook["url"]:
+            asyncio.ensure_future(self._deliver(update))
+            return
+        self.updates.append(update)
+        del self.updates[:-MAX_PENDING_UPDATES]
+        asyncio.ensure_future(self._notify_updates())
+
+    async def _notify_updates(self):
+        async with self._new_updates:
+            self._new_updates.notify_all()
+
+    # Доставка обновления на вебхук. Если бот ответил вызовом в теле ответа,
+    # выполняем его, как это делает Telegram
+    async def _deliver(self, update):
+        webhook = self.webhook
+        headers = {"Content-Type": "application/json"}
+        if webhook["secret_token"]:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = webhook["secret_token"]
+        request = urllib.request.Request(webhook["url"], data=json.dumps(update).encode("utf-8"), headers=headers)
+
+        def _post():
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.read()
+
+        async with self._webhook_slots:
+            try:
+                payload = await self.loop.run_in_executor(None, _post)
+                self.webhook_deliveries += 1
+            except Exception as e:
+                self.webhook_failures += 1
+                self.webhook_error = (int(time.time()), str(e))
+                # Недоставленное обновление остается в очереди (его можно забрать через getUpdates)
+                # (insort с key= есть только с Python 3.10)
+                self.updates.append(update)
+                self.updates.sort(key=lambda u: u["update_id"])
+                logger.warning(f"Не удалось доставить обновление {update['update_id']} на вебхук: {e}")
+                return
+        try:
+            reply = json.loads(payload.decode("utf-8")) if payload else {}
+        except ValueError:
+            return
+        if isinstance(reply, dict) and reply.get("method"):
+            method = reply.pop("method")
+            try:
+                self.call(method, reply)
+            except FakeTelegramError as e:
+                # Ответ на вебхук бот не видит - ошибку считаем в статистике
+                self.webhook_reply_errors += 1
+                logger.warning(f"Ошибка вызова {method} из ответа на вебхук: {e.error_code} {e.description}")
+
+    # Обработка одного HTTP-соединения (с поддержкой keep-alive)
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                http_method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+
+                status, response = await self._handle_request(http_method, target, headers, body)
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write((
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Error')}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                ).encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, http_method, target, headers, body):
+        path, _, query = target.partition("?")
+        parts = path.strip("/").split("/")
+
+        # Служебные адреса для тестов: /fake/updates, /fake/stats, /fake/reset
+        if parts[0] == "fake":
+            return self._handle_control(parts[1:], body)
+
+        if len(parts) != 2 or not parts[0].startswith("bot"):
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+        try:
+            params = parse_params(query, headers.get("content-type", ""), body)
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if parts[1] == "getUpdates":
+                result = await self.get_updates(params)
+            else:
+                result = self.call(parts[1], params)
+            return 200, {"ok": True, "result": result}
+        except FakeTelegramError as e:
+            response = {"ok": False, "error_code": e.error_code, "description": e.description}
+            if e.retry_after is not None:
+                response["parameters"] = {"retry_after": e.retry_after}
+            return e.error_code, response
+
+    def _handle_control(self, parts, body):
+        if parts == ["updates"]:
+            updates = json.loads(body.decode("utf-8")) if body else []
+            for update in updates if isinstance(updates, list) else [updates]:
+                self._push_update(update)
+            return 200, {"ok": True}
+        if parts == ["stats"]:
+            return 200, self.stats()
+        if parts == ["reset"]:
+            self.reset()
+            self._new_updates = asyncio.Condition()
+            self._webhook_slots = asyncio.Semaphore(self.webhook["max_connections"])
+            return 200, {"ok": True}
+        return 404, {"ok": False, "description": "Not Found"}
+
+    # Счетчик вызовов в текущей секунде; True - лимит превышен
+    def _over_limit(self, key, limit, now):
+        if limit <= 0:
+            return False
+        second = int(now)
+        start, count = self._windows.get(key, (second, 0))
+        if start != second:
+            start, count = second, 0
+        self._windows[key] = (start, count + 1)
+        return count >= limit
+
+    def _check_limits(self, method, params):
+        if method not in LIMITED_METHODS:
+            return
+        now = time.monotonic()
+        limited = random.random() < self.error_429_rate
+        limited = self._over_limit("global", self.global_limit, now) or limited
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            limited = self._over_limit(str(chat_id), self.chat_limit, now) or limited
+        if limited:
+            self.errors_429 += 1
+            raise FakeTelegramError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+
+    # Выполнение метода Bot API (кроме getUpdates)
+    def call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, f"_method_{method}", None)
+        if handler is None:
+            raise FakeTelegramError(404, "Not Found")
+        self._check_limits(method, params)
+        return handler(params)
+
+    def _method_getMe(self, params):
+        return FAKE_BOT_USER
+
+    def _method_setWebhook(self, params):
+        url = params.get("url") or ""
+        self.webhook_error = None
+        self.webhook = {
+            "url": url,
+            "secret_token": params.get("secret_token"),
+            "max_connections": int(params.get("max_connections") or WEBHOOK_CONNECTIONS),
+        }
+        self._webhook_slots = asyncio.Semaphore(self.webhook["max_connections"])
+        if url and str(params.get("drop_pending_updates")).lower() == "true":
+            self.updates.clear()
+        return True
+
+    def _method_deleteWebhook(self, params):
+        self.webhook = {**self.webhook, "url": "", "secret_token": None}
+        if str(params.get("drop_pending_updates")).lower() == "true":
+            self.updates.clear()
+        return True
+
+    def _method_getWebhookInfo(self, params):
+        info = {
+            "url": self.webhook["url"],
+            "has_custom_certificate": False,
+            "pending_update_count": len(self.updates),
+            "max_connections": self.webhook["max_connections"],
+        }
+        if self.webhook["url"] and self.webhook_error:
+            info["last_error_date"], info["last_error_message"] = self.webhook_error
+        return info
+
+    def _method_answerCallbackQuery(self, params):
+        if not params.get("callback_query_id"):
+            raise FakeTelegramError(400, "Bad Request: query is too old and response timeout expired or query ID is invalid")
+        return True
+
+    def _method_sendMessage(self, params):
+        chat_id = params.get("chat_id")
+        if chat_id in (None, ""):
+            raise FakeTelegramError(400, "Bad Request: chat_id is empty")
+        if not params.get("text"):
+            raise FakeTelegramError(400, "Bad Request: message text is empty")
+        key = str(chat_id)
+        message_id = self._next_message_id.get(key, 0) + 1
+        self._next_message_id[key] = message_id
+        message = {
+            "message_id": message_id,
+            "from": FAKE_BOT_USER,
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": params["text"],
+        }
+        if params.get("reply_markup"):
+            message["reply_markup"] = params["reply_markup"]
+        self.chats.setdefault(key, {})[message_id] = message
+        return message
+
+    # Сообщение, которое редактирует вызов
+    def _find_message(self, params):
+        if params.get("inline_message_id"):
+            message = self.inline_messages.get(params["inline_message_id"])
+        else:
+            message_id = params.get("message_id")
+            message = self.chats.get(str(params.get("chat_id")), {}).get(int(message_id or 0))
+        if message is None:
+            raise FakeTelegramError(400, "Bad Request: message to edit not found")
+        return message
+
+    # Применяем изменения к сообщению так же строго, как Telegram:
+    # правка без изменений - ошибка "message is not modified"
+    def _edit(self, params, text=None):
+        message = self._find_message(params)
+        markup = params.get("reply_markup")
+        new_text = message["text"] if text is None else text
+        if new_text == message["text"] and (markup or None) == message.get("reply_markup"):
+            self.not_modified += 1
+            raise FakeTelegramError(400, NOT_MODIFIED_DESCRIPTION)
+        message["text"] = new_text
+        if markup:
+            message["reply_markup"] = markup
+        else:
+            message.pop("reply_markup", None)
+        message["edit_date"] = int(time.time())
+        return True if params.get("inline_message_id") else message
+
+    def _method_editMessageText(self, params):
+        if not params.get("text"):
+            raise FakeTelegramError(400, "Bad Request: message text is empty")
+        return self._edit(params, params["text"])
+
+    def _method_editMessageReplyMarkup(self, params):
+        return self._edit(params)
+
+    # getUpdates с длинным опросом: offset подтверждает обработанные обновления
+    async def get_updates(self, params):
+        self.calls["getUpdates"] = self.calls.get("getUpdates", 0) + 1
+        if self.webhook["url"]:
+            raise FakeTelegramError(409, "Conflict: can't use getUpdates method while webhook is active; "
+                                         "use deleteWebhook to delete the webhook first")
+        offset = int(params.get("offset") or 0)
+        limit = min(max(int(params.get("limit") or 100), 1), 100)
+        timeout = min(float(params.get("timeout") or 0), MAX_POLL_TIMEOUT)
+        if offset:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+
+        if not self.updates and timeout > 0:
+            async with self._new_updates:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        return self.updates[:limit]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors_429": self.errors_429,
+            "not_modified": self.not_modified,
+            "messages": sum(len(messages) for messages in self.chats.values()),
+            "pending_updates": len(self.updates),
+            "webhook_url": self.webhook["url"],
+            "webhook_deliveries": self.webhook_deliveries,
+            "webhook_failures": self.webhook_failures,
+            "webhook_reply_errors": self.webhook_reply_errors,
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(FakeTelegram().serve_forever())
@@ -0,0 +1,425 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from botlib.edits import (
+    NOT_MODIFIED_ERROR,
+    RENDER_MARKUP_ONLY,
+    RENDER_UNCHANGED,
+    EditCoalescer,
+    RenderCache,
+    edit_key,
+    markup_only_params,
+    message_key,
+)
+from botlib.retry import RetryPolicy
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота
+# и около 1 сообщения в секунду в один чат (короткие всплески допустимы)
+GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30))
+GLOBAL_BURST = int(os.environ.get("TELEGRAM_GLOBAL_BURST", 30))
+CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", 3))
+
+# Методы, на которые распространяются лимиты (остальные вызовы не ограничиваем)
+PACED_METHODS = frozenset({
+    "sendMessage",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "answerCallbackQuery",
+})
+
+# При каком количестве корзин чатов чистим неактивные
+CHAT_BUCKETS_PRUNE_SIZE = 10000
+
+# Сколько секунд запроса вебхука могут занять ожидания исходящих вызовов
+# (maxDuration функции в vercel.json - 10 секунд, оставляем запас на ответ)
+REQUEST_DEADLINE = float(os.environ.get("TELEGRAM_REQUEST_DEADLINE", 8))
+
+# Крайний срок текущего запроса по time.monotonic() или None - без срока
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+# Все ожидания исходящих вызовов внутри блока укладываются в seconds секунд:
+# ожидание лимита, которое не успевает, - DeadlineExceeded, а повтор, который
+# не успевает, не делается (возвращается последний ответ Telegram)
+@contextmanager
+def request_deadline(seconds=REQUEST_DEADLINE):
+    token = _request_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+
+# Вызов не успевает дождаться слота в лимитере до срока запроса
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# Корзина токенов в форме GCRA: вместо счетчика токенов храним
+# "теоретическое время прибытия" следующего сообщения. Резервирование
+# возвращает момент, когда сообщение можно отправить, поэтому
+# ожидающие вызовы выстраиваются в очередь без отдельного потока
+class TokenBucket:
+    __slots__ = ("interval", "tolerance", "tat")
+
+    def __init__(self, rate, burst=1):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (max(burst, 1) - 1)
+        self.tat = 0.0
+
+    # Резервируем слот не раньше earliest, возвращаем время отправки
+    def reserve(self, earliest):
+        tat = max(self.tat, earliest)
+        send_at = max(earliest, tat - self.tolerance)
+        self.tat = tat + self.interval
+        return send_at
+
+    # Корзина "пустая" - в ней нет зарезервированных слотов
+    def idle(self, now):
+        return self.tat <= now
+
+
+# Планировщик исходящих вызовов с общей корзиной на бота и корзиной на чат.
+# Один экземпляр на процесс, работает и из потоков, и из asyncio
+class RateLimiter:
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self._lock = threading.Lock()
+
+        # Метрики для оценки нагрузки
+        self.pauses_chat = 0
+        self.pauses_global = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.reserved = 0
+        self.delayed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    # Резервируем слот для вызова, возвращаем сколько секунд ждать
+    def reserve(self, chat_id=None):
+        now = time.monotonic()
+        with self._lock:
+            send_at = now
+            if chat_id is not None:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    if len(self.chat_buckets) >= CHAT_BUCKETS_PRUNE_SIZE:
+                        self._prune(now)
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                send_at = bucket.reserve(send_at)
+            send_at = self.global_bucket.reserve(send_at)
+
+            delay = send_at - now
+            self.reserved += 1
+            if delay > 0:
+                self.delayed += 1
+                self.wait_time_total += delay
+                self.wait_time_max = max(self.wait_time_max, delay)
+            return delay
+
+    # Приостанавливаем отправку в чат (или всю очередь, если chat_id не задан)
+    # на seconds секунд - например, после ответа 429 с retry_after
+    def pause(self, chat_id, seconds):
+        now = time.monotonic()
+        with self._lock:
+            if chat_id is None:
+                bucket = self.global_bucket
+                self.pauses_global += 1
+            else:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                self.pauses_chat += 1
+            bucket.tat = max(bucket.tat, now + seconds + bucket.tolerance)
+
+    # Удаляем корзины чатов, в которых нет зарезервированных слотов
+    def _prune(self, now):
+        for chat_id in [c for c, b in self.chat_buckets.items() if b.idle(now)]:
+            del self.chat_buckets[chat_id]
+
+    def _enter_wait(self):
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def _leave_wait(self):
+        with self._lock:
+            self.waiting -= 1
+
+    # Блокирующее ожидание зарезервированного слота (для синхронных обработчиков)
+    def wait(self, delay):
+        self._enter_wait()
+        try:
+            time.sleep(delay)
+        finally:
+            self._leave_wait()
+
+    # Асинхронное ожидание зарезервированного слота
+    async def wait_async(self, delay):
+        self._enter_wait()
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._leave_wait()
+
+    # Резервирование и ожидание слота
+    def acquire(self, chat_id=None):
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            self.wait(delay)
+
+    async def acquire_async(self, chat_id=None):
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            await self.wait_async(delay)
+
+    # Метрики: глубина очереди и время ожидания
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.waiting,
+                "max_queue_depth": self.max_waiting,
+                "reserved": self.reserved,
+                "delayed": self.delayed,
+                "wait_time_total": round(self.wait_time_total, 3),
+                "wait_time_max": round(self.wait_time_max, 3),
+                "wait_time_avg": round(self.wait_time_total / self.delayed, 3) if self.delayed else 0.0,
+                "chats_tracked": len(self.chat_buckets),
+                "pauses_chat": self.pauses_chat,
+                "pauses_global": self.pauses_global,
+            }
+
+
+# Шаги конвейера, которые выполняют send и send_async
+_PACE = "pace"    # ожидание слота в лимитере (секунды)
+_SLEEP = "sleep"  # пауза перед повтором (секунды)
+_CALL = "call"    # вызов транспорта (метод, параметры)
+
+
+# Ответ для редактирования, которое не ушло в Telegram, потому что его заменила
+# более новая версия или оно ничего не меняет (Telegram на успешное редактирование отвечает так же)
+SKIPPED_RESPONSE = {"ok": True, "result": True}
+
+
+# Конвейер исходящих вызовов Bot API. Транспорт (http.client,
+# python-telegram-bot или aiogram) передается вызывающей стороной,
+# конвейер отвечает за то, когда, что и сколько раз уйдет в Telegram.
+# Транспорт возвращает ответ Telegram в виде словаря ({"ok": ..., ...}),
+# а при сетевой ошибке выбрасывает исключение. Метод и параметры,
+# переданные транспорту, могут отличаться от исходных (склейка редактирований)
+class Outbound:
+    def __init__(self, limiter=None, retry=None, coalescer=None, renders=None):
+        self.limiter = limiter or RateLimiter()
+        self.retry = retry or RetryPolicy()
+        self.coalescer = coalescer or EditCoalescer()
+        self.renders = renders or RenderCache()
+
+        # Сколько вызовов не дождались слота или повтора до срока запроса
+        self.deadline_exceeded = 0
+
+    # Сравниваем редактирование с последней отрисовкой сообщения.
+    # Возвращает None, если оно ничего не меняет, иначе (метод, параметры):
+    # если текст тот же и изменилась только клавиатура - editMessageReplyMarkup
+    def _plan_edit(self, key, method, params):
+        diff = self.renders.compare(key, method, params)
+        if diff == RENDER_UNCHANGED:
+            self.renders.hits += 1
+            return None
+        if diff == RENDER_MARKUP_ONLY and method == "editMessageText":
+            self.renders.markup_only += 1
+            return "editMessageReplyMarkup", markup_only_params(params)
+        return method, params
+
+    # Запоминаем отрисовку сообщения, которую принял Telegram
+    def _remember_render(self, key, method, params, response):
+        if response is None:
+            return
+        if response.get("ok"):
+            result = response.get("result")
+            if key is None and method == "sendMessage" and isinstance(result, dict):
+                key = message_key(result["chat"]["id"], result["message_id"])
+                method = "editMessageText"
+            if key is not None:
+                self.renders.remember(key, method, params)
+        elif key is not None and NOT_MODIFIED_ERROR in str(response.get("description", "")):
+            self.renders.remember(key, method, params)
+
+    # Подготовка вызова, который уходит в теле ответа на вебхук (мимо конвейера):
+    # возвращает (метод, параметры) или None, если редактирование ничего не изменит.
+    # Примет ли Telegram вызов из тела ответа, неизвестно, поэтому отрисовку
+    # не запоминаем, а прежнюю забываем - следующее редактирование уйдет целиком
+    def prepare_inline(self, method, params):
+        key = edit_key(method, params)
+        if key is None:
+            return method, params
+        if self.coalescer.busy(key):
+            plan = method, params
+        else:
+            plan = self._plan_edit(key, method, params)
+        if plan is not None:
+            self.renders.forget(key)
+        return plan
+
+    # Разбор результата попытки: возвращает задержку перед повтором или None.
+    # На 429 приостанавливаем чат, а для вызовов без чата - всю очередь
+    def _after_attempt(self, chat_id, attempt, response, error):
+        delay, retry_after = self.retry.next_delay(attempt, response, error)
+        if retry_after is not None:
+            self.limiter.pause(chat_id, float(retry_after))
+        return delay
+
+    # Не успевает ли ожидание delay до срока запроса
+    def _past_deadline(self, deadline, delay):
+        if deadline is None or time.monotonic() + delay <= deadline:
+            return False
+        self.deadline_exceeded += 1
+        return True
+
+    # Общая часть send и send_async: пропуск и склейка редактирований, лимиты,
+    # повторы и учет отрисовок. Генератор отдает шаги (_PACE или _SLEEP, секунды)
+    # и (_CALL, (метод, параметры)), получает результат вызова (ответ, ошибка),
+    # а ответ конвейера возвращает через StopIteration
+    def _pipeline(self, method, params, deadline):
+        paced = method in PACED_METHODS
+        # Лимит чата действует и на редактирования; у answerCallbackQuery нет
+        # chat_id - это не сообщение в чат, ему достаточно общей корзины
+        chat_id = (params or {}).get("chat_id")
+        key = edit_key(method, params)
+        if key and not self.coalescer.busy(key) and self._plan_edit(key, method, params) is None:
+            return SKIPPED_RESPONSE
+        seq = self.coalescer.submit(key, method, params) if key else None
+        owned = False
+        self.retry.budget.deposit()
+
+        # Ответ (или ошибка) на собственную версию вызова
+        result = None
+        try:
+            attempt = 0
+            while True:
+                if paced:
+                    delay = self.limiter.reserve(chat_id)
+                    if delay > 0:
+                        if self._past_deadline(deadline, delay):
+                            raise DeadlineExceeded(f"{method}: слот через {delay:.1f} с, позже срока запроса")
+                        yield _PACE, delay
+                plan = method, params
+                if key:
+                    claimed = self.coalescer.claim(key, seq, owned)
+                    if claimed is None:
+                        return SKIPPED_RESPONSE
+                    seq, method, params = claimed[0], claimed[1] or method, claimed[2] or params
+                    owned = True
+                    plan = self._plan_edit(key, method, params) if attempt == 0 else (method, params)
+
+                if plan is None:
+                    # Версия ничего не меняет - в Telegram не отправляем
+                    response, error, delay = SKIPPED_RESPONSE, None, None
+                else:
+                    method, params = plan
+                    response, error = yield _CALL, plan
+                    delay = self._after_attempt(chat_id, attempt, response, error)
+                    if delay is not None and self._past_deadline(deadline, delay):
+                        delay = None
+
+                if delay is None:
+                    if error is None:
+                        self._remember_render(key, method, params, response)
+                    if result is None:
+                        result = response, error
+                    if key:
+                        # Версию, пришедшую, пока эта была в полете, отправляет тот же владелец
+                        handoff = self.coalescer.done(key, seq)
+                        if handoff is not None:
+                            seq, method, params = handoff
+                            attempt = 0
+                            continue
+                        owned = False
+                    response, error = result
+                    if error is not None:
+                        raise error
+                    return response
+                # После 429 ожидание обеспечивает пауза в лимитере
+                if not paced or response is None or response.get("error_code") != 429:
+                    yield _SLEEP, delay
+                attempt += 1
+        finally:
+            if owned:
+                self.coalescer.release(key, seq)
+
+    # Синхронная отправка: transport(method, params) выполняет сам вызов.
+    # deadline - срок по time.monotonic() (по умолчанию - из request_deadline)
+    def send(self, method, params, transport, deadline=None):
+        steps = self._pipeline(method, params, deadline or _request_deadline.get())
+        try:
+            result = None
+            while True:
+                step, arg = steps.send(result)
+                result = None
+                if step == _PACE:
+                    self.limiter.wait(arg)
+                elif step == _SLEEP:
+                    time.sleep(arg)
+                else:
+                    try:
+                        result = transport(*arg), None
+                    except Exception as e:
+                        result = None, e
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+    # Асинхронная отправка: transport(method, params) - корутина
+    async def send_async(self, method, params, transport, deadline=None):
+        steps = self._pipeline(method, params, deadline or _request_deadline.get())
+        try:
+            result = None
+            while True:
+                step, arg = steps.send(result)
+                result = None
+                if step == _PACE:
+                    await self.limiter.wait_async(arg)
+                elif step == _SLEEP:
+                    await asyncio.sleep(arg)
+                else:
+                    try:
+                        result = await transport(*arg), None
+                    except Exception as e:
+                        result = None, e
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close()
+
+    def stats(self):
+        return {
+            "rate_limiter": self.limiter.stats(),
+            "retry": self.retry.stats(),
+            "edits": self.coalescer.stats(),
+            "render_cache": self.renders.stats(),
+            "deadline_exceeded": self.deadline_exceeded,
+        }
+
+
+# Общий конвейер процесса: лимиты Telegram действуют на бота целиком,
+# поэтому все модули должны ходить через один экземпляр
+_default_outbound = None
+_default_lock = threading.Lock()
+
+
+def get_outbound():
+    global _default_outbound
+    with _default_lock:
+        if _default_outbound is None:
+            _default_outbound = Outbound()
+        return _default_outbound
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Режим получения обновлений:
+# webhook - только вебхук (как раньше), polling - только getUpdates,
+# auto - вебхук, а при ошибках доставки переключаемся на getUpdates и обратно
+UPDATES_MODE = os.environ.get("UPDATES_MODE", "webhook").lower()
+
+# Сколько обновлений забираем за один getUpdates (максимум Telegram - 100)
+POLL_LIMIT = 100
+
+# Сколько секунд Telegram держит getUpdates открытым, если обновлений нет
+POLL_TIMEOUT = int(os.environ.get("UPDATES_POLL_TIMEOUT", 30))
+
+# Пауза после ошибки getUpdates (секунды)
+POLL_ERROR_DELAY = 5.0
+
+# Как часто проверяем getWebhookInfo в режиме вебхука (секунды)
+WEBHOOK_CHECK_INTERVAL = float(os.environ.get("WEBHOOK_CHECK_INTERVAL", 60))
+
+# Через сколько секунд опроса снова пробуем вернуться на вебхук
+WEBHOOK_RETRY_INTERVAL = float(os.environ.get("WEBHOOK_RETRY_INTERVAL", 300))
+
+
+# Вызов Bot API через синхронный TelegramClient из event loop:
+# таймаут запроса увеличиваем на время длинного опроса
+def client_call(client):
+    async def call(method, params=None):
+        timeout = client.timeout + (params or {}).get("timeout", 0)
+        return await asyncio.to_thread(client.call, method, params, timeout)
+    return call
+
+
+# Получение обновлений через getUpdates пачками до POLL_LIMIT.
+# Пачка обрабатывается параллельно (порядок по пользователю обеспечивает dispatch),
+# offset сдвигается только после обработки всей пачки: если процесс упадет
+# посреди пачки, Telegram отдаст ее заново
+class UpdatePoller:
+    def __init__(self, call, dispatch, limit=POLL_LIMIT, timeout=POLL_TIMEOUT):
+        self.call = call
+        self.dispatch = dispatch
+        self.limit = limit
+        self.timeout = timeout
+        self.offset = 0
+
+        # Метрики
+        self.batches = 0
+        self.updates = 0
+        self.failed = 0
+        self.errors = 0
+        self.max_batch = 0
+
+    # Один getUpdates и обработка полученной пачки; возвращает размер пачки
+    async def poll_once(self):
+        updates = await self.call("getUpdates", {
+            "offset": self.offset,
+            "limit": self.limit,
+            "timeout": self.timeout,
+        })
+        if not updates:
+            return 0
+
+        results = await asyncio.gather(*(self.dispatch(update) for update in updates), return_exceptions=True)
+        for update, result in zip(updates, results):
+            if isinstance(result, Exception):
+                self.failed += 1
+                logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {result}")
+
+        # Подтверждаем пачку: следующий getUpdates начнется после нее
+        self.offset = updates[-1]["update_id"] + 1
+        self.batches += 1
+        self.updates += len(updates)
+        self.max_batch = max(self.max_batch, len(updates))
+        return len(updates)
+
+    async def run(self, stop=None):
+        while stop is None or not stop.is_set():
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+
+    def stats(self):
+        return {
+            "offset": self.offset,
+            "batches": self.batches,
+            "updates": self.updates,
+            "failed": self.failed,
+            "errors": self.errors,
+            "max_batch": self.max_batch,
+        }
+
+
+# Выбор способа получения обновлений и автоматическое переключение
+# между вебхуком и getUpdates по данным getWebhookInfo
+class UpdateIngestion:
+    def __init__(self, call, dispatch, webhook_url=None, mode=UPDATES_MODE,
+                 check_interval=WEBHOOK_CHECK_INTERVAL, retry_interval=WEBHOOK_RETRY_INTERVAL):
+        self.call = call
+        self.webhook_url = webhook_url
+        self.mode = mode
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.poller = UpdatePoller(call, dispatch)
+
+        # Текущий способ: "webhook" или "polling"
+        self.active = None
+        self.switched_at = 0.0
+        self.failovers = 0
+
+    # Вебхук не доставляет обновления: недавняя ошибка доставки и очередь не пуста
+    def webhook_failing(self, info):
+        last_error = info.get("last_error_date")
+        if not last_error or not info.get("pending_update_count"):
+            return False
+        return time.time() - last_error < self.check_interval * 2
+
+    async def use_webhook(self):
+        # Подтверждаем последнюю пачку, иначе Telegram доставит ее на вебхук повторно
+        if self.active == "polling" and self.poller.offset:
+            await self.call("getUpdates", {"offset": self.poller.offset, "limit": 1, "timeout": 0})
+        await self.call("setWebhook", {"url": self.webhook_url})
+        self.active = "webhook"
+        self.switched_at = time.monotonic()
+        logger.info(f"Обновления получаем через вебхук {self.webhook_url}")
+
+    async def use_polling(self):
+        # Пока установлен вебхук, getUpdates отвечает 409 Conflict
+        # (накопившиеся обновления не сбрасываем - их заберет getUpdates)
+        await self.call("deleteWebhook")
+        self.active = "polling"
+        self.switched_at = time.monotonic()
+        logger.info("Обновления получаем через getUpdates")
+
+    async def run(self, stop=None):
+        if self.mode == "polling" or not self.webhook_url:
+            await self.use_polling()
+            await self.poller.run(stop)
+            return
+
+        await self.use_webhook()
+        if self.mode != "auto":
+            return
+
+        while stop is None or not stop.is_set():
+            try:
+                if self.active == "webhook":
+                    await asyncio.sleep(self.check_interval)
+                    info = await self.call("getWebhookInfo")
+                    if self.webhook_failing(info):
+                        logger.warning(f"Вебхук не доставляет обновления ({info.get('last_error_message')}), "
+                                       f"переключаемся на getUpdates")
+                        self.failovers += 1
+                        await self.use_polling()
+                elif time.monotonic() - self.switched_at >= self.retry_interval:
+                    await self.use_webhook()
+                else:
+                    await self.poller.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при получении обновлений ({self.active}): {e}")
+                await asyncio.sleep(POLL_ERROR_DELAY)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "active": self.active,
+            "failovers": self.failovers,
+            "polling": self.poller.stats(),
+        }
@@ -0,0 +1,158 @@
+import logging
+import os
+
+import numpy as np
+
+from botlib.catalog import EQUIPMENT_SETS, CatalogError, load_catalog_data
+
+logger = logging.getLogger(__name__)
+
+# Услуги, из которых по умолчанию составляются пакеты матрицы цен: услуги
+# калькулятора, опуск насоса и монтаж кабеля, которые считаются за метр глубины
+PRICE_MATRIX_SERVICES = (
+    "Монтаж кессона",
+    "Монтаж систем автоматики",
+    "Транспортные расходы",
+    "Анализ воды",
+    "Монтаж гидроаккумулятора",
+    "Опуск насоса в скважину (за метр)",
+    "Монтаж кабеля (за метр)",
+)
+
+# Пакеты услуг - все подмножества списка, поэтому их 2^n; ограничиваем n
+PRICE_MATRIX_MAX_SERVICES = int(os.environ.get("PRICE_MATRIX_MAX_SERVICES", 10))
+
+# Первый "набор" оборудования матрицы - без оборудования
+NO_EQUIPMENT = "Без оборудования"
+
+
+# Компоненты наборов оборудования, длина которых равна глубине скважины, и
+# позиции каталога с их ценой за метр. В EQUIPMENT_SETS у них цена готового
+# отрезка, поэтому в матрице она заменяется ценой за метр, умноженной на глубину.
+# Труба PPR в наборах - короткий отрезок внутри кессона, ее цена постоянная
+EQUIPMENT_SET_PER_METER = {
+    "кабель": "Кабель 3*1.5 подводный (за метр)",
+    "трос": "Трос 3 мм (за метр)",
+    "труба ПНД Ø32": "Труба ПНД Ø32 (за метр)",
+}
+
+
+# Услуга, цена которой указана за метр глубины ("Опуск насоса в скважину (за метр)")
+def per_meter(name):
+    return "за метр" in name
+
+
+# Матрица цен: район x глубина x набор оборудования x пакет услуг.
+# Стоимость раскладывается на независимые слагаемые - бурение (район x глубина),
+# оборудование (глубина x набор) и услуги (глубина x пакет), - и каждое считается
+# одной векторной операцией; цена ячейки - их сумма через broadcasting.
+# Услуги "за метр" и компоненты наборов из EQUIPMENT_SET_PER_METER умножаются
+# на глубину, на глубине больше filter_min_depth
+# добавляется фильтр на песок, как в calculateDrillingCost из drilling-data.ts.
+# Номер пакета услуг - битовая маска услуг (как Session.services)
+class PriceMatrix:
+    def __init__(self, catalog_data, equipment_sets=EQUIPMENT_SETS, services=PRICE_MATRIX_SERVICES,
+                 set_per_meter=EQUIPMENT_SET_PER_METER):
+        if len(services) > PRICE_MATRIX_MAX_SERVICES:
+            raise CatalogError(f"Слишком много услуг для пакетов: {len(services)} > {PRICE_MATRIX_MAX_SERVICES}")
+        unknown = [name for name in services if name not in catalog_data.service_index]
+        if unknown:
+            raise CatalogError(f"Нет в каталоге услуг: {unknown}")
+        unknown = [name for name in set_per_meter.values() if name not in catalog_data.equipment_index]
+        if unknown:
+            raise CatalogError(f"Нет в каталоге оборудования: {unknown}")
+        # Без компонентов за метр цена оборудования не зависела бы от глубины
+        if not any(name in set_per_meter for components in equipment_sets.values() for name in components):
+            raise CatalogError("Ни один компонент наборов оборудования не считается за метр")
+
+        self.version = catalog_data.version
+        self.districts = catalog_data.districts
+        self.equipment_sets = (NO_EQUIPMENT,) + tuple(equipment_sets)
+        self.services = tuple(services)
+
+        # Ось глубин - все глубины всех районов; offered[район, глубина] - есть ли
+        # такая глубина у района (у районов без данных глубин нет)
+        all_depths = sorted({depth for depths in catalog_data.depths for depth in depths})
+        self.depths = np.array(all_depths, dtype=np.int64)
+        depth_index = {depth: i for i, depth in enumerate(all_depths)}
+        self.offered = np.zeros((len(self.districts), len(self.depths)), dtype=bool)
+        for district, depths in enumerate(catalog_data.depths):
+            self.offered[district, [depth_index[depth] for depth in depths]] = True
+
+        # Бурение: цена за метр по районам (пока у всех базовая) и доплата за фильтр
+        cost_per_meter = np.full(len(self.districts), catalog_data.base_drilling_cost, dtype=np.int64)
+        surcharge = np.where(self.depths > catalog_data.filter_min_depth, catalog_data.filter_cost, 0)
+        self.drilling = cost_per_meter[:, None] * self.depths[None, :] + surcharge[None, :]
+
+        # Оборудование: постоянная часть и часть за метр каждого набора
+        set_fixed = np.zeros(len(self.equipment_sets), dtype=np.int64)
+        set_meter_prices = np.zeros(len(self.equipment_sets), dtype=np.int64)
+        meter_prices = catalog_data.equipment_price_map(set_per_meter.values())
+        for i, components in enumerate(equipment_sets.values(), 1):
+            for name, price in components.items():
+                if name in set_per_meter:
+                    set_meter_prices[i] += meter_prices[set_per_meter[name]]
+                else:
+                    set_fixed[i] += price
+        self.equipment = set_fixed[None, :] + self.depths[:, None] * set_meter_prices[None, :]
+
+        # Услуги: матрица вхождения услуг в пакеты (пакет = битовая маска), затем
+        # постоянная часть и часть за метр каждого пакета - одно умножение матриц
+        prices = np.array([catalog_data.service_prices[catalog_data.service_index[name]] for name in services],
+                          dtype=np.int64)
+        meters = np.array([per_meter(name) for name in services], dtype=bool)
+        bundles = np.arange(1 << len(services), dtype=np.int64)
+        membership = (bundles[:, None] >> np.arange(len(services))[None, :]) & 1
+        bundle_fixed = membership @ np.where(meters, 0, prices)
+        bundle_per_meter = membership @ np.where(meters, prices, 0)
+        self.service_bundles = self.depths[:, None] * bundle_per_meter[None, :] + bundle_fixed[None, :]
+
+    @property
+    def shape(self):
+        return len(self.districts), len(self.depths), len(self.equipment_sets), self.service_bundles.shape[1]
+
+    # Срез матрицы по номерам на каждой оси (None - вся ось). Считается только
+    # выбранная часть: четырехмерный массив цен собирается одним сложением.
+    # Для глубин, которых нет у района, цена -1
+    def prices(self, districts=None, depths=None, equipment_sets=None, bundles=None):
+        districts = np.arange(self.shape[0]) if districts is None else np.asarray(districts, dtype=np.int64)
+        depths = np.arange(self.shape[1]) if depths is None else np.asarray(depths, dtype=np.int64)
+        equipment_sets = np.arange(self.shape[2]) if equipment_sets is None else np.asarray(equipment_sets, dtype=np.int64)
+        bundles = np.arange(self.shape[3]) if bundles is None else np.asarray(bundles, dtype=np.int64)
+
+        drilling = self.drilling[np.ix_(districts, depths)]
+        equipment = self.equipment[np.ix_(depths, equipment_sets)]
+        services = self.service_bundles[np.ix_(depths, bundles)]
+        total = drilling[:, :, None, None] + equipment[None, :, :, None] + services[None, :, None, :]
+
+        offered = self.offered[np.ix_(districts, depths)]
+        total[~offered] = -1
+        return total
+
+    # Названия услуг пакета
+    def bundle_services(self, bundle):
+        return [name for i, name in enumerate(self.services) if bundle >> i & 1]
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "shape": list(self.shape),
+            "cells": int(np.prod(self.shape)),
+            "offered_pairs": int(self.offered.sum()),
+        }
+
+
+_price_matrices = {}
+
+
+# Матрица для версии артефакта каталога строится один раз на процесс.
+# Матрицу с другим списком услуг не кэшируем: список приходит из запроса
+def get_price_matrix(services=PRICE_MATRIX_SERVICES):
+    catalog_data = load_catalog_data()
+    if tuple(services) != PRICE_MATRIX_SERVICES:
+        return PriceMatrix(catalog_data, services=services)
+    matrix = _price_matrices.get(catalog_data.version)
+    if matrix is None:
+        matrix = _price_matrices[catalog_data.version] = PriceMatrix(catalog_data)
+        logger.info(f"Построена матрица цен {matrix.shape} для каталога версии {catalog_data.version}")
+    return matrix
@@ -0,0 +1,41 @@
+import json
+
+from telegram.request import HTTPXRequest, RequestData
+from telegram.request._requestparameter import RequestParameter
+
+from botlib.outbound import get_outbound
+from botlib.telegram_client import API_BASE
+
+# Адреса Bot API в формате python-telegram-bot (Bot(base_url=..., base_file_url=...))
+PTB_BASE_URL = f"{API_BASE}/bot"
+PTB_BASE_FILE_URL = f"{API_BASE}/file/bot"
+
+
+# Транспорт python-telegram-bot, пропускающий все вызовы через общий
+# конвейер исходящих запросов (лимиты Telegram, повторы и т.д.)
+class PacedRequest(HTTPXRequest):
+    def __init__(self, *args, outbound=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = outbound or get_outbound()
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+
+        async def transport(_method, _params):
+            # Конвейер мог заменить вызов более свежей версией - собираем запрос заново
+            call_url, call_data = url, request_data
+            if _method != api_method or _params is not params:
+                call_url = f"{url.rsplit('/', 1)[0]}/{_method}"
+                call_data = RequestData([RequestParameter.from_input(k, v) for k, v in _params.items()])
+            code, payload = await HTTPXRequest.do_request(self, call_url, method, call_data, **kwargs)
+            try:
+                return json.loads(payload.decode("utf-8"))
+            except ValueError:
+                return {"ok": False, "error_code": code, "description": payload[:200].decode("utf-8", "replace")}
+
+        response = await self.outbound.send_async(api_method, params, transport)
+
+        # python-telegram-bot сам разбирает ответ и выбирает исключение по коду
+        code = 200 if response.get("ok") else response.get("error_code") or 500
+        return code, json.dumps(response).encode("utf-8")
@@ -0,0 +1,146 @@
+import logging
+import socket
+import threading
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# Таймаут соединения и ответа сервера (секунды)
+RESP_TIMEOUT = 5.0
+
+
+# Ошибка, которую вернул сервер (-ERR ...)
+class RespError(Exception):
+    pass
+
+
+# Команда в формате RESP: массив bulk-строк
+def encode_command(args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode("utf-8")
+        elif isinstance(arg, (int, float)):
+            arg = str(arg).encode("ascii")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+# Чтение одного ответа RESP из файла сокета.
+# Ошибку сервера возвращаем как RespError, а не выбрасываем: в конвейере
+# ошибка одной команды не должна терять ответы остальных
+def read_reply(stream):
+    line = stream.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Соединение с сервером RESP закрыто")
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload.decode("utf-8")
+    if prefix == b"-":
+        return RespError(payload.decode("utf-8"))
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError("Соединение с сервером RESP закрыто")
+        return data[:-2]
+    if prefix == b"*":
+        count = int(payload)
+        if count < 0:
+            return None
+        return [read_reply(stream) for _ in range(count)]
+    raise ConnectionError(f"Неожиданный ответ сервера RESP: {line[:32]!r}")
+
+
+# Минимальный синхронный клиент Redis (протокол RESP) без внешних зависимостей.
+# Одно соединение на клиента; команды конвейера уходят одним пакетом,
+# а ответы читаются подряд - вся пачка стоит один сетевой round trip.
+# Адрес: redis://[:пароль@]хост[:порт][/номер базы]
+class RespClient:
+    def __init__(self, url, timeout=RESP_TIMEOUT):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._sock = None
+        self._stream = None
+
+        # Метрики
+        self.round_trips = 0
+        self.commands = 0
+        self.reconnects = 0
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock = sock
+        self._stream = sock.makefile("rb")
+
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            self._send(setup)
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._stream.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._stream = None
+
+    def _send(self, commands):
+        self._sock.sendall(b"".join(encode_command(command) for command in commands))
+        replies = [read_reply(self._stream) for _ in commands]
+        self.round_trips += 1
+        self.commands += len(commands)
+        for reply in replies:
+            if isinstance(reply, RespError) and str(reply).startswith(("NOAUTH", "WRONGPASS")):
+                raise reply
+        return replies
+
+    # Выполняем команды одним пакетом; ответ на каждую (ошибки - RespError в списке).
+    # При обрыве соединения пачка повторяется один раз на новом соединении
+    def pipeline(self, commands):
+        if not commands:
+            return []
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(commands)
+                except (OSError, ConnectionError) as e:
+                    self.close()
+                    if attempt:
+                        raise
+                    self.reconnects += 1
+                    logger.warning(f"Соединение с {self.host}:{self.port} прервано ({e}), переподключаемся")
+
+    # Одна команда; ошибку сервера выбрасываем
+    def execute(self, *args):
+        reply = self.pipeline([args])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def stats(self):
+        return {
+            "server": f"{self.host}:{self.port}/{self.db}",
+            "round_trips": self.round_trips,
+            "commands": self.commands,
+            "reconnects": self.reconnects,
+        }
@@ -0,0 +1,119 @@
+import os
+import random
+import threading
+import time
+
+# Сколько раз всего пробуем выполнить один вызов (первая попытка + повторы)
+MAX_ATTEMPTS = int(os.environ.get("TELEGRAM_RETRY_ATTEMPTS", 4))
+
+# Экспоненциальная задержка для 5xx и сетевых ошибок (секунды)
+BASE_DELAY = 0.5
+MAX_DELAY = 10.0
+
+# Дольше этого ждать retry_after не имеет смысла - вызов отбрасываем
+MAX_RETRY_AFTER = float(os.environ.get("TELEGRAM_MAX_RETRY_AFTER", 60))
+
+# Бюджет повторов на процесс: каждый исходный вызов добавляет RETRY_RATIO
+# токена, каждый повтор тратит один. Так при падении Telegram повторы
+# добавляют не больше ~20% к обычному трафику и не раздувают аварию
+RETRY_RATIO = 0.2
+RETRY_MIN_PER_SECOND = 1.0
+RETRY_BUDGET_CAP = 50.0
+
+
+# Общий для процесса бюджет повторов
+class RetryBudget:
+    def __init__(self, ratio=RETRY_RATIO, min_per_second=RETRY_MIN_PER_SECOND, cap=RETRY_BUDGET_CAP):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.cap = cap
+        self.tokens = cap
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.cap, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    # Учитываем исходный вызов
+    def deposit(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    # Пытаемся потратить токен на повтор
+    def withdraw(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+# Политика повторов вызовов Bot API:
+# - 429: ждем parameters.retry_after и приостанавливаем чат (или всю очередь)
+# - 5xx и сетевые ошибки: экспоненциальная задержка со случайным разбросом
+# - остальные ошибки (400, 403 и т.д.) не повторяем
+class RetryPolicy:
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 max_retry_after=MAX_RETRY_AFTER, budget=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget or RetryBudget()
+
+        # Метрики
+        self.retries = 0
+        self.retries_429 = 0
+        self.retries_5xx = 0
+        self.retries_network = 0
+        self.gave_up = 0
+        self.budget_exhausted = 0
+
+    # Задержка перед повтором номер attempt (с нуля), "full jitter"
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # Разбираем результат попытки. Возвращает (задержка, retry_after):
+    # задержка None - повторять не нужно (успех, неповторяемая ошибка или бюджет исчерпан),
+    # retry_after не None - Telegram просил подождать (429)
+    def next_delay(self, attempt, response=None, error=None):
+        retry_after = None
+        if error is None:
+            if response is None or response.get("ok"):
+                return None, None
+            error_code = response.get("error_code")
+            retry_after = (response.get("parameters") or {}).get("retry_after")
+            if retry_after is None and not (error_code and error_code >= 500):
+                return None, None
+
+        if attempt + 1 >= self.max_attempts or (retry_after or 0) > self.max_retry_after:
+            self.gave_up += 1
+            return None, retry_after
+        if not self.budget.withdraw():
+            self.budget_exhausted += 1
+            self.gave_up += 1
+            return None, retry_after
+
+        self.retries += 1
+        if retry_after is not None:
+            self.retries_429 += 1
+            return float(retry_after), retry_after
+        if error is not None:
+            self.retries_network += 1
+        else:
+            self.retries_5xx += 1
+        return self.backoff(attempt), None
+
+    def stats(self):
+        return {
+            "retries": self.retries,
+            "retries_429": self.retries_429,
+            "retries_5xx": self.retries_5xx,
+            "retries_network": self.retries_network,
+            "gave_up": self.gave_up,
+            "budget_exhausted": self.budget_exhausted,
+            "budget_tokens": round(self.budget.tokens, 2),
+        }
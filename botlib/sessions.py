@@ -0,0 +1,728 @@
+import asyncio
+import atexit
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from botlib.resp import RespClient, RespError
+
+logger = logging.getLogger(__name__)
+
+# Процесс - экземпляр serverless-функции (Vercel, AWS Lambda): экземпляров
+# много, у каждого своя память и свой /tmp, и живут они недолго
+SERVERLESS = bool(os.environ.get("VERCEL") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME"))
+
+# Файл SQLite с сессиями пользователей (пусто - только память процесса).
+# В serverless-функции у каждого экземпляра свой временный /tmp, файл сессии
+# другим экземплярам не виден, поэтому по умолчанию его там нет: общие сессии
+# хранятся в SESSION_REDIS_URL
+SESSION_DB = os.environ.get("SESSION_DB", "" if SERVERLESS else os.path.join(tempfile.gettempdir(), "kenga_sessions.sqlite"))
+
+# Общий для нескольких процессов и машин Redis (redis://хост:порт/база);
+# если задан, сессии хранятся в нем, а не в SESSION_DB
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL", "")
+
+# Режим "сессия в кнопках": вся сессия пользователя кодируется в callback_data
+# (encode_callback_state), поэтому хранилище сессий обработчику не нужно
+STATELESS_SESSIONS = os.environ.get("STATELESS_SESSIONS", "").lower() in ("1", "true", "yes")
+
+# Сколько сессий держим в памяти процесса (самые давние вытесняются,
+# при следующем обращении сессия снова читается из хранилища)
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+
+# Через сколько секунд без обращений сессия пользователя удаляется
+# (из памяти и из хранилища); 0 - не удаляется
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 7 * 24 * 3600))
+
+# Как часто фоновая чистка удаляет просроченные сессии (секунды)
+SESSION_SWEEP_INTERVAL = float(os.environ.get("SESSION_SWEEP_INTERVAL", 60))
+
+# Как часто измененные сессии записываются в хранилище (секунды)
+SESSION_FLUSH_INTERVAL = float(os.environ.get("SESSION_FLUSH_INTERVAL", 0.5))
+
+# Сколько измененных сессий запускают запись, не дожидаясь интервала
+SESSION_FLUSH_BATCH = 500
+
+# Метка удаленной сессии в очереди записи
+_DELETED = object()
+
+
+# Сессия, закодированная в конце обработки обновления (SessionCache.commit):
+# в хранилище уходит этот снимок, даже если сессию уже снова меняют
+class _Snapshot:
+    __slots__ = ("session", "body")
+
+    def __init__(self, session, body):
+        self.session = session
+        self.body = body
+
+
+# Сессия пользователя калькулятора. Все поля - небольшие целые числа:
+# district и equipment_set - номера в каталоге (-1 - не выбрано), depth - метры
+# (0 - не выбрана), equipment и services - битовые маски выбранных позиций
+# каталога, поэтому переключение и проверка выбора - одна битовая операция
+class Session:
+    __slots__ = ("state", "district", "depth", "equipment_set", "equipment", "services")
+
+    def __init__(self, state=0, district=-1, depth=0, equipment_set=-1, equipment=0, services=0):
+        self.state = state
+        self.district = district
+        self.depth = depth
+        self.equipment_set = equipment_set
+        self.equipment = equipment
+        self.services = services
+
+    def toggle_equipment(self, index):
+        self.equipment ^= 1 << index
+
+    def has_equipment(self, index):
+        return self.equipment >> index & 1 == 1
+
+    def toggle_service(self, index):
+        self.services ^= 1 << index
+
+    def has_service(self, index):
+        return self.services >> index & 1 == 1
+
+    # Поля вне диапазонов SESSION_FORMAT (например, глубина больше 65535)
+    # не записываются: ValueError вместо struct.error из середины записи
+    def check(self):
+        for field, (low, high) in SESSION_FIELD_RANGES.items():
+            value = getattr(self, field)
+            if not isinstance(value, int) or not low <= value <= high:
+                raise ValueError(f"Поле сессии {field}={value!r} вне диапазона {low}..{high}")
+
+    # Компактная двоичная запись для хранилища (SESSION_FORMAT)
+    def to_bytes(self):
+        self.check()
+        return SESSION_FORMAT.pack(SESSION_FORMAT_VERSION, self.state, self.district, self.depth,
+                                   self.equipment_set, self.equipment, self.services)
+
+    # Запись другого формата или версии не восстанавливаем - начнется новая сессия
+    @classmethod
+    def from_bytes(cls, data):
+        if not isinstance(data, bytes) or len(data) != SESSION_FORMAT.size or data[0] != SESSION_FORMAT_VERSION:
+            return cls()
+        return cls(*SESSION_FORMAT.unpack(data)[1:])
+
+    def __repr__(self):
+        return (f"Session(state={self.state}, district={self.district}, depth={self.depth}, "
+                f"equipment_set={self.equipment_set}, equipment={self.equipment:#x}, services={self.services:#x})")
+
+
+# Двоичный формат Session: версия, state, district, depth, equipment_set
+# и маски выбора (до 64 позиций каталога в каждой) - 23 байта
+SESSION_FORMAT = struct.Struct("<BBhHbQQ")
+SESSION_FORMAT_VERSION = 1
+
+# Сколько позиций каталога помещается в Session (SESSION_FORMAT): номера районов
+# и наборов - поля h и b, выбор компонентов и услуг - маски по 64 бита, глубина - H
+SESSION_LIMITS = {"districts": 0x8000, "equipment_sets": 0x80, "components": 64, "services": 64, "depth": 0xFFFF}
+
+# Допустимые значения полей Session в SESSION_FORMAT
+SESSION_FIELD_RANGES = {
+    "state": (0, 0xFF),
+    "district": (-0x8000, 0x7FFF),
+    "depth": (0, 0xFFFF),
+    "equipment_set": (-0x80, 0x7F),
+    "equipment": (0, 0xFFFFFFFFFFFFFFFF),
+    "services": (0, 0xFFFFFFFFFFFFFFFF),
+}
+
+
+# Сессия внутри callback_data кнопки (до 64 байт): префикс и base64url от
+# версии, кода действия кнопки, его аргумента и полей сессии (маски - до 32
+# компонентов и 16 услуг) плюс обрезанная подпись HMAC, чтобы сессию
+# нельзя было подделать. Итого 28 символов
+CALLBACK_STATE_PREFIX = "~"
+CALLBACK_STATE_FORMAT = struct.Struct("<BBHBbHbIH")
+CALLBACK_STATE_VERSION = 1
+CALLBACK_SIGNATURE_SIZE = 6
+
+# То же для сессии в кнопке (CALLBACK_STATE_FORMAT): номера районов и наборов -
+# поля b, маски - 32 компонента (I) и 16 услуг (H), глубина и аргумент кнопки - H
+CALLBACK_STATE_LIMITS = {"districts": 0x80, "equipment_sets": 0x80, "components": 32, "services": 16, "depth": 0xFFFF}
+
+
+def _callback_signature(body, key):
+    return hmac.new(key, body, hashlib.sha256).digest()[:CALLBACK_SIGNATURE_SIZE]
+
+
+# callback_data с действием (код, аргумент) и сессией на момент показа кнопки
+def encode_callback_state(action, arg, session, key):
+    body = CALLBACK_STATE_FORMAT.pack(CALLBACK_STATE_VERSION, action, arg, session.state, session.district,
+                                      session.depth, session.equipment_set, session.equipment, session.services)
+    token = base64.urlsafe_b64encode(body + _callback_signature(body, key)).rstrip(b"=")
+    return CALLBACK_STATE_PREFIX + token.decode("ascii")
+
+
+# Обратно: (код действия, аргумент, Session) или None, если данные
+# не в этом формате, другой версии или подпись не сходится
+def decode_callback_state(data, key):
+    if not data.startswith(CALLBACK_STATE_PREFIX):
+        return None
+    token = data[len(CALLBACK_STATE_PREFIX):]
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except ValueError:
+        return None
+    if len(raw) != CALLBACK_STATE_FORMAT.size + CALLBACK_SIGNATURE_SIZE:
+        return None
+    body, signature = raw[:CALLBACK_STATE_FORMAT.size], raw[CALLBACK_STATE_FORMAT.size:]
+    if not hmac.compare_digest(signature, _callback_signature(body, key)):
+        return None
+    version, action, arg, *fields = CALLBACK_STATE_FORMAT.unpack(body)
+    if version != CALLBACK_STATE_VERSION:
+        return None
+    return action, arg, Session(*fields)
+
+
+# Номера установленных битов маски по возрастанию
+def mask_bits(mask):
+    index = 0
+    while mask:
+        if mask & 1:
+            yield index
+        mask >>= 1
+        index += 1
+
+
+# Хранилище сессий: ключ - строка, значение - закодированная сессия (str или bytes).
+# Реализации: MemorySessionStore (память процесса), SqliteSessionStore и
+# RespSessionStore (Redis, общий для нескольких машин - shared)
+class SessionStore:
+    # Хранилище общее с другими процессами: копия сессии в памяти может устареть
+    shared = False
+
+    # Сессия по ключу или None (и если она не менялась дольше max_age секунд)
+    def load(self, key, max_age=None):
+        raise NotImplementedError
+
+    # Записываем пачку: {ключ: сессия}, None - удалить
+    def store_many(self, items):
+        raise NotImplementedError
+
+    # Удаляем сессии, не менявшиеся дольше max_age секунд; возвращает их число
+    def purge(self, max_age):
+        return 0
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def load(self, key, max_age=None):
+        with self._lock:
+            body, updated = self._data.get(key, (None, 0))
+        if body is None or (max_age and time.time() - updated > max_age):
+            return None
+        return body
+
+    def store_many(self, items):
+        now = time.time()
+        with self._lock:
+            for key, body in items.items():
+                if body is None:
+                    self._data.pop(key, None)
+                else:
+                    self._data[key] = (body, now)
+
+    def purge(self, max_age):
+        cutoff = time.time() - max_age
+        with self._lock:
+            expired = [key for key, (_, updated) in self._data.items() if updated < cutoff]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+
+# Сессии в SQLite (режим WAL): чтение не блокирует запись, несколько процессов
+# на одной машине видят общие сессии. Таблица общая, обработчики разделены по namespace
+class SqliteSessionStore(SessionStore):
+    def __init__(self, path, namespace="default"):
+        self.path = path
+        self.namespace = namespace
+        self._local = threading.local()
+
+    # Соединение на поток (sqlite3 не разрешает делить его между потоками)
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            self._local.conn = conn
+        return conn
+
+    def load(self, key, max_age=None):
+        cutoff = time.time() - max_age if max_age else 0
+        row = self._conn().execute("SELECT body FROM sessions WHERE namespace = ? AND key = ? AND updated >= ?",
+                                   (self.namespace, key, cutoff)).fetchone()
+        return None if row is None else row[0]
+
+    # Вся пачка - одна транзакция (один fsync журнала)
+    def store_many(self, items):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO sessions (namespace, key, body, updated) VALUES (?, ?, ?, ?)",
+                [(self.namespace, key, body, now) for key, body in items.items() if body is not None],
+            )
+            conn.executemany(
+                "DELETE FROM sessions WHERE namespace = ? AND key = ?",
+                [(self.namespace, key) for key, body in items.items() if body is None],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def purge(self, max_age):
+        return self._conn().execute("DELETE FROM sessions WHERE namespace = ? AND updated < ?",
+                                    (self.namespace, time.time() - max_age)).rowcount
+
+
+# Сессии в Redis (протокол RESP): общие для всех реплик бота.
+# Время жизни сессии задает сам сервер (SET ... EX ttl), чтение продлевает его
+# в том же пакете (GET + EXPIRE), а пачка изменений уходит одним конвейером:
+# и чтение, и запись сессии - по одному сетевому round trip
+class RespSessionStore(SessionStore):
+    shared = True
+
+    def __init__(self, client, namespace="default", ttl=SESSION_TTL):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = int(ttl)
+
+    def _key(self, key):
+        return f"session:{self.namespace}:{key}"
+
+    def _check(self, replies):
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    def load(self, key, max_age=None):
+        key = self._key(key)
+        commands = [("GET", key)]
+        if self.ttl > 0:
+            commands.append(("EXPIRE", key, self.ttl))
+        return self._check(self.client.pipeline(commands))[0]
+
+    def store_many(self, items):
+        commands = []
+        for key, body in items.items():
+            if body is None:
+                commands.append(("DEL", self._key(key)))
+            elif self.ttl > 0:
+                commands.append(("SET", self._key(key), body, "EX", self.ttl))
+            else:
+                commands.append(("SET", self._key(key), body))
+        self._check(self.client.pipeline(commands))
+
+    def stats(self):
+        return self.client.stats()
+
+    def close(self):
+        self.client.close()
+
+
+# Сессии пользователей: LRU-кэш в памяти процесса перед хранилищем.
+# Работает как словарь user_states: чтение промаха идет в хранилище (read-through),
+# а изменения копятся в памяти и записываются пачками фоновым потоком (write-back),
+# поэтому нажатие кнопки не ждет записи на диск.
+# Обработчики меняют словарь сессии на месте, поэтому сессия, полученная
+# через [] или get(), тоже считается измененной и попадет в следующую запись.
+# Сессии пишутся в хранилище как JSON, а с session_type (например, Session) -
+# как session.to_bytes() и восстанавливаются через session_type.from_bytes().
+# Если хранилище общее (shared), обработка обновления обрамляется refresh(key)
+# и commit(): первое обращение читает свежую сессию, а изменения уходят
+# в хранилище сразу после обработки, до следующего обновления пользователя.
+# Размер ограничен: сверх capacity вытесняется давно не использованная сессия,
+# а сессия без обращений дольше ttl удаляется совсем. Записи лежат в порядке
+# последнего обращения, поэтому и то и другое снимается с начала за O(1)
+class SessionCache:
+    def __init__(self, store=None, capacity=SESSION_CACHE_SIZE, ttl=SESSION_TTL,
+                 flush_interval=SESSION_FLUSH_INTERVAL, flush_batch=SESSION_FLUSH_BATCH, session_type=None):
+        self.store = store
+        self.session_type = session_type
+        self.capacity = capacity
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+
+        # Ключ -> [сессия, время последнего обращения]
+        self._cache = OrderedDict()
+        # Ключи, ожидающие записи: ключ -> сессия, _Snapshot или _DELETED
+        self._dirty = {}
+        # Пользователи, чье обновление сейчас обрабатывается (refresh без commit):
+        # ключ -> число обработок. Их сессии фоновая запись не кодирует
+        self._active = {}
+        self._lock = threading.RLock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.store_errors = 0
+        self.encode_errors = 0
+        self.evictions = 0
+        self.expired = 0
+        self.purged = 0
+        self.peak_size = 0
+
+    def _is_expired(self, accessed, now):
+        return self.ttl > 0 and now - accessed > self.ttl
+
+    # Удаляем сессию по истечении ttl (и из хранилища)
+    def _expire(self, key):
+        del self._cache[key]
+        self.expired += 1
+        if self.store is not None:
+            self._dirty[key] = _DELETED
+
+    # Снимаем с начала просроченные сессии; возвращает их число
+    def _drop_expired(self, now):
+        count = 0
+        while self._cache:
+            key, (_, accessed) = next(iter(self._cache.items()))
+            if not self._is_expired(accessed, now):
+                break
+            self._expire(key)
+            count += 1
+        return count
+
+    # Поиск без изменения; None - сессии нет
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and self._is_expired(entry[1], now):
+                self._expire(key)
+                entry = None
+            if entry is not None:
+                entry[1] = now
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            session = self._unsaved(key)
+            if session is _DELETED:
+                return None
+            if session is not None:
+                self._remember(key, session, now)
+                return session
+        if self.store is None:
+            return None
+
+        try:
+            session = self.store.load(str(key), self.ttl or None)
+        except Exception as e:
+            self.store_errors += 1
+            logger.warning(f"Не удалось прочитать сессию {key}: {e}")
+            return None
+        self.loads += 1
+        if session is None:
+            return None
+        session = self._decode(session)
+        with self._lock:
+            # Пока читали, сессию могли записать в этом процессе - она новее
+            current = self._unsaved(key)
+            if key in self._cache:
+                current = self._cache[key][0]
+            if current is _DELETED:
+                return None
+            if current is not None:
+                return current
+            self._remember(key, session, now)
+        return session
+
+    # Еще не записанная сессия из очереди записи (или _DELETED, None)
+    def _unsaved(self, key):
+        session = self._dirty.get(key)
+        return session.session if isinstance(session, _Snapshot) else session
+
+    def _remember(self, key, session, now):
+        self._cache[key] = [session, now]
+        self._cache.move_to_end(key)
+        self._drop_expired(now)
+        while len(self._cache) > self.capacity:
+            # Несохраненная сессия остается в _dirty до записи
+            self._cache.popitem(last=False)
+            self.evictions += 1
+        self.peak_size = max(self.peak_size, len(self._cache))
+
+    def _encode(self, session):
+        if self.session_type is not None:
+            return session.to_bytes()
+        return json.dumps(session, ensure_ascii=False)
+
+    def _decode(self, body):
+        if self.session_type is not None:
+            return self.session_type.from_bytes(body)
+        return json.loads(body)
+
+    def _mark_dirty(self, key, session):
+        if self.store is None:
+            return
+        self._dirty[key] = session
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="session-flusher", daemon=True)
+            self._flusher.start()
+        if len(self._dirty) >= self.flush_batch:
+            self._wakeup.set()
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def __getitem__(self, key):
+        session = self._lookup(key)
+        if session is None:
+            raise KeyError(key)
+        with self._lock:
+            self._mark_dirty(key, session)
+        return session
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, session):
+        with self._lock:
+            self._remember(key, session, time.monotonic())
+            self._mark_dirty(key, session)
+
+    def __delitem__(self, key):
+        if self.pop(key, None) is None:
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        session = self._lookup(key)
+        with self._lock:
+            self._cache.pop(key, None)
+            self._mark_dirty(key, _DELETED)
+        return default if session is None else session
+
+    @property
+    def shared(self):
+        return self.store is not None and self.store.shared
+
+    # Начало обработки обновления пользователя: пока не вызван commit(key), фоновая
+    # запись не кодирует его сессию. При общем хранилище забываем копию в памяти
+    # (если в ней нет еще не записанных изменений) и читаем свежую
+    def refresh(self, key):
+        with self._lock:
+            self._active[key] = self._active.get(key, 0) + 1
+        if not self.shared:
+            return
+        with self._lock:
+            if key not in self._dirty:
+                self._cache.pop(key, None)
+        self._lookup(key)
+
+    # Конец обработки обновления пользователя key: сессия кодируется здесь, пока
+    # ее никто не меняет (обновления одного пользователя идут по очереди), и в
+    # хранилище уходит этот снимок. При общем хранилище записываем сразу
+    def commit(self, key=None):
+        if key is not None:
+            with self._lock:
+                count = self._active.pop(key, 0) - 1
+                if count > 0:
+                    self._active[key] = count
+                session = self._dirty.get(key)
+                if session is not None and session is not _DELETED and not isinstance(session, _Snapshot):
+                    snapshot = self._snapshot(key, session)
+                    if snapshot is None:
+                        del self._dirty[key]
+                    else:
+                        self._dirty[key] = snapshot
+        if self.shared:
+            self.flush()
+
+    # То же из event loop: с общим хранилищем обращение к нему - в потоке
+    async def refresh_async(self, key):
+        if self.shared:
+            await asyncio.to_thread(self.refresh, key)
+        else:
+            self.refresh(key)
+
+    async def commit_async(self, key=None):
+        if self.shared:
+            await asyncio.to_thread(self.commit, key)
+        else:
+            self.commit(key)
+
+    # Закодированный снимок сессии или None, если ее нельзя записать
+    def _snapshot(self, key, session):
+        try:
+            return _Snapshot(session, self._encode(session))
+        except (ValueError, TypeError, RuntimeError, struct.error) as e:
+            # Сессия, которую нельзя записать, не должна терять остальные
+            self.encode_errors += 1
+            logger.error(f"Не удалось закодировать сессию {key}, пропускаем: {e}")
+            return None
+
+    # Записываем все накопившиеся изменения одной пачкой
+    def flush(self):
+        if self.store is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            active = set(self._active)
+
+        items = {}
+        retry = {}
+        for key, session in batch.items():
+            if session is _DELETED:
+                items[str(key)] = None
+            elif isinstance(session, _Snapshot):
+                items[str(key)] = session.body
+            elif key in active:
+                # Обновление пользователя еще обрабатывается - запишем снимок из commit
+                retry[key] = session
+            else:
+                # Сессия изменена вне refresh/commit
+                snapshot = self._snapshot(key, session)
+                if snapshot is not None:
+                    items[str(key)] = snapshot.body
+        try:
+            if items:
+                self.store.store_many(items)
+            self.flushes += 1
+            self.flushed += len(items)
+        except Exception as e:
+            self.store_errors += 1
+            logger.error(f"Не удалось записать сессии: {e}")
+            retry = batch
+        if retry:
+            with self._lock:
+                # Более новые изменения, пришедшие во время записи, не затираем
+                for key, session in retry.items():
+                    self._dirty.setdefault(key, session)
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи сессий: {e}")
+
+    # Удаляем просроченные сессии из памяти и из хранилища
+    def sweep(self):
+        if self.ttl <= 0:
+            return 0
+        with self._lock:
+            count = self._drop_expired(time.monotonic())
+        if self.store is not None:
+            try:
+                self.purged += self.store.purge(self.ttl)
+            except Exception as e:
+                self.store_errors += 1
+                logger.warning(f"Не удалось удалить просроченные сессии: {e}")
+        return count
+
+    # Фоновая чистка для event loop процесса
+    async def run_sweeper(self, interval=SESSION_SWEEP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                logger.error(f"Ошибка фоновой чистки сессий: {e}")
+
+    def __len__(self):
+        return len(self._cache)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "capacity": self.capacity,
+                "occupancy": round(len(self._cache) / self.capacity, 3) if self.capacity else None,
+                "peak_size": self.peak_size,
+                "ttl": self.ttl,
+                "evictions": self.evictions,
+                "expired": self.expired,
+                "purged": self.purged,
+                "dirty": len(self._dirty),
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "flushes": self.flushes,
+                "flushed": self.flushed,
+                "store_errors": self.store_errors,
+                "encode_errors": self.encode_errors,
+                "store": type(self.store).__name__ if self.store is not None else None,
+                "store_stats": self.store.stats() if self.store is not None else None,
+            }
+
+
+# Сессии обработчиков процесса: отдельный кэш на каждое пространство имен
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def _flush_all():
+    for cache in list(_caches.values()):
+        try:
+            cache.flush()
+        except Exception as e:
+            logger.error(f"Не удалось записать сессии при завершении: {e}")
+
+
+def get_sessions(namespace, session_type=None):
+    with _caches_lock:
+        cache = _caches.get(namespace)
+        if cache is None:
+            if not _caches:
+                atexit.register(_flush_all)
+            if SESSION_REDIS_URL:
+                store = RespSessionStore(RespClient(SESSION_REDIS_URL), namespace)
+            elif SERVERLESS:
+                logger.warning(f"Сессии {namespace} хранятся только в памяти экземпляра функции и теряются "
+                               f"при переходе пользователя на другой экземпляр: задайте SESSION_REDIS_URL")
+                store = SqliteSessionStore(SESSION_DB, namespace) if SESSION_DB else None
+            elif SESSION_DB:
+                store = SqliteSessionStore(SESSION_DB, namespace)
+            else:
+                store = None
+            cache = _caches[namespace] = SessionCache(store, session_type=session_type)
+        return cache
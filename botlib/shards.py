@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Сколько параллельных очередей обработки обновлений
+SHARDS = int(os.environ.get("UPDATE_SHARDS", 16))
+
+# Сколько обновлений может ждать в одной очереди
+# (дальше submit ждет места, а submit_nowait отбрасывает обновление)
+SHARD_QUEUE_SIZE = int(os.environ.get("UPDATE_SHARD_QUEUE_SIZE", 100))
+
+# Поля обновления, в которых лежит объект с отправителем
+UPDATE_FIELDS = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "channel_post",
+    "edited_channel_post",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+
+
+# Пользователь, от которого пришло обновление (сырой JSON Telegram).
+# Если отправителя нет - чат, в крайнем случае update_id
+def update_user_id(update):
+    for field in UPDATE_FIELDS:
+        obj = update.get(field)
+        if not obj:
+            continue
+        sender = obj.get("from") or {}
+        if sender.get("id") is not None:
+            return sender["id"]
+        chat = obj.get("chat") or {}
+        if chat.get("id") is not None:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+
+# Похоже ли тело запроса на обновление Telegram
+def valid_update(update):
+    return isinstance(update, dict) and isinstance(update.get("update_id"), int)
+
+
+# Пул обработчиков обновлений из N последовательных очередей.
+# Обновление попадает в очередь hash(user_id) % N: обновления разных
+# пользователей обрабатываются параллельно, а обновления одного
+# пользователя - строго по порядку, поэтому его состояние
+# не нужно защищать блокировками
+class ShardedQueue:
+    def __init__(self, handler, shards=SHARDS, queue_size=SHARD_QUEUE_SIZE):
+        self.handler = handler
+        self.shards = max(shards, 1)
+        self.queue_size = queue_size
+
+        self._loop = None
+        self._queues = []
+        self._workers = []
+
+        # Метрики
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.shed = 0
+        self.max_queue_depth = 0
+
+    # Очереди и обработчики создаем в том event loop, где идет работа
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queues = [asyncio.Queue(self.queue_size) for _ in range(self.shards)]
+        self._workers = [loop.create_task(self._worker(queue)) for queue in self._queues]
+
+    def shard(self, key):
+        return hash(key) % self.shards
+
+    async def _worker(self, queue):
+        while True:
+            item, future = await queue.get()
+            try:
+                if not future.cancelled():
+                    future.set_result(await self.handler(item))
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при обработке обновления: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    # Ставим обновление в очередь пользователя key.
+    # Возвращает future с результатом обработчика
+    async def submit(self, key, item):
+        self._ensure_started()
+        queue = self._queues[self.shard(key)]
+        future = self._loop.create_future()
+        await queue.put((item, future))
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, queue.qsize())
+        return future
+
+    # Ставим обновление в очередь без ожидания. Если очередь пользователя
+    # заполнена, обновление отбрасываем и возвращаем None
+    def submit_nowait(self, key, item):
+        self._ensure_started()
+        queue = self._queues[self.shard(key)]
+        future = self._loop.create_future()
+        try:
+            queue.put_nowait((item, future))
+        except asyncio.QueueFull:
+            self.shed += 1
+            return None
+        # Результат никто не ждет, ошибку обработчик уже записал в лог
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, queue.qsize())
+        return future
+
+    # То же из другого потока через botlib.event_loop: принято ли обновление
+    async def offer(self, key, item):
+        return self.submit_nowait(key, item) is not None
+
+    # Ставим обновление в очередь и ждем, пока оно будет обработано
+    async def process(self, key, item):
+        return await (await self.submit(key, item))
+
+    # Ждем, пока все поставленные обновления будут обработаны
+    async def join(self):
+        for queue in self._queues:
+            await queue.join()
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._loop = None
+        self._queues = []
+        self._workers = []
+
+    def stats(self):
+        return {
+            "shards": self.shards,
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "failed": self.failed,
+            "shed": self.shed,
+            "queued": sum(queue.qsize() for queue in self._queues),
+            "max_queue_depth": self.max_queue_depth,
+        }
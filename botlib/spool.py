@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from botlib.shards import update_user_id
+
+logger = logging.getLogger(__name__)
+
+# На сколько разделов делим очередь: обновления одного пользователя всегда
+# в одном разделе, разделы распределяются между процессами-обработчиками
+SPOOL_PARTITIONS = int(os.environ.get("SPOOL_PARTITIONS", 64))
+
+# Номер этого процесса-обработчика и сколько их всего
+SPOOL_WORKER_INDEX = int(os.environ.get("SPOOL_WORKER_INDEX", 0))
+SPOOL_WORKERS = int(os.environ.get("SPOOL_WORKERS", 1))
+
+# Сколько обновлений обработчик забирает за раз
+SPOOL_BATCH = 100
+
+# Через сколько секунд взятое, но не подтвержденное обновление
+# снова становится доступно (обработчик упал или завис)
+SPOOL_LEASE = float(os.environ.get("SPOOL_LEASE", 60))
+
+# Пауза между проверками пустой очереди (секунды)
+SPOOL_POLL_INTERVAL = 0.1
+
+# Сколько записей максимум попадает в одну транзакцию (один fsync)
+SPOOL_MAX_WRITE_BATCH = 500
+
+
+# Раздел очереди для обновления
+def spool_partition(update, partitions=SPOOL_PARTITIONS):
+    key = update_user_id(update)
+    if not isinstance(key, int):
+        key = zlib.crc32(str(key).encode("utf-8"))
+    return key % partitions
+
+
+# Очередь обновлений на диске (таблица SQLite в режиме WAL).
+# Приемник добавляет обновления группами: все записи, накопившиеся, пока шел
+# предыдущий fsync, фиксируются одной транзакцией, и только после этого
+# вызывающий получает подтверждение (можно отвечать Telegram 200).
+# Обработчики забирают записи с арендой и удаляют их после обработки:
+# доставка "хотя бы один раз", незавершенное переживает перезапуск процесса
+class UpdateSpool:
+    def __init__(self, path, partitions=SPOOL_PARTITIONS, max_write_batch=SPOOL_MAX_WRITE_BATCH):
+        self.path = path
+        self.partitions = partitions
+        self.max_write_batch = max_write_batch
+
+        self._local = threading.local()
+        self._pending = []
+        self._cond = threading.Condition()
+        self._writer = None
+
+        # Метрики
+        self.appended = 0
+        self.write_batches = 0
+        self.max_write_batch_seen = 0
+        self.claimed = 0
+        self.acked = 0
+
+        self._conn()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # FULL: каждая фиксация транзакции - fsync журнала
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                partition INTEGER NOT NULL,
+                body TEXT NOT NULL,
+                claimed_by TEXT,
+                claimed_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS spool_partition ON spool (partition, id)")
+        return conn
+
+    # Соединение на поток (sqlite3 не разрешает делить его между потоками)
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # Поток записи: забирает все накопившиеся записи и фиксирует их одной транзакцией
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._pending[:self.max_write_batch]
+                del self._pending[:self.max_write_batch]
+
+            error = None
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO spool (partition, body) VALUES (?, ?)",
+                                 [(partition, body) for partition, body, _ in batch])
+                conn.execute("COMMIT")
+                self.appended += len(batch)
+                self.write_batches += 1
+                self.max_write_batch_seen = max(self.max_write_batch_seen, len(batch))
+            except Exception as e:
+                error = e
+                logger.error(f"Не удалось записать обновления в очередь на диске: {e}")
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+            for _, _, done in batch:
+                done(error)
+
+    def _enqueue(self, update, done):
+        record = (spool_partition(update, self.partitions), json.dumps(update, ensure_ascii=False), done)
+        with self._cond:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="update-spool-writer", daemon=True)
+                self._writer.start()
+            self._pending.append(record)
+            self._cond.notify()
+
+    # Записываем обновление; возвращается, когда запись надежно на диске
+    def append(self, update):
+        written = threading.Event()
+        result = []
+
+        def done(error):
+            result.append(error)
+            written.set()
+
+        self._enqueue(update, done)
+        written.wait()
+        if result[0] is not None:
+            raise result[0]
+
+    # То же для event loop
+    async def append_async(self, update):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(error):
+            loop.call_soon_threadsafe(_resolve, error)
+
+        def _resolve(error):
+            if future.done():
+                return
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+        self._enqueue(update, done)
+        await future
+
+    # Берем до limit записей своих разделов: свободные, с истекшей арендой
+    # и (после перезапуска, recover) взятые этим же обработчиком.
+    # Возвращает список (id, обновление)
+    def claim(self, consumer, limit=SPOOL_BATCH, lease=SPOOL_LEASE, worker_index=0, workers=1, recover=False):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, body FROM spool WHERE partition % ? = ? "
+                "AND (claimed_until < ? OR (? AND claimed_by = ?)) ORDER BY id LIMIT ?",
+                (workers, worker_index, now, recover, consumer, limit),
+            ).fetchall()
+            if rows:
+                conn.execute(
+                    f"UPDATE spool SET claimed_by = ?, claimed_until = ? WHERE id IN ({','.join('?' * len(rows))})",
+                    (consumer, now + lease, *(row[0] for row in rows)),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.claimed += len(rows)
+        return [(row_id, json.loads(body)) for row_id, body in rows]
+
+    # Подтверждаем обработку: записи удаляются из очереди
+    def ack(self, ids):
+        if not ids:
+            return
+        self._conn().execute(f"DELETE FROM spool WHERE id IN ({','.join('?' * len(ids))})", list(ids))
+        self.acked += len(ids)
+
+    def backlog(self):
+        return self._conn().execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def stats(self):
+        return {
+            "appended": self.appended,
+            "write_batches": self.write_batches,
+            "max_write_batch": self.max_write_batch_seen,
+            "claimed": self.claimed,
+            "acked": self.acked,
+            "backlog": self.backlog(),
+        }
+
+
+# Обработчик очереди на диске: забирает пачку своих разделов, обрабатывает
+# ее через dispatch (параллельно, порядок по пользователю обеспечивает dispatch)
+# и подтверждает только после обработки всей пачки
+class SpoolConsumer:
+    def __init__(self, spool, dispatch, worker_index=SPOOL_WORKER_INDEX, workers=SPOOL_WORKERS,
+                 batch=SPOOL_BATCH, lease=SPOOL_LEASE):
+        self.spool = spool
+        self.dispatch = dispatch
+        self.worker_index = worker_index
+        self.workers = max(workers, 1)
+        self.batch = batch
+        self.lease = lease
+        # Имя постоянное между перезапусками: свои незавершенные записи забираем сразу
+        self.consumer = f"worker-{worker_index}"
+
+        # Метрики
+        self.processed = 0
+        self.failed = 0
+        self.errors = 0
+
+    async def run(self, stop=None):
+        recover = True
+        while stop is None or not stop.is_set():
+            try:
+                batch = await asyncio.to_thread(self.spool.claim, self.consumer, self.batch, self.lease,
+                                                self.worker_index, self.workers, recover)
+                recover = False
+                if not batch:
+                    await asyncio.sleep(SPOOL_POLL_INTERVAL)
+                    continue
+
+                results = await asyncio.gather(*(self.dispatch(update) for _, update in batch),
+                                               return_exceptions=True)
+                for (_, update), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        # Ошибку обработчика не повторяем, иначе одно "плохое" обновление заблокирует очередь
+                        self.failed += 1
+                        logger.error(f"Ошибка при обработке обновления {update.get('update_id')}: {result}")
+                self.processed += len(batch)
+                await asyncio.to_thread(self.spool.ack, [row_id for row_id, _ in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка очереди обновлений на диске: {e}")
+                await asyncio.sleep(1)
+
+    def stats(self):
+        return {
+            "consumer": self.consumer,
+            "processed": self.processed,
+            "failed": self.failed,
+            "errors": self.errors,
+        }
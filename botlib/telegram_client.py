@@ -0,0 +1,213 @@
+import http.client
+import json
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+from botlib.outbound import get_outbound
+
+logger = logging.getLogger(__name__)
+
+# Адрес Telegram Bot API по умолчанию
+DEFAULT_API_BASE = "https://api.telegram.org"
+
+# Адрес Bot API, с которым работают все реализации бота.
+# Для тестов и нагрузочных прогонов - локальный botlib.fake_telegram
+API_BASE = os.environ.get("TELEGRAM_API_BASE", DEFAULT_API_BASE).rstrip("/")
+
+# Таймаут одного вызова API (секунды)
+DEFAULT_TIMEOUT = 10.0
+
+# Сколько простаивающих соединений держим в пуле
+DEFAULT_POOL_SIZE = 4
+
+# Через сколько секунд простоя соединение считаем протухшим
+# (Telegram закрывает keep-alive соединения примерно через минуту)
+DEFAULT_IDLE_TIMEOUT = 55.0
+
+# Ошибки отправки запроса по переиспользованному соединению, которое уже
+# закрыл сервер: запрос до Telegram не дошел, его можно повторить.
+# RemoteDisconnected/BadStatusLine при чтении ответа сюда не входят - тело
+# запроса уже отправлено, и повтор sendMessage доставил бы сообщение дважды
+STALE_CONNECTION_ERRORS = (
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    BrokenPipeError,
+)
+
+
+# Ошибка, которую возвращает Telegram в поле "ok": false
+class TelegramError(Exception):
+    def __init__(self, response):
+        self.response = response
+        self.error_code = response.get("error_code")
+        self.description = response.get("description") or response.get("error")
+        super().__init__(f"{self.error_code}: {self.description}")
+
+
+# Клиент Bot API с пулом постоянных (keep-alive) соединений.
+# Соединения переживают вызовы и "тёплые" запуски serverless-функции,
+# поэтому TCP + TLS рукопожатие платим только один раз.
+class TelegramClient:
+    def __init__(self, token, base_url=DEFAULT_API_BASE, timeout=DEFAULT_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT, outbound=None):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.base_url = base_url
+        self.outbound = outbound
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+
+        self._https = parsed.scheme == "https"
+        self._host = parsed.hostname
+        self._port = parsed.port or (443 if self._https else 80)
+        self._path_prefix = f"{parsed.path.rstrip('/')}/bot{token}/"
+        self._ssl_context = ssl.create_default_context() if self._https else None
+
+        # Простаивающие соединения: список пар (соединение, время последнего использования)
+        self._idle = []
+        self._lock = threading.Lock()
+
+        # Счетчики для мониторинга
+        self.stats = {"requests": 0, "connections_opened": 0, "connections_reused": 0,
+                      "stale_retries": 0, "errors": 0}
+
+    # Создание нового соединения
+    def _connect(self, timeout):
+        self.stats["connections_opened"] += 1
+        if self._https:
+            conn = http.client.HTTPSConnection(self._host, self._port, timeout=timeout,
+                                               context=self._ssl_context)
+        else:
+            conn = http.client.HTTPConnection(self._host, self._port, timeout=timeout)
+        conn.connect()
+        return conn
+
+    # Берем соединение из пула или открываем новое
+    def _acquire(self, timeout):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < self.idle_timeout and conn.sock is not None:
+                    self.stats["connections_reused"] += 1
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return self._connect(timeout), False
+
+    # Возвращаем соединение в пул (лишние закрываем)
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    # Один HTTP-запрос по соединению из пула
+    def _send(self, method, body, timeout):
+        headers = {"Connection": "keep-alive"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+
+        conn, reused = self._acquire(timeout)
+        try:
+            try:
+                conn.request("POST" if body is not None else "GET",
+                             self._path_prefix + method, body=body, headers=headers)
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # Сервер закрыл простаивавшее соединение до отправки запроса -
+                # повторяем один раз на новом соединении
+                self.stats["stale_retries"] += 1
+                conn = self._connect(timeout)
+                conn.request("POST" if body is not None else "GET",
+                             self._path_prefix + method, body=body, headers=headers)
+            response = conn.getresponse()
+            payload = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return response.status, payload
+
+    # Вызов метода Bot API. Возвращает ответ Telegram в виде словаря,
+    # при сетевой ошибке - {"ok": False, "error": ...}.
+    # Если задан конвейер outbound, вызов проходит через его лимиты и повторы
+    def request(self, method, data=None, timeout=None):
+        try:
+            if self.outbound is None:
+                return self._request(method, data, timeout)
+            return self.outbound.send(method, data, lambda m, p: self._request(m, p, timeout))
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Ошибка при вызове Telegram API ({method}): {e}")
+            return {"ok": False, "error": str(e)}
+
+    # Одна попытка вызова; сетевые ошибки выбрасываются наружу
+    def _request(self, method, data=None, timeout=None):
+        self.stats["requests"] += 1
+        body = json.dumps(data).encode("utf-8") if data else None
+        status, payload = self._send(method, body, timeout or self.timeout)
+
+        try:
+            return json.loads(payload.decode("utf-8"))
+        except ValueError:
+            self.stats["errors"] += 1
+            return {"ok": False, "error_code": status, "description": payload[:200].decode("utf-8", "replace")}
+
+    # То же, что request, но возвращает поле result или выбрасывает TelegramError
+    def call(self, method, data=None, timeout=None):
+        response = self.request(method, data, timeout)
+        if not response.get("ok"):
+            raise TelegramError(response)
+        return response.get("result")
+
+    # Заранее резолвим DNS и открываем соединение (TCP + TLS),
+    # чтобы первое обновление не платило за рукопожатие
+    def warmup(self, background=True):
+        def _warmup():
+            try:
+                socket.getaddrinfo(self._host, self._port, type=socket.SOCK_STREAM)
+                self._release(self._connect(self.timeout))
+            except Exception as e:
+                logger.warning(f"Не удалось прогреть соединение с {self._host}: {e}")
+
+        if background:
+            threading.Thread(target=_warmup, daemon=True).start()
+        else:
+            _warmup()
+
+    # Закрываем все соединения пула
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+# Общие клиенты процесса (по одному на токен), чтобы все модули делили пул
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(token, base_url=API_BASE, warmup=True):
+    key = (token, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = TelegramClient(token, base_url, outbound=get_outbound())
+            _clients[key] = client
+            if warmup:
+                client.warmup()
+    return client